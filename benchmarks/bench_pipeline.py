@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+"""
+Benchmarks of the pipeline's own overhead, using the offline mock backend.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_pipeline --seeds 20 --output bench.json
+
+Pass --baseline with the JSON output of an earlier run to fail (exit code 1)
+when a benchmark's median time regresses by more than --max-regression.
+"""
+
+import contextlib
+import functools
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+
+import business_modeler
+import business_modeler_chains
+
+
+def time_call(function, repeat):
+    """
+    Time repeated calls of a function.
+
+    Parameters:
+    - function (callable): The function to time; it is called without arguments.
+    - repeat (int): The number of calls.
+
+    Returns:
+    - dict: The minimum, median and mean duration of a call in seconds.
+    """
+    durations = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start_time)
+    return {
+        "min": min(durations),
+        "median": statistics.median(durations),
+        "mean": statistics.mean(durations),
+    }
+
+
+def load_seeds(seed_dir, count):
+    """
+    Read seed files from a directory, cycling through them to get count seeds.
+
+    Parameters:
+    - seed_dir (str): The directory containing the seed files.
+    - count (int): The number of seeds to return.
+
+    Returns:
+    - list: The contents of the seeds.
+    """
+    seeds = []
+    for seed_file in business_modeler.find_seed_files(seed_dir, "*.md"):
+        with open(seed_file, "r") as f:
+            seeds.append(f.read())
+    return [seeds[i % len(seeds)] for i in range(count)]
+
+
+def build_mock_chain(chain_config, mock_options):
+    """
+    Build the configured chain on the mock backend, without a response cache.
+    """
+    return business_modeler_chains.build_chain(
+        None,
+        chain_config["chains"],
+        chain_config.get("prompt_templates_dir", business_modeler.PROMPT_TEMPLATES_DIR),
+        chain_config.get("common_prefix_file", business_modeler.COMMON_PREFIX_FILE),
+        backend="mock",
+        mock_options=mock_options,
+    )
+
+
+def run_benchmarks(chain_config, seeds, repeat, formats, batch_workers, mock_options):
+    """
+    Run every benchmark.
+
+    Parameters:
+    - chain_config (dict): The configuration, as loaded from config.yaml.
+    - seeds (list): The seeds to run the chain for.
+    - repeat (int): The number of times each benchmark is repeated.
+    - formats (list): The report formats generated by the report benchmark.
+    - batch_workers (int): The number of seeds run concurrently by the batch benchmark.
+    - mock_options (dict): MockChatModel settings.
+
+    Returns:
+    - dict: The timings of each benchmark.
+    """
+    results = {}
+    results["chain_construction"] = time_call(
+        lambda: build_mock_chain(chain_config, mock_options), repeat
+    )
+
+    chain = build_mock_chain(chain_config, mock_options)
+    outputs = [business_modeler_chains.run_chain(chain, seed) for seed in seeds]
+
+    def render_prompts():
+        for output in outputs:
+            for stage in chain.chains:
+                stage.prompt.format(
+                    **{key: output[key] for key in stage.prompt.input_variables}
+                )
+
+    results["prompt_rendering"] = time_call(render_prompts, repeat)
+
+    def run_sequentially():
+        for seed in seeds:
+            business_modeler_chains.run_chain(chain, seed)
+
+    results["scheduling"] = time_call(run_sequentially, repeat)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+
+        def generate_reports():
+            for i, output in enumerate(outputs):
+                business_modeler.generate_report(
+                    os.path.join(tmp_dir, f"report-{i}"), formats, **output
+                )
+
+        results["report_generation"] = time_call(generate_reports, repeat)
+
+        seed_files = []
+        for i, seed in enumerate(seeds):
+            seed_files.append(os.path.join(tmp_dir, f"seed-{i}.md"))
+            with open(seed_files[-1], "w") as f:
+                f.write(seed)
+
+        def run_batch():
+            # Silence the progress output of every seed
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                business_modeler_chains.run_batch(
+                    chain,
+                    seed_files,
+                    os.path.join(tmp_dir, "reports"),
+                    formats,
+                    batch_workers,
+                )
+
+        results["batch"] = time_call(run_batch, repeat)
+
+    return results
+
+
+def run_startup_benchmarks(repeat):
+    """
+    Time how long the command line takes to start when it runs no chain, each
+    time in a fresh Python process.
+
+    Parameters:
+    - repeat (int): The number of times each benchmark is repeated.
+
+    Returns:
+    - dict: The timings of importing the module, showing the help and showing
+      the example input.
+    """
+    root_dir = os.path.dirname(os.path.abspath(business_modeler.__file__))
+    script = os.path.join(root_dir, "business_modeler.py")
+    commands = {
+        "startup_import": [sys.executable, "-c", "import business_modeler"],
+        "startup_help": [sys.executable, script, "--help"],
+        "startup_example": [sys.executable, script],
+    }
+    return {
+        name: time_call(
+            functools.partial(
+                subprocess.run,
+                command,
+                cwd=root_dir,
+                stdout=subprocess.DEVNULL,
+                check=True,
+            ),
+            repeat,
+        )
+        for name, command in commands.items()
+    }
+
+
+def find_regressions(results, baseline, max_regression):
+    """
+    Compare the median timings with a baseline.
+
+    Parameters:
+    - results (dict): The timings of this run.
+    - baseline (dict): The timings of an earlier run.
+    - max_regression (float): The allowed relative slowdown, e.g. 0.25 for 25%.
+
+    Returns:
+    - list: A description of each benchmark that regressed.
+    """
+    regressions = []
+    for name, timing in results.items():
+        if name not in baseline:
+            continue
+        limit = baseline[name]["median"] * (1 + max_regression)
+        if timing["median"] > limit:
+            regressions.append(
+                f"{name}: {timing['median']:.4f}s > {limit:.4f}s "
+                f"(baseline {baseline[name]['median']:.4f}s)"
+            )
+    return regressions
+
+
+@click.command()
+@click.option("--seeds", default=20, show_default=True, help="Number of seeds.")
+@click.option(
+    "--seed-dir",
+    default="examples",
+    show_default=True,
+    help="Directory with the seed files to cycle through.",
+)
+@click.option(
+    "--repeat", default=5, show_default=True, help="Repetitions per benchmark."
+)
+@click.option(
+    "--config-file", default="config.yaml", help="Path to the configuration file."
+)
+@click.option(
+    "--format",
+    "report_format",
+    default="md,html",
+    show_default=True,
+    help="Report formats generated by the report benchmarks.",
+)
+@click.option(
+    "--batch-workers", default=4, show_default=True, help="Concurrent seeds in a batch."
+)
+@click.option(
+    "--latency", default=0.0, show_default=True, help="Simulated seconds per response."
+)
+@click.option(
+    "--tokens-per-second",
+    default=0.0,
+    show_default=True,
+    help="Simulated generation speed; 0 is instant.",
+)
+@click.option("--output", default=None, help="Write the timings to this JSON file.")
+@click.option("--baseline", default=None, help="JSON timings of an earlier run.")
+@click.option(
+    "--max-regression",
+    default=0.25,
+    show_default=True,
+    help="Allowed relative slowdown against the baseline.",
+)
+def main(
+    seeds,
+    seed_dir,
+    repeat,
+    config_file,
+    report_format,
+    batch_workers,
+    latency,
+    tokens_per_second,
+    output,
+    baseline,
+    max_regression,
+):
+    """Benchmark the pipeline's own overhead with the mock backend."""
+    chain_config = business_modeler.load_chain_config(config_file)
+    mock_options = {"latency": latency, "tokens_per_second": tokens_per_second}
+    results = run_startup_benchmarks(repeat)
+    results |= run_benchmarks(
+        chain_config,
+        load_seeds(seed_dir, seeds),
+        repeat,
+        business_modeler.parse_report_formats(report_format, False),
+        batch_workers,
+        mock_options,
+    )
+
+    for name, timing in results.items():
+        click.secho(
+            f"{name}: median {timing['median']:.4f}s, min {timing['min']:.4f}s, "
+            f"mean {timing['mean']:.4f}s",
+            fg="yellow",
+        )
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if baseline:
+        with open(baseline, "r") as f:
+            regressions = find_regressions(results, json.load(f), max_regression)
+        for regression in regressions:
+            click.secho(f"Regression: {regression}", fg="red")
+        if regressions:
+            exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,37 @@
 #!/usr/bin/env python
 
+import collections
 import contextlib
+import functools
+import glob
+import hashlib
+import json
+import multiprocessing
 import os
 import re
+import shutil
+import signal
+import socket
+import socketserver
+import sqlite3
+import string
+import sys
+import threading
 import time
+import unicodedata
+import uuid
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from typing import Any, Dict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import click
 import yaml
 from dotenv import load_dotenv
-from langchain.callbacks import get_openai_callback
-from langchain.callbacks.base import BaseCallbackHandler
-from langchain.chains import LLMChain, SequentialChain
-from langchain.chat_models import ChatOpenAI
-from langchain.prompts import PromptTemplate
-from md2pdf.core import md2pdf
+
+# The language model pipeline (langchain, openai) lives in
+# business_modeler_chains, and the report renderers (markdown, md2pdf) are
+# imported by the functions using them, so that the command line starts
+# quickly when it only shows help or the example input.
 
 PROMPT_TEMPLATES_DIR = "templates"
 COMMON_PREFIX_FILE = "_common.txt"
@@ -24,6 +40,83 @@ OUTPUT_TEMPLATE_FILE = "output.txt"
 EXAMPLE_INPUT_FILE = "input_example.md"
 DEFAULT_TEMPERATURE = 0.7
 DEFAULT_MODEL_NAME = "gpt-3.5-turbo-16k"
+DEFAULT_BACKEND = "openai"
+BACKENDS = ["openai", "mock"]
+DEFAULT_BATCH_WORKERS = 4
+DEFAULT_RENDER_WORKERS = 2
+REPORT_FORMATS = ["md", "pdf", "html"]
+REPORT_FORMAT_NAMES = {"md": "Markdown", "pdf": "PDF", "html": "HTML"}
+DEFAULT_CACHE_DIR = ".cache"
+DEFAULT_CACHE_MAX_SIZE_MB = 100
+DEFAULT_CACHE_MAX_AGE_DAYS = 30
+# LLM parameters that do not change the generated text, so are left out of cache keys
+NON_SEMANTIC_LLM_PARAMS = {"stream", "request_timeout"}
+DEFAULT_TOKENIZER = "gpt2"
+# Rough characters per token, used to count tokens when no tokenizer is available
+CHARS_PER_TOKEN = 4
+TRUNCATION_MARKER = "\n[...]"
+# A line starting a numbered or bulleted list item
+LIST_ITEM = re.compile(r"\s*(?:\d+[.)]|[-*+])\s")
+# Settings of the "validate" section of a chain
+VALIDATION_RULES = [
+    "required_headings",
+    "min_items",
+    "min_length",
+    "max_length",
+    "forbidden_patterns",
+    "on_failure",
+    "max_retries",
+]
+# What to do with an output that fails validation
+VALIDATION_FAILURE_ACTIONS = ["abort", "retry"]
+DEFAULT_VALIDATION_RETRIES = 1
+# Template variables supplied by the caller instead of produced by a template
+EXTERNAL_INPUTS = ("seed",)
+DEFAULT_SERVER_HOST = "127.0.0.1"
+DEFAULT_SERVER_PORT = 8000
+# Finished jobs the server keeps the status of
+DEFAULT_MAX_JOBS = 1000
+DEFAULT_MAX_CONCURRENCY = 16
+DEFAULT_MAX_RETRIES = 6
+DEFAULT_RUNS_DIR = ".runs"
+DEFAULT_SPILL_DIR = ".spill"
+# Size of the chunks spilled outputs are copied into reports in
+SPILL_CHUNK_SIZE = 64 * 1024
+DEFAULT_HISTORY_FILE = "history.db"
+DEFAULT_BULK_DIR = ".batches"
+DEFAULT_BULK_POLL_INTERVAL = 60
+QUEUE_BACKENDS = ["sqlite", "directory"]
+DEFAULT_QUEUE_BACKEND = "sqlite"
+DEFAULT_QUEUE_PATHS = {"sqlite": "queue.db", "directory": ".queue"}
+# Seconds a claimed task stays leased to its worker without a heartbeat
+DEFAULT_QUEUE_LEASE = 300
+DEFAULT_QUEUE_MAX_ATTEMPTS = 3
+DEFAULT_QUEUE_POLL_INTERVAL = 2
+QUEUE_STATUSES = ["pending", "running", "done", "failed"]
+DEFAULT_SEED_MAX_TOKENS = 2000
+# What to do with a seed over its max_tokens
+SEED_OVERSIZE_ACTIONS = ["compress", "reject"]
+DEFAULT_SEED_CACHE_DIR = ".cache/seeds"
+DEFAULT_EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+DEFAULT_REPORT_SIMILARITY = 0.97
+DEFAULT_CANVAS_SIMILARITY = 0.9
+DEFAULT_SEED_CACHE_MAX_ENTRIES = 10000
+# Size of the hashed word and character features embedding seeds when the
+# embedding model is not available
+HASHED_EMBEDDING_SIZE = 512
+# Directory in the templates directory holding the JSON schema of each
+# template's output, used by the structured output mode
+SCHEMAS_DIR = "schemas"
+DEFAULT_REPORT_STORE = "reports.jsonl"
+# Python types of the JSON schema types
+SCHEMA_TYPES = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "integer": int,
+    "number": (int, float),
+    "boolean": bool,
+}
 
 
 def extract_variable_names(template):
@@ -43,6 +136,9 @@ def read_prompt_template(template_name, prompt_templates_dir, common_prefix_file
     """
     Read and return content from a prompt template file with a common prefix added to it.
 
+    The template is loaded through the TemplateRegistry of the directory, so
+    the files are only read again once they change.
+
     Parameters:
     - template_name (str): Name of the template file.
     - prompt_templates_dir (str): Directory path containing prompt template files.
@@ -51,13 +147,8 @@ def read_prompt_template(template_name, prompt_templates_dir, common_prefix_file
     Returns:
     - str: Content of the template file with common prefix added.
     """
-    common_prefix_path = os.path.join(prompt_templates_dir, common_prefix_file)
-    with open(common_prefix_path, "r") as common_file:
-        common_prefix = common_file.read()
-
-    template_path = os.path.join(prompt_templates_dir, template_name)
-    with open(template_path, "r") as template_file:
-        return common_prefix + template_file.read()
+    registry = get_template_registry(prompt_templates_dir, common_prefix_file)
+    return registry.prompt(template_name).text
 
 
 def load_chain_config(config_file):
@@ -88,291 +179,4039 @@ def read_template(template_name):
     Returns:
     - str: Content of the template file.
     """
-    path = os.path.join(PROMPT_TEMPLATES_DIR, template_name)
-    with open(path, "r") as f:
-        return f.read()
+    return get_template_registry(PROMPT_TEMPLATES_DIR).get(template_name).text
+
+
+CompiledTemplate = collections.namedtuple("CompiledTemplate", ["text", "variables"])
+
+
+class TemplateRegistry:
+    """
+    Loads the templates of a directory once, keeping the text of each one with
+    the names of its variables.
+
+    Templates are cached keyed on the modification times of their files, so a
+    template edited while the process runs (e.g. in server mode) is loaded
+    again on its next use. Files that cannot be stat'ed are read on every use,
+    which raises the usual errors when they are missing.
+
+    Attributes:
+        templates_dir (str): Directory containing the template files.
+        common_prefix_file (str): Name of the file prefixed to prompt templates.
+    """
+
+    def __init__(self, templates_dir, common_prefix_file=COMMON_PREFIX_FILE):
+        self.templates_dir = templates_dir
+        self.common_prefix_file = common_prefix_file
+        self._templates = {}
+
+    def _load(self, file_names):
+        paths = [os.path.join(self.templates_dir, name) for name in file_names]
+        try:
+            mtimes = tuple(os.stat(path).st_mtime_ns for path in paths)
+        except OSError:
+            mtimes = None
+        cached = self._templates.get(tuple(paths))
+        if mtimes is not None and cached is not None and cached[0] == mtimes:
+            return cached[1]
+
+        text = ""
+        for path in paths:
+            with open(path, "r") as f:
+                text += f.read()
+        template = CompiledTemplate(text, tuple(extract_variable_names(text)))
+        if mtimes is not None:
+            self._templates[tuple(paths)] = (mtimes, template)
+        return template
+
+    def get(self, template_name):
+        """
+        Return a template as it is, such as the output template.
+
+        Parameters:
+        - template_name (str): Name of the template file.
+
+        Returns:
+        - CompiledTemplate: The text of the template and its variable names.
+        """
+        return self._load([template_name])
+
+    def prompt(self, template_name):
+        """
+        Return a prompt template with the common prefix added to it.
+
+        Parameters:
+        - template_name (str): Name of the template file.
+
+        Returns:
+        - CompiledTemplate: The text of the prefixed template and its variable names.
+        """
+        return self._load([self.common_prefix_file, template_name])
+
+
+@functools.lru_cache(maxsize=None)
+def get_template_registry(templates_dir, common_prefix_file=COMMON_PREFIX_FILE):
+    """
+    Return the TemplateRegistry of a directory, shared by the whole process.
+    """
+    return TemplateRegistry(templates_dir, common_prefix_file)
 
 
-def create_llm_chain(llm, template_file, prompt_templates_dir, common_prefix_file):
+def find_cycles(graph):
     """
-    Create and return an LLMChain instance configured with the given parameters.
+    Find the cycles of a dependency graph.
 
     Parameters:
-    - llm (ChatOpenAI): An instance of ChatOpenAI which is used to perform the language model operations.
-    - template_file (str): The name of the template file to be used for prompt creation.
-    - prompt_templates_dir (str): Directory path containing prompt template files.
-    - common_prefix_file (str): Name of the file containing common prefix content to be appended before the template.
+    - graph (dict): A mapping of each key to the keys it depends on.
 
     Returns:
-    - LLMChain: An instance of LLMChain configured with the given parameters.
+    - list: Every cycle found, as a list of keys starting and ending with the same key.
     """
-    monitor = CallbackHandler()
-    # Extract variable names as input_keys
-    template_content = read_prompt_template(
-        template_file, prompt_templates_dir, common_prefix_file
-    )
-    input_keys = extract_variable_names(template_content)
-    # Set output_key as the name of the template file without the file extension
-    output_key = os.path.splitext(template_file)[0]
-    return LLMChain(
-        llm=llm,
-        prompt=PromptTemplate(input_variables=input_keys, template=template_content),
-        output_key=output_key,
-        callbacks=[monitor],
-        tags=[output_key],
-    )
+    cycles = []
+    visited = set()
+    path = []
 
+    def visit(key):
+        visited.add(key)
+        path.append(key)
+        for upstream in graph.get(key, []):
+            if upstream in path:
+                cycles.append(path[path.index(upstream) :] + [upstream])
+            elif upstream not in visited:
+                visit(upstream)
+        path.pop()
 
-def build_chain(
-    api_key,
+    for key in graph:
+        if key not in visited:
+            visit(key)
+    return cycles
+
+
+def validate_templates(
     chains_config,
     prompt_templates_dir,
     common_prefix_file,
-    verbose=False,
-    model_name="gpt-3.5-turbo-16k",
-    temperature=0.7,
+    output_template_file=OUTPUT_TEMPLATE_FILE,
 ):
     """
-    Build and return a SequentialChain by running several LLMChains in sequence.
+    Check the templates of a chain configuration before any of them is run.
+
+    Every variable of a template must be an external input (the seed) or the
+    output of an earlier template, the templates must not depend on each other
+    in a cycle, and every output must be used by the output template or by
+    another template, since generating it would otherwise be wasted.
 
     Parameters:
-    - api_key (str): The API key to access the language model.
-    - chains_config (list): A list of dictionaries, each containing configuration for a chain (e.g., template file).
+    - chains_config (list): The "chains" section of the configuration.
     - prompt_templates_dir (str): Directory path containing prompt template files.
-    - common_prefix_file (str): Name of the file containing common prefix content to be appended before the template.
-    - verbose (bool, optional): If True, prints verbose output. Defaults to False.
-    - model_name (str, optional): The name of the language model to be used. Defaults to "gpt-3.5-turbo-16k".
-    - temperature (float, optional): The temperature parameter for the language model. Defaults to 0.7.
+    - common_prefix_file (str): Name of the file containing common prefix content.
+    - output_template_file (str, optional): Name of the template of the report.
 
     Returns:
-    - SequentialChain: An instance of SequentialChain configured with the chains created from chains_config.
+    - list: A description of every problem found, empty if the templates are valid.
     """
+    registry = get_template_registry(prompt_templates_dir, common_prefix_file)
+    problems = []
 
-    # Initialize ChatOpenAI
-    llm = ChatOpenAI(openai_api_key=api_key, model=model_name, temperature=temperature)
+    # Map each output key to its template file and variables, in chain order
+    templates = {}
+    for chain_config in chains_config:
+        template_file = chain_config["template_file"]
+        try:
+            variables = registry.prompt(template_file).variables
+        except OSError as e:
+            problems.append(f"Cannot read {template_file}: {e}")
+            continue
+        templates[os.path.splitext(template_file)[0]] = (template_file, variables)
+    try:
+        output_variables = registry.get(output_template_file).variables
+    except OSError as e:
+        problems.append(f"Cannot read {output_template_file}: {e}")
+        output_variables = None
 
-    # Chains created using the create_llm_chain function
-    chains = [
-        create_llm_chain(
-            llm, chain_config["template_file"], prompt_templates_dir, common_prefix_file
-        )
-        for chain_config in chains_config
-    ]
+    for template_file, variables in [*templates.values()] + [
+        (output_template_file, output_variables or [])
+    ]:
+        for variable in variables:
+            if variable not in templates and variable not in EXTERNAL_INPUTS:
+                problems.append(
+                    f"{template_file} uses {{{variable}}}, which no template produces"
+                )
 
-    # Calculate input_variables and output_variables
-    input_variables = extract_variable_names(
-        read_prompt_template(
-            chains_config[0]["template_file"], prompt_templates_dir, common_prefix_file
-        )
-    )
-    output_variables = [
-        os.path.splitext(chain_config["template_file"])[0]
+    graph = {
+        key: [variable for variable in variables if variable in templates]
+        for key, (_, variables) in templates.items()
+    }
+    cycles = find_cycles(graph)
+    for cycle in cycles:
+        problems.append(f"Templates depend on each other: {' -> '.join(cycle)}")
+    if not cycles:
+        # The chains run in order, so each one can only use earlier outputs
+        order = list(templates)
+        for key, upstream_keys in graph.items():
+            for upstream in upstream_keys:
+                if order.index(upstream) > order.index(key):
+                    problems.append(
+                        f"{templates[key][0]} uses {{{upstream}}}, which is "
+                        f"produced by the later {templates[upstream][0]}"
+                    )
+
+    if output_variables is not None:
+        used = set(output_variables).union(*graph.values())
+        for key, (template_file, _) in templates.items():
+            if key not in used:
+                problems.append(
+                    f"The output of {template_file} is not used by "
+                    f"{output_template_file} or any other template"
+                )
+
+    return problems
+
+
+def validate_variants(
+    chains_config, shared_stages, variants, prompt_templates_dir, common_prefix_file
+):
+    """
+    Check the variant settings of a chain configuration.
+
+    The shared stages run once for all variants, so they may only depend on
+    other shared stages, and at least one stage must be left to the variants.
+
+    Parameters:
+    - chains_config (list): The "chains" section of the configuration.
+    - shared_stages (list): The names of the stages run once for all variants.
+    - variants (list): The variant settings, each with a unique "name".
+    - prompt_templates_dir (str): Directory path containing prompt template files.
+    - common_prefix_file (str): Name of the file containing common prefix content.
+
+    Returns:
+    - list: A description of every problem found, empty if the variants are valid.
+    """
+    registry = get_template_registry(prompt_templates_dir, common_prefix_file)
+    stages = {
+        os.path.splitext(chain_config["template_file"])[0]: chain_config
         for chain_config in chains_config
-    ]
+    }
+    problems = []
 
-    # Sequential chain
-    sequential_chain = SequentialChain(
-        chains=chains,
-        input_variables=input_variables,
-        output_variables=output_variables,
-        verbose=verbose,
+    if not variants:
+        problems.append("No variants are configured")
+    names = [variant.get("name") for variant in variants]
+    if None in names or len(set(names)) < len(names):
+        problems.append("Every variant needs a unique name")
+
+    for stage in shared_stages:
+        if stage not in stages:
+            problems.append(f"The shared stage {stage} is not one of the chains")
+            continue
+        variables = registry.prompt(stages[stage]["template_file"]).variables
+        for variable in variables:
+            if variable in stages and variable not in shared_stages:
+                problems.append(
+                    f"The shared stage {stage} uses {{{variable}}}, "
+                    "which is generated per variant"
+                )
+    if not set(stages) - set(shared_stages):
+        problems.append("Every stage is shared, so the variants would not differ")
+
+    return problems
+
+
+def variant_label(variant, model_name, temperature, chains_config=(), shared_stages=()):
+    """
+    Return the label of a variant in reports, e.g. "creative (gpt-4, temperature 1.0)".
+
+    The stages of the variant setting their own model_name are listed with it,
+    e.g. "focused (gpt-3.5-turbo-16k, risks: gpt-4, temperature 0.3)", unless
+    the variant sets a model_name, which takes precedence over theirs.
+    """
+    models = [variant.get("model_name", model_name)]
+    if "model_name" not in variant:
+        models += [
+            f"{os.path.splitext(chain_config['template_file'])[0]}: "
+            f"{chain_config['model_name']}"
+            for chain_config in chains_config
+            if "model_name" in chain_config
+            and os.path.splitext(chain_config["template_file"])[0] not in shared_stages
+        ]
+    return (
+        f"{variant['name']} ({', '.join(models)}, "
+        f"temperature {variant.get('temperature', temperature)})"
     )
 
-    return sequential_chain
+
+def combine_variant_outputs(variant_outputs):
+    """
+    Combine the outputs of several variants into the sections of one report.
+
+    Sections that are the same for every variant (the seed and the shared
+    stages) appear once; the others list the output of each variant in turn.
+
+    Parameters:
+    - variant_outputs (dict): The output of the chain for each variant label.
+
+    Returns:
+    - dict: The text of every section, to fill in the output template.
+    """
+    sections = {}
+    for key in next(iter(variant_outputs.values())):
+        outputs = [output[key] for output in variant_outputs.values()]
+        if all(output == outputs[0] for output in outputs):
+            sections[key] = outputs[0]
+        else:
+            sections[key] = "\n\n".join(
+                f"---\n\n**Variant: {label}**\n\n{output[key]}"
+                for label, output in variant_outputs.items()
+            )
+    return sections
+
+
+def build_dependency_graph(chains):
+    """
+    Map each chain's output key to the output keys of the chains it depends on.
+
+    Parameters:
+    - chains (list): The chains to analyse. Input keys that no chain produces
+      (such as "seed") are external inputs and are not part of the graph.
+
+    Returns:
+    - dict: A mapping of output key to the list of upstream output keys.
+    """
+    produced = {key for chain in chains for key in chain.output_keys}
+    return {
+        output_key: [key for key in chain.input_keys if key in produced]
+        for chain in chains
+        for output_key in chain.output_keys
+    }
 
 
-class CallbackHandler(BaseCallbackHandler):
+class ResponseCache:
     """
-    Custom callback handler class for monitoring the progress of the chains.
+    On-disk cache of stage outputs, keyed on a hash of the rendered prompt and
+    the language model parameters.
 
-    This class is a subclass of BaseCallbackHandler and is used to output
-    progress information when a chain starts executing.
+    Each entry is a small JSON file in the cache directory. Entries older than
+    max_age are ignored and removed, and the least recently used entries are
+    evicted once the directory grows beyond max_size.
 
     Attributes:
-        None
+        cache_dir (str): Directory holding the cache entries.
+        max_size (int): Maximum total size of the entries in bytes.
+        max_age (float): Maximum age of an entry in seconds.
     """
 
-    def on_chain_start(
-        self, serialized: Dict[str, Any], inputs: Dict[str, Any], **kwargs: Any
-    ) -> Any:
+    def __init__(self, cache_dir, max_size, max_age):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.max_age = max_age
+
+    @staticmethod
+    def make_key(prompt, llm_params):
         """
-        Callback function that is executed when a chain starts.
+        Return the cache key for a rendered prompt and language model parameters.
 
         Parameters:
-        - serialized (dict): The serialized chain information.
-        - inputs (dict): The inputs passed to the chain.
-        - kwargs (dict): Additional keyword arguments containing tags.
+        - prompt (str): The fully rendered prompt.
+        - llm_params (dict): The parameters identifying the language model.
 
         Returns:
-        - None
+        - str: A hex digest identifying the request.
+        """
+        params = {
+            k: v for k, v in llm_params.items() if k not in NON_SEMANTIC_LLM_PARAMS
+        }
+        payload = json.dumps([prompt, params], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key):
+        """
+        Return the cached output for a key, or None if it is missing or expired.
+        """
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age:
+                os.remove(path)
+                return None
+            with open(path, "r") as f:
+                output = json.load(f)["output"]
+        except (OSError, ValueError, KeyError):
+            return None
+        # Refresh the modification time so eviction is least recently used
+        os.utime(path)
+        return output
+
+    def put(self, key, output):
+        """
+        Store the output for a key and evict old entries if needed.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"output": output}, f)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        """
+        Remove expired entries, then the least recently used entries until the
+        cache fits within max_size.
         """
-        click.secho(f"Running chain '{''.join(kwargs['tags'])}'", fg="cyan")
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
 
+        now = time.time()
+        total_size = 0
+        for mtime, size, path in sorted(entries, reverse=True):
+            total_size += size
+            if now - mtime > self.max_age or total_size > self.max_size:
+                with contextlib.suppress(OSError):
+                    os.remove(path)
 
-def generate_report(output_file, markdown, **chain_output_dict):
+
+def build_response_cache(cache_config):
     """
-    Generates a report by converting chain output to markdown and then to PDF.
+    Create a ResponseCache from the "cache" section of the configuration.
 
     Parameters:
-    - output_file (str): The base name of the output file.
-    - markdown (bool): If True, saves the markdown content to a file.
-    - chain_output_dict (dict): Dictionary containing the output of the chains.
+    - cache_config (dict): Optional "dir", "max_size_mb" and "max_age_days" keys.
 
     Returns:
-    - tuple: The names of the created markdown and PDF files.
+    - ResponseCache: The configured cache.
     """
-    output_template = read_template(OUTPUT_TEMPLATE_FILE)
-    markdown_output = output_template.format(**chain_output_dict)
-    file_name = output_file or f"output-{datetime.now().strftime('%Y-%m-%d-%H-%M-%S')}"
-    markdown_file_name = f"{file_name}.md"
-    pdf_file_name = f"{file_name}.pdf"
+    return ResponseCache(
+        cache_config.get("dir", DEFAULT_CACHE_DIR),
+        max_size=cache_config.get("max_size_mb", DEFAULT_CACHE_MAX_SIZE_MB)
+        * 1024
+        * 1024,
+        max_age=cache_config.get("max_age_days", DEFAULT_CACHE_MAX_AGE_DAYS)
+        * 24
+        * 60
+        * 60,
+    )
 
-    # Save markdown content to file
-    if markdown:
-        with open(markdown_file_name, "w") as f:
-            f.write(markdown_output)
 
-    # Convert the markdown file to PDF
-    md2pdf(pdf_file_name, md_content=markdown_output)
+@functools.lru_cache(maxsize=None)
+def load_tokenizer(tokenizer_name):
+    """
+    Load a Hugging Face tokenizer used to count prompt tokens locally.
+
+    Parameters:
+    - tokenizer_name (str): The name or path of the tokenizer, e.g. "gpt2".
+
+    Returns:
+    - PreTrainedTokenizer: The tokenizer, or None if it cannot be loaded.
+    """
+    try:
+        from transformers import AutoTokenizer
+
+        tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+    except Exception as e:
+        click.secho(
+            f"Could not load tokenizer '{tokenizer_name}', estimating tokens: {e}",
+            fg="yellow",
+        )
+        return None
+    # Only used for counting, so texts longer than the model's context are fine
+    tokenizer.model_max_length = int(1e30)
+    return tokenizer
 
-    # Return the names of the created files
-    return markdown_file_name, pdf_file_name
 
+_tokenizer_lock = threading.Lock()
 
-def report_results(markdown, markdown_file_name, pdf_file_name, cb, duration):
+
+def count_tokens(text, tokenizer_name=DEFAULT_TOKENIZER):
     """
-    Reports the results of the report generation including file names,
-    total tokens, cost, and runtime.
+    Count the tokens of a text.
 
     Parameters:
-    - markdown (bool): If True, indicates markdown file was created.
-    - markdown_file_name (str): The name of the markdown file.
-    - pdf_file_name (str): The name of the PDF file.
-    - cb (CallbackHandler): The callback handler used during report generation.
-    - duration (float): The total runtime in seconds.
+    - text (str): The text to count.
+    - tokenizer_name (str, optional): The tokenizer to count with. Defaults to "gpt2".
 
     Returns:
-    - None
+    - int: The number of tokens, estimated from the length of the text if the
+      tokenizer is not available.
     """
-    if markdown:
-        click.secho(f"Markdown file created: {markdown_file_name}", fg="green")
-    click.secho(f"PDF file created: {pdf_file_name}", fg="green")
-    click.secho(f"Total tokens: {cb.total_tokens}", fg="yellow")
-    click.secho(f"Total cost: ${cb.total_cost:.2f}", fg="yellow")
-    click.secho(f"Runtime: {duration:.2f} seconds", fg="yellow")
+    # Neither loading transformers nor fast tokenizers are thread-safe
+    with _tokenizer_lock:
+        tokenizer = load_tokenizer(tokenizer_name)
+        if tokenizer is None:
+            return -(-len(text) // CHARS_PER_TOKEN)
+        return len(tokenizer.encode(text, add_special_tokens=False))
 
 
-def check_api_key():
+@functools.lru_cache(maxsize=None)
+def load_embedding_model(model_name):
     """
-    Checks if the OPENAI_API_KEY environment variable is set.
+    Load a Hugging Face model used to embed seeds locally.
 
-    Returns:
-    - str: The API key if it is set.
+    Parameters:
+    - model_name (str): The name or path of the model.
 
-    Raises:
-    - SystemExit: If the OPENAI_API_KEY environment variable is not set.
+    Returns:
+    - tuple: The tokenizer and the model, or None if they cannot be loaded.
     """
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        click.secho("Error: OPENAI_API_KEY environment variable is not set.", fg="red")
+    try:
+        from transformers import AutoModel, AutoTokenizer
+
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        model = AutoModel.from_pretrained(model_name)
+    except Exception as e:
         click.secho(
-            "Please set it by running: export OPENAI_API_KEY=your_api_key", fg="red"
+            f"Could not load embedding model '{model_name}', "
+            f"comparing seeds by their words: {e}",
+            fg="yellow",
         )
-        exit(1)
-    return api_key
+        return None
+    model.eval()
+    return tokenizer, model
 
 
-def read_seed(seed_file):
+def hashed_embedding(text):
     """
-    Reads the content of a seed file or displays an example input if no file is provided.
+    Embed a text as signed hashes of its words and character trigrams.
 
     Parameters:
-    - seed_file (str): The name of the seed file.
+    - text (str): The normalized text.
 
     Returns:
-    - str: The contents of the seed file.
+    - numpy.ndarray: The embedding, of HASHED_EMBEDDING_SIZE dimensions.
     """
-    if seed_file is None:
-        click.secho(f"{read_template(EXAMPLE_INPUT_FILE)}", fg="white")
-        exit(0)
-    else:
-        click.secho(f"Using seed file: {seed_file}", fg="green")
-        with open(seed_file, "r") as f:
-            return f.read()
+    import numpy as np
 
+    vector = np.zeros(HASHED_EMBEDDING_SIZE, dtype=np.float32)
+    features = text.split() + [text[i : i + 3] for i in range(len(text) - 2)]
+    for feature in features:
+        digest = hashlib.md5(feature.encode("utf-8")).digest()
+        index = int.from_bytes(digest[:4], "little") % HASHED_EMBEDDING_SIZE
+        vector[index] += 1.0 if digest[4] & 1 else -1.0
+    return vector
 
-@contextlib.contextmanager
-def measure_time():
+
+_embedding_lock = threading.Lock()
+
+
+def embed_seed(seed, model_name=DEFAULT_EMBEDDING_MODEL):
     """
-    Context manager for measuring the execution time of a code block.
+    Embed a seed for comparing it with other seeds.
 
-    Yields:
-    - function: A function that when called, returns the elapsed time in seconds.
+    Whitespace and casing are normalized first, so seeds only differing in
+    them have the same embedding. Seeds longer than the model's maximum input
+    are embedded in chunks, so their whole text is compared.
+
+    Parameters:
+    - seed (str): The contents of the seed file.
+    - model_name (str, optional): The embedding model.
+
+    Returns:
+    - tuple: The name of the embedder ("hashed" if the model is not
+      available) and the normalized embedding.
     """
-    start_time = time.time()
-    yield lambda: time.time() - start_time
+    import numpy as np
 
+    text = " ".join(seed.lower().split())
+    with _embedding_lock:
+        embedding_model = load_embedding_model(model_name)
+        if embedding_model is None:
+            embedder, vector = "hashed", hashed_embedding(text)
+        else:
+            import torch
 
-@click.command()
-@click.option("--seed-file", default=None, help="Path to the seed file.")
-@click.option(
-    "--output-file", default=None, help="Specify the name of the output file."
-)
-@click.option(
-    "--markdown", is_flag=True, default=False, help="Save output as markdown."
-)
-@click.option("--verbose", is_flag=True, default=False, help="Enable verbose output.")
-@click.option(
-    "--config-file", default="config.yaml", help="Path to the configuration file."
-)
-@click.option("--temperature", default=None, type=float, help="Set the temperature.")
-@click.option("--model-name", default=None, type=str, help="Set the model name.")
-def main(
-    seed_file, output_file, markdown, verbose, config_file, temperature, model_name
-):
-    """Generate a business model from a hunch file."""
+            tokenizer, model = embedding_model
+            # Long seeds are split into chunks the model can read at once
+            tokens = tokenizer(
+                text,
+                truncation=True,
+                padding=True,
+                return_overflowing_tokens=True,
+                return_tensors="pt",
+            )
+            tokens.pop("overflow_to_sample_mapping", None)
+            with torch.no_grad():
+                hidden = model(**tokens).last_hidden_state
+            # Mean of the token embeddings of all chunks
+            mask = tokens["attention_mask"].unsqueeze(-1)
+            embedder = model_name
+            vector = ((hidden * mask).sum((0, 1)) / mask.sum()).numpy()
+    norm = np.linalg.norm(vector)
+    return embedder, (vector / norm if norm else vector).astype(np.float32)
 
-    # Check API Key
-    api_key = check_api_key()
 
-    # Read seed file
-    seed = read_seed(seed_file)
+class SeedCache:
+    """
+    On-disk index of the seeds of earlier reports, used to reuse their outputs
+    for near-duplicate seeds.
 
-    # Load the configuration from the specified configuration file
-    chain_config = load_chain_config(config_file)
+    Seeds are embedded locally and compared by cosine similarity. The vectors
+    are kept in one float32 matrix ("vectors.npy") with the entries in
+    "index.json", and the outputs of each entry in its own JSON file. A seed at
+    least report_similarity similar to an earlier one reuses its whole report;
+    one at least canvas_similarity similar only reuses its canvas. Every entry
+    records the fingerprint of the chain that generated it (see
+    chain_fingerprint), and is only reused by runs of a chain with the same
+    fingerprint: the same templates, models and settings.
 
-    # Override temperature and model_name if provided
-    temperature = temperature or chain_config.get("temperature", DEFAULT_TEMPERATURE)
-    model_name = model_name or chain_config.get("model_name", DEFAULT_MODEL_NAME)
+    Attributes:
+        cache_dir (str): Directory holding the index.
+        model_name (str): The embedding model.
+        report_similarity (float): Similarity from which the report is reused.
+        canvas_similarity (float): Similarity from which the canvas is reused.
+        max_entries (int): Maximum number of seeds kept; the oldest are dropped.
+    """
 
-    # Get prompt_templates_dir and common_prefix_file from config or set defaults
-    prompt_templates_dir = chain_config.get(
-        "prompt_templates_dir", PROMPT_TEMPLATES_DIR
-    )
-    common_prefix_file = chain_config.get("common_prefix_file", COMMON_PREFIX_FILE)
+    def __init__(
+        self,
+        cache_dir,
+        model_name=DEFAULT_EMBEDDING_MODEL,
+        report_similarity=DEFAULT_REPORT_SIMILARITY,
+        canvas_similarity=DEFAULT_CANVAS_SIMILARITY,
+        max_entries=DEFAULT_SEED_CACHE_MAX_ENTRIES,
+    ):
+        self.cache_dir = cache_dir
+        self.model_name = model_name
+        self.report_similarity = report_similarity
+        self.canvas_similarity = canvas_similarity
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
 
-    with measure_time() as duration, get_openai_callback() as cb:
-        # Build and execute chain
-        chain = build_chain(
-            api_key,
-            chain_config["chains"],
-            prompt_templates_dir,
-            common_prefix_file,
-            verbose=verbose,
-            model_name=model_name,
-            temperature=temperature,
-        )
-        output = chain({"seed": seed})
+    def _path(self, name):
+        return os.path.join(self.cache_dir, name)
+
+    def _load(self):
+        import numpy as np
+
+        try:
+            with open(self._path("index.json")) as f:
+                entries = json.load(f)["entries"]
+            vectors = np.load(self._path("vectors.npy"))
+        except (OSError, ValueError, KeyError):
+            return [], None
+        # An interrupted update may have written one file but not the other
+        count = min(len(entries), len(vectors))
+        return entries[:count], vectors[:count]
+
+    def lookup(self, seed, fingerprint=None):
+        """
+        Find the most similar earlier seed and the outputs to reuse from it.
+
+        Parameters:
+        - seed (str): The contents of the seed file.
+        - fingerprint (str, optional): The fingerprint of the chain the outputs
+          are for; only the seeds added with the same one are considered.
+
+        Returns:
+        - dict: The "similarity" of the earlier seed and the "outputs" to
+          reuse, or None if no earlier seed is similar enough.
+        """
+        embedder, vector = embed_seed(seed, self.model_name)
+        with self._lock:
+            entries, vectors = self._load()
+        candidates = [
+            i
+            for i, entry in enumerate(entries)
+            if entry["embedder"] == embedder and entry.get("fingerprint") == fingerprint
+        ]
+        if not candidates:
+            return None
+        similarities = vectors[candidates] @ vector
+        best = int(similarities.argmax())
+        similarity = float(similarities[best])
+        if similarity < self.canvas_similarity:
+            return None
+        try:
+            with open(self._path(f"{entries[candidates[best]]['id']}.json")) as f:
+                outputs = json.load(f)["outputs"]
+        except (OSError, ValueError, KeyError):
+            return None
+        if similarity < self.report_similarity:
+            outputs = {key: outputs[key] for key in ["canvas"] if key in outputs}
+        return {"similarity": similarity, "outputs": outputs}
+
+    def add(self, seed, outputs, fingerprint=None):
+        """
+        Add the outputs generated for a seed to the index.
+
+        Parameters:
+        - seed (str): The contents of the seed file.
+        - outputs (dict): The outputs of the chain; the seed itself is left out.
+        - fingerprint (str, optional): The fingerprint of the chain that
+          generated them.
+
+        Returns:
+        - None
+        """
+        import numpy as np
 
-        # Generate report
-        markdown_file_name, pdf_file_name = generate_report(
-            output_file, markdown, **output
+        embedder, vector = embed_seed(seed, self.model_name)
+        entry_id = uuid.uuid4().hex
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._write(
+            f"{entry_id}.json",
+            lambda f: json.dump(
+                {
+                    "outputs": {
+                        k: resolve_output(v) for k, v in outputs.items() if k != "seed"
+                    }
+                },
+                f,
+            ),
         )
+        with self._lock:
+            entries, vectors = self._load()
+            entries.append(
+                {"id": entry_id, "embedder": embedder, "fingerprint": fingerprint}
+            )
+            vectors = (
+                vector[None]
+                if vectors is None
+                else np.concatenate([vectors, vector[None]])
+            )
+            dropped = entries[: -self.max_entries]
+            entries, vectors = (
+                entries[-self.max_entries :],
+                vectors[-self.max_entries :],
+            )
+            # Write the vectors first, as entries without a vector are ignored
+            self._write("vectors.npy", lambda f: np.save(f, vectors), "wb")
+            self._write("index.json", lambda f: json.dump({"entries": entries}, f))
+        for entry in dropped:
+            with contextlib.suppress(OSError):
+                os.remove(self._path(f"{entry['id']}.json"))
 
-        # Reporting on result.
-        report_results(markdown, markdown_file_name, pdf_file_name, cb, duration())
+    def _write(self, name, write, mode="w"):
+        path = self._path(name)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, mode) as f:
+            write(f)
+        os.replace(tmp_path, path)
+
+
+def build_seed_cache(seed_cache_config):
+    """
+    Create a SeedCache from the "seed_cache" section of the configuration.
+
+    Parameters:
+    - seed_cache_config (dict): Optional "dir", "model", "report_similarity",
+      "canvas_similarity" and "max_entries" keys.
+
+    Returns:
+    - SeedCache: The configured cache.
+    """
+    return SeedCache(
+        seed_cache_config.get("dir", DEFAULT_SEED_CACHE_DIR),
+        model_name=seed_cache_config.get("model", DEFAULT_EMBEDDING_MODEL),
+        report_similarity=seed_cache_config.get(
+            "report_similarity", DEFAULT_REPORT_SIMILARITY
+        ),
+        canvas_similarity=seed_cache_config.get(
+            "canvas_similarity", DEFAULT_CANVAS_SIMILARITY
+        ),
+        max_entries=seed_cache_config.get(
+            "max_entries", DEFAULT_SEED_CACHE_MAX_ENTRIES
+        ),
+    )
+
+
+def describe_seed_match(seed_match):
+    """
+    Describe what was reused from a similar seed, e.g. for report_results.
+
+    Parameters:
+    - seed_match (dict): The match returned by SeedCache.lookup.
+
+    Returns:
+    - str: The description.
+    """
+    return (
+        f"Reused {', '.join(seed_match['outputs'])} from a similar earlier seed "
+        f"(similarity {seed_match['similarity']:.2f})"
+    )
+
+
+def first_sentence(line):
+    """
+    Shorten a line of markdown to its first sentence.
+
+    Headings and table rows are kept whole, and list markers are preserved.
+
+    Parameters:
+    - line (str): The line to shorten.
+
+    Returns:
+    - str: The first sentence of the line.
+    """
+    if line.lstrip().startswith(("#", "|")):
+        return line
+    match = re.match(r"\s*(?:[-*+]|\d+\.)?\s*.*?[.!?](?=\s|$)", line)
+    return match.group(0) if match else line
+
+
+def compact_text(text, max_tokens, count=count_tokens):
+    """
+    Shorten a text to fit within a number of tokens.
+
+    The text is first summarized extractively, keeping its headings, table rows
+    and the first sentence of every other line. If that is not enough, it is
+    truncated after the last whole line that fits.
+
+    Parameters:
+    - text (str): The text to shorten.
+    - max_tokens (int): The maximum number of tokens of the result.
+    - count (callable, optional): Function returning the number of tokens of a text.
+
+    Returns:
+    - str: The text, shortened if needed.
+    """
+    if count(text) <= max_tokens:
+        return text
+    text = "\n".join(first_sentence(line) for line in text.splitlines())
+    if count(text) <= max_tokens:
+        return text
+
+    # Find the longest prefix that fits alongside the truncation marker
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count(text[:middle] + TRUNCATION_MARKER) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    if low == 0:
+        return ""
+    truncated = text[:low]
+    if "\n" in truncated:
+        truncated = truncated[: truncated.rindex("\n")]
+    return truncated + TRUNCATION_MARKER
+
+
+def compact_inputs(prompt, inputs, max_tokens, count=count_tokens):
+    """
+    Shorten the inputs of a prompt so the rendered prompt fits a token budget.
+
+    The tokens left after the template itself are shared evenly between the
+    inputs; inputs smaller than their share are kept whole and their unused
+    tokens go to the larger ones.
+
+    Parameters:
+    - prompt (PromptTemplate): The prompt the inputs are rendered into.
+    - inputs (dict): The values of the prompt's input variables.
+    - max_tokens (int): The maximum number of tokens of the rendered prompt.
+    - count (callable, optional): Function returning the number of tokens of a text.
+
+    Returns:
+    - dict: The inputs, with the oversized ones compacted.
+    """
+    variables = prompt.input_variables
+    available = max_tokens - count(prompt.format(**{key: "" for key in variables}))
+    sizes = {key: count(inputs[key]) for key in variables}
+    compacted = dict(inputs)
+    remaining = sorted(variables, key=sizes.get)
+    while remaining:
+        share = max(available, 0) // len(remaining)
+        key = remaining.pop(0)
+        if sizes[key] > share:
+            compacted[key] = compact_text(inputs[key], share, count)
+        available -= count(compacted[key])
+    return compacted
+
+
+class SeedPreprocessor:
+    """
+    Cleans up seeds before they are sent to the language model.
+
+    Seeds are normalized to NFKC with plain spaces and newlines, HTML comments
+    and lines matching the strip_patterns are removed, and so are headings
+    whose sections are empty, such as the unanswered questions of
+    examples/template.md. Runs of spaces and blank lines are collapsed. A seed
+    that is empty once cleaned is rejected; one over max_tokens is compressed
+    with compact_text or rejected.
+
+    Attributes:
+        max_tokens (int): The maximum number of tokens of a seed, or None.
+        oversize (str): "compress" or "reject" a seed over max_tokens.
+        strip_patterns (list): Regular expressions of boilerplate lines to remove.
+        tokenizer (str): The name of the tokenizer counting the tokens.
+    """
+
+    def __init__(
+        self,
+        max_tokens=DEFAULT_SEED_MAX_TOKENS,
+        oversize="compress",
+        strip_patterns=(),
+        tokenizer=DEFAULT_TOKENIZER,
+    ):
+        if oversize not in SEED_OVERSIZE_ACTIONS:
+            raise ValueError(
+                f"oversize must be one of {', '.join(SEED_OVERSIZE_ACTIONS)}"
+            )
+        self.max_tokens = max_tokens
+        self.oversize = oversize
+        self.strip_patterns = [re.compile(pattern) for pattern in strip_patterns]
+        self.tokenizer = tokenizer
+
+    def normalize(self, seed):
+        """
+        Return the seed with normalized whitespace and without boilerplate.
+
+        Parameters:
+        - seed (str): The seed.
+
+        Returns:
+        - str: The cleaned up seed, possibly empty.
+        """
+        seed = unicodedata.normalize("NFKC", seed)
+        seed = seed.replace("\r\n", "\n").replace("\r", "\n")
+        seed = re.sub(r"[\u200b\u200c\u200d\ufeff]", "", seed)
+        seed = re.sub(r"<!--.*?-->", "", seed, flags=re.DOTALL)
+        lines = []
+        for line in seed.split("\n"):
+            if any(pattern.search(line) for pattern in self.strip_patterns):
+                continue
+            text = re.sub(r"[ \t]+", " ", line.strip())
+            indent = re.match(r"[ \t]*", line).group(0).replace("\t", "    ")
+            lines.append(indent + text if text else "")
+        lines = remove_empty_sections(lines)
+        return re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+
+    def process(self, seed):
+        """
+        Clean up a seed and check its size.
+
+        Parameters:
+        - seed (str): The seed.
+
+        Returns:
+        - str: The seed to send to the language model.
+
+        Raises:
+        - ValueError: If the seed is empty, or over max_tokens and oversize is "reject".
+        """
+        seed = self.normalize(seed)
+        if not seed:
+            raise ValueError("The seed is empty once its empty sections are removed")
+        # A token is at least one character, so short seeds need not be counted
+        if self.max_tokens is None or len(seed) <= self.max_tokens:
+            return seed
+        count = functools.partial(count_tokens, tokenizer_name=self.tokenizer)
+        tokens = count(seed)
+        if tokens <= self.max_tokens:
+            return seed
+        if self.oversize == "reject":
+            raise ValueError(
+                f"The seed has {tokens} tokens, more than the maximum of "
+                f"{self.max_tokens}"
+            )
+        return compact_text(seed, self.max_tokens, count)
+
+
+def remove_empty_sections(lines):
+    """
+    Remove the markdown headings that have no content before the next heading
+    of the same or a higher level.
+
+    Parameters:
+    - lines (list): The lines of the markdown text.
+
+    Returns:
+    - list: The lines without the empty headings.
+    """
+    kept = []
+    # The level of the next heading, and whether there is content before it
+    next_level, content = 0, False
+    for line in reversed(lines):
+        heading = re.match(r"(#{1,6})\s", line)
+        if heading:
+            level = len(heading.group(1))
+            if not content and (next_level == 0 or next_level <= level):
+                continue
+            next_level, content = level, False
+        elif line.strip():
+            content = True
+        kept.append(line)
+    return kept[::-1]
+
+
+def build_seed_preprocessor(preprocessing_config, tokenizer=DEFAULT_TOKENIZER):
+    """
+    Create the SeedPreprocessor configured in the "seed_preprocessing" section of
+    the configuration file.
+
+    Parameters:
+    - preprocessing_config (dict): Optional "enabled", "max_tokens", "oversize"
+      and "strip_patterns" keys.
+    - tokenizer (str, optional): The tokenizer counting the tokens of the seeds.
+
+    Returns:
+    - SeedPreprocessor: The preprocessor, or None if preprocessing is disabled.
+    """
+    if not preprocessing_config.get("enabled", True):
+        return None
+    return SeedPreprocessor(
+        max_tokens=preprocessing_config.get("max_tokens", DEFAULT_SEED_MAX_TOKENS),
+        oversize=preprocessing_config.get("oversize", "compress"),
+        strip_patterns=preprocessing_config.get("strip_patterns", []),
+        tokenizer=tokenizer,
+    )
+
+
+def read_seeds(seed_files, preprocessor=None):
+    """
+    Read and preprocess the seed files of a batch.
+
+    Parameters:
+    - seed_files (list): The paths of the seed files.
+    - preprocessor (SeedPreprocessor, optional): Cleans up the seeds.
+
+    Returns:
+    - tuple: The list of seeds and the list of errors, with None in place of the
+      seed or error of each seed file.
+    """
+    seeds, errors = [], []
+    for seed_file in seed_files:
+        try:
+            seed = read_seed(seed_file)
+            seeds.append(preprocessor.process(seed) if preprocessor else seed)
+            errors.append(None)
+        except Exception as e:
+            seeds.append(None)
+            errors.append(str(e) or e.__class__.__name__)
+    return seeds, errors
+
+
+def find_duplicate_seeds(seeds):
+    """
+    Find the seeds that are the same as an earlier seed of a batch.
+
+    Parameters:
+    - seeds (list): The seeds of the batch; None for seeds that could not be read.
+
+    Returns:
+    - dict: The index of the first seed with the same contents, keyed by the
+      index of each duplicate.
+    """
+    first = {}
+    duplicates = {}
+    for i, seed in enumerate(seeds):
+        if seed is None:
+            continue
+        if seed in first:
+            duplicates[i] = first[seed]
+        else:
+            first[seed] = i
+    return duplicates
+
+
+def copy_duplicate_reports(results, duplicates, output_files):
+    """
+    Give each duplicate seed of a batch a copy of the report of its original.
+
+    Parameters:
+    - results (list): The results of the seeds of the batch. The results of the
+      duplicates are updated.
+    - duplicates (dict): The index of the original of each duplicate, as
+      returned by find_duplicate_seeds.
+    - output_files (list): The base name of the report of each seed.
+
+    Returns:
+    - None
+    """
+    for i, original in duplicates.items():
+        result = results[i]
+        result["duplicate_of"] = results[original]["seed_file"]
+        result["error"] = results[original]["error"]
+        for report_format, report_file in results[original]["report_files"].items():
+            copy = f"{output_files[i]}.{report_format}"
+            try:
+                shutil.copyfile(report_file, copy)
+            except OSError as e:
+                result["error"] = str(e) or e.__class__.__name__
+                break
+            result["report_files"][report_format] = copy
+
+
+def load_manifest(manifest_file):
+    """
+    Load a run manifest, or return an empty one if the file does not exist.
+
+    Parameters:
+    - manifest_file (str): The path to the manifest file.
+
+    Returns:
+    - dict: The manifest, with the fingerprint and output of each stage under "stages".
+    """
+    try:
+        with open(manifest_file, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"stages": {}}
+
+
+def save_manifest(manifest_file, manifest):
+    """
+    Atomically write a run manifest.
+
+    Parameters:
+    - manifest_file (str): The path to the manifest file.
+    - manifest (dict): The manifest to write.
+
+    Returns:
+    - None
+    """
+    tmp_file = f"{manifest_file}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_file, manifest_file)
+
+
+class RunCheckpoint:
+    """
+    Checkpoint of a run, saving the output of every stage to the run's
+    directory as soon as the stage finishes, so that an interrupted run can be
+    resumed without paying for those stages again.
+
+    The seed and output file of the run are saved in "run.json", and the output
+    of each stage in "<stage>.json". Every file is written to a temporary file
+    and renamed, so a crash never leaves a partial checkpoint behind.
+
+    Attributes:
+        run_dir (str): The directory of the run.
+    """
+
+    def __init__(self, run_dir):
+        self.run_dir = run_dir
+
+    @property
+    def run_id(self):
+        return os.path.basename(self.run_dir)
+
+    @classmethod
+    def create(cls, runs_dir, seed, output_file):
+        """
+        Create the checkpoint of a new run.
+
+        Parameters:
+        - runs_dir (str): The directory holding the run directories.
+        - seed (str): The contents of the seed file.
+        - output_file (str): The base name of the report.
+
+        Returns:
+        - RunCheckpoint: The checkpoint, with a new run ID.
+        """
+        run_id = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{os.urandom(3).hex()}"
+        checkpoint = cls(os.path.join(runs_dir, run_id))
+        os.makedirs(checkpoint.run_dir)
+        checkpoint._write("run", {"seed": seed, "output_file": output_file})
+        return checkpoint
+
+    def _write(self, name, data):
+        path = os.path.join(self.run_dir, f"{name}.json")
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def save_stage(self, stage, output):
+        """
+        Save the output of a finished stage.
+        """
+        self._write(f"stage-{stage}", {"output": output})
+
+    def load(self):
+        """
+        Load the run and the outputs of the stages that finished.
+
+        Returns:
+        - tuple: The run (with its "seed" and "output_file"), and a dict with
+          the output of each finished stage.
+
+        Raises:
+        - FileNotFoundError: If the run does not exist.
+        """
+        with open(os.path.join(self.run_dir, "run.json")) as f:
+            run = json.load(f)
+        outputs = {}
+        for path in glob.glob(os.path.join(self.run_dir, "stage-*.json")):
+            stage = os.path.basename(path)[len("stage-") : -len(".json")]
+            with open(path) as f:
+                outputs[stage] = json.load(f)["output"]
+        return run, outputs
+
+    def remove(self):
+        """
+        Remove the checkpoint once the run has finished.
+        """
+        shutil.rmtree(self.run_dir, ignore_errors=True)
+
+
+class SpilledOutput:
+    """
+    Handle to a stage output that was written to disk to free its memory.
+
+    Formatting the handle reads the output back, so it can stand in for the
+    text in templates; copy_to streams it to a file instead.
+
+    Attributes:
+        path (str): The file holding the output.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        """
+        Return the output.
+        """
+        with open(self.path, encoding="utf-8") as f:
+            return f.read()
+
+    def copy_to(self, f):
+        """
+        Write the output to an open text file in chunks.
+        """
+        with open(self.path, encoding="utf-8") as source:
+            shutil.copyfileobj(source, f, SPILL_CHUNK_SIZE)
+
+    def __str__(self):
+        return self.read()
+
+    def __format__(self, format_spec):
+        return format(self.read(), format_spec)
+
+    def __repr__(self):
+        return f"SpilledOutput({self.path!r})"
+
+
+class OutputSpill:
+    """
+    Directory the outputs of one run of a chain are spilled to.
+
+    Attributes:
+        run_dir (str): The directory, a new one in spill_dir for every run.
+    """
+
+    def __init__(self, spill_dir=DEFAULT_SPILL_DIR):
+        self.run_dir = os.path.join(spill_dir, uuid.uuid4().hex)
+
+    def write(self, key, text):
+        """
+        Write an output to disk.
+
+        Parameters:
+        - key (str): The output key.
+        - text (str): The output.
+
+        Returns:
+        - SpilledOutput: The handle to the output.
+        """
+        os.makedirs(self.run_dir, exist_ok=True)
+        path = os.path.join(self.run_dir, f"{key}.txt")
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(f"{path}.tmp", path)
+        return SpilledOutput(path)
+
+    def remove(self):
+        """
+        Remove the directory with the outputs it holds.
+        """
+        shutil.rmtree(self.run_dir, ignore_errors=True)
+
+
+def resolve_output(value):
+    """
+    Return the text of an output, reading it back if it was spilled to disk.
+    """
+    return value.read() if isinstance(value, SpilledOutput) else value
+
+
+def discard_spilled(outputs):
+    """
+    Remove the files of the spilled outputs of a run, once they are no longer needed.
+
+    Parameters:
+    - outputs (dict): The outputs of the run; those that are not spilled are ignored.
+
+    Returns:
+    - None
+    """
+    run_dirs = set()
+    for value in outputs.values():
+        if isinstance(value, SpilledOutput):
+            with contextlib.suppress(OSError):
+                os.remove(value.path)
+            run_dirs.add(os.path.dirname(value.path))
+    for run_dir in run_dirs:
+        with contextlib.suppress(OSError):
+            os.rmdir(run_dir)
+
+
+def seed_hash(seed):
+    """
+    Return the hash identifying a seed in the run history.
+
+    Parameters:
+    - seed (str): The contents of the seed file.
+
+    Returns:
+    - str: The SHA-256 hex digest of the seed.
+    """
+    return hashlib.sha256(seed.encode("utf-8")).hexdigest()
+
+
+class RunHistory:
+    """
+    SQLite database recording every run: its seed, settings, the output, tokens,
+    cost and timings of every stage, and its totals.
+
+    Runs are in the "runs" table and their stages in the "stages" table, which
+    are indexed on the columns runs are looked up by, so listing and querying
+    stays fast with tens of thousands of runs. The stage outputs are only read
+    when a single run is shown.
+
+    Attributes:
+        path (str): The path of the database file.
+        config (dict): The configuration recorded with every run.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created TEXT NOT NULL,
+            seed_hash TEXT,
+            seed_file TEXT,
+            seed TEXT,
+            output_file TEXT,
+            model_name TEXT,
+            temperature REAL,
+            backend TEXT,
+            config TEXT,
+            total_tokens INTEGER,
+            total_cost REAL,
+            duration REAL,
+            error TEXT
+        );
+        CREATE TABLE IF NOT EXISTS stages (
+            run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+            stage TEXT NOT NULL,
+            model TEXT,
+            output TEXT,
+            start REAL,
+            duration REAL,
+            time_to_first_token REAL,
+            prompt_tokens INTEGER,
+            completion_tokens INTEGER,
+            total_tokens INTEGER,
+            cost REAL,
+            reused INTEGER,
+            error TEXT
+        );
+        CREATE INDEX IF NOT EXISTS runs_created ON runs (created);
+        CREATE INDEX IF NOT EXISTS runs_seed_hash ON runs (seed_hash, created);
+        CREATE INDEX IF NOT EXISTS runs_model_name ON runs (model_name, created);
+        CREATE INDEX IF NOT EXISTS runs_total_cost ON runs (total_cost);
+        CREATE INDEX IF NOT EXISTS stages_run_id ON stages (run_id);
+        CREATE INDEX IF NOT EXISTS stages_model ON stages (model, run_id);
+    """
+
+    # The columns listed by query; the seed is shortened to its first line
+    SUMMARY_COLUMNS = (
+        "id, created, seed_hash, seed_file, output_file, model_name, temperature, "
+        "backend, total_tokens, total_cost, duration, error"
+    )
+
+    def __init__(self, path, config=None):
+        self.path = path
+        self.config = config or {}
+        self._initialized = False
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.row_factory = sqlite3.Row
+        try:
+            with self._lock:
+                if not self._initialized:
+                    # Let queries read while a batch is recording its runs
+                    connection.execute("PRAGMA journal_mode=WAL")
+                    connection.executescript(self.SCHEMA)
+                    self._initialized = True
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def record(
+        self,
+        seed,
+        outputs,
+        stage_records,
+        seed_file=None,
+        output_file=None,
+        total_tokens=0,
+        total_cost=0.0,
+        duration=0.0,
+        error=None,
+    ):
+        """
+        Record a run.
+
+        Parameters:
+        - seed (str): The contents of the seed file, or None if it could not be read.
+        - outputs (dict): The output of every stage that finished.
+        - stage_records (list): The stage records collected by CallbackHandler.
+        - seed_file (str, optional): The path of the seed file.
+        - output_file (str, optional): The base name of the report files.
+        - total_tokens (int, optional): The tokens used by the run.
+        - total_cost (float, optional): The cost of the run.
+        - duration (float, optional): The runtime of the run in seconds.
+        - error (str, optional): The error the run failed with.
+
+        The model of the run is the one its stages used, all the models they
+        used if they differ, or the configured one if no stage ran.
+
+        Returns:
+        - int: The ID of the recorded run.
+        """
+        models = sorted({record["model"] for record in stage_records} - {None})
+        if models:
+            model_name = ", ".join(models)
+        elif self.config.get("backend") == "mock":
+            model_name = "mock"
+        else:
+            model_name = self.config.get("model_name")
+        with self._connect() as connection:
+            run_id = connection.execute(
+                "INSERT INTO runs (created, seed_hash, seed_file, seed, output_file, "
+                "model_name, temperature, backend, config, total_tokens, total_cost, "
+                "duration, error) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    datetime.now().isoformat(),
+                    None if seed is None else seed_hash(seed),
+                    seed_file,
+                    seed,
+                    output_file,
+                    model_name,
+                    self.config.get("temperature"),
+                    self.config.get("backend"),
+                    json.dumps(self.config, default=str),
+                    total_tokens,
+                    total_cost,
+                    duration,
+                    error,
+                ),
+            ).lastrowid
+            connection.executemany(
+                "INSERT INTO stages (run_id, stage, model, output, start, duration, "
+                "time_to_first_token, prompt_tokens, completion_tokens, total_tokens, "
+                "cost, reused, error) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        run_id,
+                        record["stage"],
+                        record["model"],
+                        None
+                        if record["error"]
+                        else resolve_output(outputs.get(record["stage"])),
+                        record["start"],
+                        record["duration"],
+                        record["time_to_first_token"],
+                        record["prompt_tokens"],
+                        record["completion_tokens"],
+                        record["total_tokens"],
+                        record["cost"],
+                        record["reused"],
+                        record["error"],
+                    )
+                    for record in stage_records
+                ],
+            )
+        return run_id
+
+    def query(
+        self,
+        seed_hash=None,
+        search=None,
+        model_name=None,
+        since=None,
+        min_cost=None,
+        limit=20,
+    ):
+        """
+        List the runs matching all the given criteria, most recent first.
+
+        Parameters:
+        - seed_hash (str, optional): Only runs of the seed with this hash.
+        - search (str, optional): Only runs whose seed contains this text.
+        - model_name (str, optional): Only runs using this model, for the
+          whole run or one of its stages.
+        - since (str, optional): Only runs created on or after this ISO date.
+        - min_cost (float, optional): Only runs costing at least this much.
+        - limit (int, optional): The maximum number of runs to list.
+
+        Returns:
+        - list: A dict with the columns of every run, without the seed,
+          configuration and stage outputs.
+        """
+        conditions, parameters = [], []
+        if seed_hash is not None:
+            conditions.append("seed_hash = ?")
+            parameters.append(seed_hash)
+        if search is not None:
+            conditions.append("instr(lower(seed), lower(?)) > 0")
+            parameters.append(search)
+        if model_name is not None:
+            conditions.append(
+                "id IN (SELECT id FROM runs WHERE model_name = ? "
+                "UNION SELECT run_id FROM stages WHERE model = ?)"
+            )
+            parameters += [model_name, model_name]
+        if since is not None:
+            conditions.append("created >= ?")
+            parameters.append(since)
+        if min_cost is not None:
+            conditions.append("total_cost >= ?")
+            parameters.append(min_cost)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._connect() as connection:
+            rows = connection.execute(
+                f"SELECT {self.SUMMARY_COLUMNS}, substr(seed, 1, 200) AS seed_start "
+                f"FROM runs {where} ORDER BY created DESC, id DESC LIMIT ?",
+                [*parameters, limit],
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def get(self, run_id):
+        """
+        Return a run with its seed, configuration and every stage.
+
+        Parameters:
+        - run_id (int): The ID of the run.
+
+        Returns:
+        - dict: The run, with its stages in "stages", or None if there is no such run.
+        """
+        with self._connect() as connection:
+            run = connection.execute(
+                "SELECT * FROM runs WHERE id = ?", (run_id,)
+            ).fetchone()
+            if run is None:
+                return None
+            stages = connection.execute(
+                "SELECT * FROM stages WHERE run_id = ? ORDER BY start", (run_id,)
+            ).fetchall()
+        run = dict(run)
+        run["config"] = json.loads(run["config"] or "{}")
+        run["stages"] = [dict(stage) for stage in stages]
+        return run
+
+
+def queue_task_id(job, seed_id, stage):
+    """
+    Return the ID of the task running a stage for a seed of a queued job.
+
+    Parameters:
+    - job (str): The ID of the job.
+    - seed_id (str): The ID of the seed within the job.
+    - stage (str): The output key of the stage.
+
+    Returns:
+    - str: The task ID, which is also safe to use as a file name.
+    """
+    return f"{job}-{seed_id}-{stage}"
+
+
+class SQLiteTaskQueue:
+    """
+    Queue of stage tasks shared by a coordinator and any number of workers, in
+    a SQLite database.
+
+    Every task runs one stage for one seed of a job. It is in the "tasks"
+    table, and the "dependencies" table lists the tasks whose outputs it needs;
+    it can only be claimed once they are done. A claimed task is leased to its
+    worker until lease seconds after the last heartbeat. A task whose lease
+    expires, or that fails, is claimed again until it has been attempted
+    max_attempts times; it then fails, and so do the pending tasks of its seed.
+    Every change is made in an immediate transaction, so no two workers claim
+    the same task. SQLite locking needs a local filesystem: use it for workers
+    on one host, and a DirectoryTaskQueue to spread them over several.
+
+    Attributes:
+        path (str): The path of the database file.
+        lease (float): Seconds a task stays leased without a heartbeat.
+        max_attempts (int): The number of times a task is run before it fails.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS tasks (
+            id TEXT PRIMARY KEY,
+            job TEXT NOT NULL,
+            seed_id TEXT NOT NULL,
+            stage TEXT NOT NULL,
+            inputs TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            worker TEXT,
+            lease_expires REAL,
+            output TEXT,
+            error TEXT,
+            records TEXT NOT NULL DEFAULT '[]',
+            created REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS dependencies (
+            task TEXT NOT NULL,
+            upstream TEXT NOT NULL,
+            PRIMARY KEY (task, upstream)
+        );
+        CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, created);
+        CREATE INDEX IF NOT EXISTS tasks_job ON tasks (job, seed_id, status);
+    """
+
+    # Matches a task only while it is leased to the worker that claimed it
+    LEASED = "id = ? AND worker = ? AND attempts = ? AND status = 'running'"
+
+    def __init__(
+        self,
+        path,
+        lease=DEFAULT_QUEUE_LEASE,
+        max_attempts=DEFAULT_QUEUE_MAX_ATTEMPTS,
+    ):
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self._initialized = False
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        try:
+            with self._lock:
+                if not self._initialized:
+                    connection.execute("PRAGMA journal_mode=WAL")
+                    connection.executescript(self.SCHEMA)
+                    self._initialized = True
+            # Take the write lock before reading, so that no other worker can
+            # claim the task read here before this transaction commits
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+        finally:
+            connection.close()
+
+    def add(self, job, seeds, graph):
+        """
+        Queue a task for every stage of every seed of a job.
+
+        Parameters:
+        - job (str): The ID of the job.
+        - seeds (dict): The external inputs (e.g. the "seed") of every seed, by seed ID.
+        - graph (dict): The output keys of the stages the stage of each output
+          key depends on, as built by build_dependency_graph.
+        """
+        now = time.time()
+        with self._connect() as connection:
+            for seed_id, inputs in seeds.items():
+                connection.executemany(
+                    "INSERT INTO tasks (id, job, seed_id, stage, inputs, created) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    [
+                        (
+                            queue_task_id(job, seed_id, stage),
+                            job,
+                            seed_id,
+                            stage,
+                            json.dumps(inputs),
+                            now,
+                        )
+                        for stage in graph
+                    ],
+                )
+                connection.executemany(
+                    "INSERT INTO dependencies (task, upstream) VALUES (?, ?)",
+                    [
+                        (
+                            queue_task_id(job, seed_id, stage),
+                            queue_task_id(job, seed_id, upstream),
+                        )
+                        for stage, upstream_stages in graph.items()
+                        for upstream in upstream_stages
+                    ],
+                )
+
+    def claim(self, worker):
+        """
+        Lease the oldest task whose upstream tasks are done to a worker.
+
+        Parameters:
+        - worker (str): The ID of the worker.
+
+        Returns:
+        - dict: The task's "id", "job", "seed_id", "stage" and "attempts" (this
+          one included), and its "inputs": the external inputs of its seed and
+          the outputs of its upstream tasks. None if no task can be claimed.
+        """
+        now = time.time()
+        with self._connect() as connection:
+            for row in connection.execute(
+                "SELECT * FROM tasks WHERE status = 'running' AND lease_expires < ? "
+                "AND attempts >= ?",
+                (now, self.max_attempts),
+            ).fetchall():
+                self._fail(connection, row, f"The lease of {row['worker']} expired")
+            row = connection.execute(
+                "SELECT * FROM tasks WHERE (status = 'pending' OR "
+                "(status = 'running' AND lease_expires < ?)) AND NOT EXISTS ("
+                "SELECT 1 FROM dependencies JOIN tasks AS upstream "
+                "ON upstream.id = dependencies.upstream "
+                "WHERE dependencies.task = tasks.id AND upstream.status != 'done') "
+                "ORDER BY created, id LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE tasks SET status = 'running', worker = ?, "
+                "attempts = attempts + 1, lease_expires = ? WHERE id = ?",
+                (worker, now + self.lease, row["id"]),
+            )
+            upstream = connection.execute(
+                "SELECT upstream.stage, upstream.output FROM dependencies "
+                "JOIN tasks AS upstream ON upstream.id = dependencies.upstream "
+                "WHERE dependencies.task = ?",
+                (row["id"],),
+            ).fetchall()
+        return {
+            "id": row["id"],
+            "job": row["job"],
+            "seed_id": row["seed_id"],
+            "stage": row["stage"],
+            "attempts": row["attempts"] + 1,
+            "inputs": {
+                **json.loads(row["inputs"]),
+                **{task["stage"]: task["output"] for task in upstream},
+            },
+        }
+
+    def heartbeat(self, task, worker):
+        """
+        Renew the lease of a claimed task.
+
+        Parameters:
+        - task (dict): The task, as returned by claim.
+        - worker (str): The ID of the worker that claimed it.
+
+        Returns:
+        - bool: Whether the task is still leased to the worker.
+        """
+        with self._connect() as connection:
+            return (
+                connection.execute(
+                    f"UPDATE tasks SET lease_expires = ? WHERE {self.LEASED}",
+                    (time.time() + self.lease, task["id"], worker, task["attempts"]),
+                ).rowcount
+                == 1
+            )
+
+    def complete(self, task, worker, output, records=None):
+        """
+        Save the output of a claimed task, which makes it done.
+
+        Parameters:
+        - task (dict): The task, as returned by claim.
+        - worker (str): The ID of the worker that claimed it.
+        - output (str): The output of its stage.
+        - records (list, optional): The stage records collected by CallbackHandler.
+
+        Returns:
+        - bool: Whether the output was saved; False if the task was no longer
+          leased to the worker.
+        """
+        with self._connect() as connection:
+            row = connection.execute(
+                f"SELECT * FROM tasks WHERE {self.LEASED}",
+                (task["id"], worker, task["attempts"]),
+            ).fetchone()
+            if row is None:
+                return False
+            connection.execute(
+                "UPDATE tasks SET status = 'done', output = ?, error = NULL, "
+                "records = ? WHERE id = ?",
+                (output, self._add_records(row, records), task["id"]),
+            )
+            return True
+
+    def fail(self, task, worker, error, records=None):
+        """
+        Report that a claimed task failed. It is claimed again unless it has
+        been attempted max_attempts times; it then fails, and so do the pending
+        tasks of its seed.
+
+        Parameters:
+        - task (dict): The task, as returned by claim.
+        - worker (str): The ID of the worker that claimed it.
+        - error (str): The error it failed with.
+        - records (list, optional): The stage records collected by CallbackHandler.
+
+        Returns:
+        - bool: Whether the failure was saved; False if the task was no longer
+          leased to the worker.
+        """
+        with self._connect() as connection:
+            row = connection.execute(
+                f"SELECT * FROM tasks WHERE {self.LEASED}",
+                (task["id"], worker, task["attempts"]),
+            ).fetchone()
+            if row is None:
+                return False
+            connection.execute(
+                "UPDATE tasks SET status = 'pending', error = ?, records = ? "
+                "WHERE id = ?",
+                (error, self._add_records(row, records), task["id"]),
+            )
+            if row["attempts"] >= self.max_attempts:
+                self._fail(connection, row, error)
+            return True
+
+    @staticmethod
+    def _add_records(row, records):
+        return json.dumps(json.loads(row["records"]) + (records or []))
+
+    @staticmethod
+    def _fail(connection, row, error):
+        connection.execute(
+            "UPDATE tasks SET status = 'failed', error = ? WHERE id = ?",
+            (error, row["id"]),
+        )
+        connection.execute(
+            "UPDATE tasks SET status = 'failed', error = ? "
+            "WHERE job = ? AND seed_id = ? AND status = 'pending'",
+            (f"Not run, as chain '{row['stage']}' failed", row["job"], row["seed_id"]),
+        )
+
+    def tasks(self, job):
+        """
+        List the tasks of a job.
+
+        Parameters:
+        - job (str): The ID of the job.
+
+        Returns:
+        - list: The "id", "seed_id", "stage", "status" ("pending", "running",
+          "done" or "failed"), "output", "error" and stage "records" of every task.
+        """
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT id, seed_id, stage, status, output, error, records "
+                "FROM tasks WHERE job = ? ORDER BY created, id",
+                (job,),
+            ).fetchall()
+        return [
+            {**row, "records": json.loads(row["records"])} for row in map(dict, rows)
+        ]
+
+    def counts(self, job=None):
+        """
+        Count the tasks of a job, or of all jobs, by status.
+
+        Returns:
+        - dict: The number of "pending", "running", "done" and "failed" tasks.
+        """
+        where, parameters = ("WHERE job = ?", (job,)) if job else ("", ())
+        with self._connect() as connection:
+            rows = connection.execute(
+                f"SELECT status, COUNT(*) FROM tasks {where} GROUP BY status",
+                parameters,
+            ).fetchall()
+        return {**dict.fromkeys(QUEUE_STATUSES, 0), **dict(map(tuple, rows))}
+
+    def remove(self, job):
+        """
+        Remove the tasks of a job, once the coordinator has collected them.
+        """
+        with self._connect() as connection:
+            connection.execute(
+                "DELETE FROM dependencies WHERE task IN "
+                "(SELECT id FROM tasks WHERE job = ?)",
+                (job,),
+            )
+            connection.execute("DELETE FROM tasks WHERE job = ?", (job,))
+
+
+class DirectoryTaskQueue:
+    """
+    Queue of stage tasks shared by a coordinator and any number of workers, in
+    a directory on a filesystem they all mount.
+
+    It works like SQLiteTaskQueue without a database: every task is a JSON file
+    in the subdirectory of its status, "pending", "running", "done" or
+    "failed". A worker claims a task by renaming it from pending to running,
+    which only one worker can do, and the modification time of the running file
+    is its last heartbeat. Files are written to a temporary file and renamed,
+    so a task is never read half written. A task running on a worker whose
+    lease expired may be claimed and finished twice; the done file is linked
+    into place, which fails if it exists, so the first output is kept.
+
+    Attributes:
+        path (str): The directory of the queue.
+        lease (float): Seconds a task stays leased without a heartbeat.
+        max_attempts (int): The number of times a task is run before it fails.
+    """
+
+    def __init__(
+        self,
+        path,
+        lease=DEFAULT_QUEUE_LEASE,
+        max_attempts=DEFAULT_QUEUE_MAX_ATTEMPTS,
+    ):
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        for status in QUEUE_STATUSES:
+            os.makedirs(os.path.join(path, status), exist_ok=True)
+
+    def _path(self, status, task_id):
+        return os.path.join(self.path, status, f"{task_id}.json")
+
+    def _read(self, status, task_id):
+        try:
+            with open(self._path(status, task_id)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _write(self, status, task, exclusive=False):
+        # Returns False if exclusive is set and the file already exists
+        path = self._path(status, task["id"])
+        tmp_path = os.path.join(
+            self.path, status, f".{task['id']}.{uuid.uuid4().hex}.tmp"
+        )
+        with open(tmp_path, "w") as f:
+            json.dump(task, f)
+        if not exclusive:
+            os.replace(tmp_path, path)
+            return True
+        try:
+            os.link(tmp_path, path)
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(tmp_path)
+        return True
+
+    def _remove(self, status, task_id):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self._path(status, task_id))
+
+    def _list(self, status, prefix=""):
+        return [
+            name[: -len(".json")]
+            for name in sorted(os.listdir(os.path.join(self.path, status)))
+            if name.startswith(prefix) and name.endswith(".json")
+        ]
+
+    def _leased(self, task, worker):
+        running = self._read("running", task["id"])
+        if (
+            running is None
+            or running["worker"] != worker
+            or running["attempts"] != task["attempts"]
+        ):
+            return None
+        return running
+
+    def add(self, job, seeds, graph):
+        """
+        Queue a task for every stage of every seed of a job.
+
+        Parameters:
+        - job (str): The ID of the job.
+        - seeds (dict): The external inputs (e.g. the "seed") of every seed, by seed ID.
+        - graph (dict): The output keys of the stages the stage of each output
+          key depends on, as built by build_dependency_graph.
+        """
+        for seed_id, inputs in seeds.items():
+            for stage, upstream in graph.items():
+                self._write(
+                    "pending",
+                    {
+                        "id": queue_task_id(job, seed_id, stage),
+                        "job": job,
+                        "seed_id": seed_id,
+                        "stage": stage,
+                        "inputs": inputs,
+                        "depends_on": list(upstream),
+                        "attempts": 0,
+                        "worker": None,
+                        "output": None,
+                        "error": None,
+                        "records": [],
+                    },
+                )
+
+    def claim(self, worker):
+        """
+        Lease the first task whose upstream tasks are done to a worker.
+
+        Parameters:
+        - worker (str): The ID of the worker.
+
+        Returns:
+        - dict: The task's "id", "job", "seed_id", "stage" and "attempts" (this
+          one included), and its "inputs": the external inputs of its seed and
+          the outputs of its upstream tasks. None if no task can be claimed.
+        """
+        self._expire_leases()
+        for task_id in self._list("pending"):
+            task = self._read("pending", task_id)
+            if task is None:
+                continue
+            if os.path.exists(self._path("done", task_id)):
+                # Finished by a worker whose lease had expired
+                self._remove("pending", task_id)
+                continue
+            upstream = {}
+            for stage in task["depends_on"]:
+                done = self._read(
+                    "done", queue_task_id(task["job"], task["seed_id"], stage)
+                )
+                if done is None:
+                    break
+                upstream[stage] = done["output"]
+            else:
+                pending_path = self._path("pending", task_id)
+                try:
+                    # The modification time becomes the first heartbeat
+                    os.utime(pending_path)
+                    os.rename(pending_path, self._path("running", task_id))
+                except FileNotFoundError:
+                    # Claimed by another worker
+                    continue
+                task.update(attempts=task["attempts"] + 1, worker=worker)
+                self._write("running", task)
+                return {
+                    **{key: task[key] for key in ("id", "job", "seed_id", "stage")},
+                    "attempts": task["attempts"],
+                    "inputs": {**task["inputs"], **upstream},
+                }
+        return None
+
+    def _expire_leases(self):
+        now = time.time()
+        for task_id in self._list("running"):
+            try:
+                if os.path.getmtime(self._path("running", task_id)) + self.lease > now:
+                    continue
+            except FileNotFoundError:
+                continue
+            task = self._read("running", task_id)
+            if task is None:
+                continue
+            if task["attempts"] >= self.max_attempts:
+                self._fail(task, f"The lease of {task['worker']} expired")
+                continue
+            with contextlib.suppress(FileNotFoundError):
+                os.rename(
+                    self._path("running", task_id), self._path("pending", task_id)
+                )
+
+    def heartbeat(self, task, worker):
+        """
+        Renew the lease of a claimed task.
+
+        Parameters:
+        - task (dict): The task, as returned by claim.
+        - worker (str): The ID of the worker that claimed it.
+
+        Returns:
+        - bool: Whether the task is still leased to the worker.
+        """
+        if self._leased(task, worker) is None:
+            return False
+        try:
+            os.utime(self._path("running", task["id"]))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def complete(self, task, worker, output, records=None):
+        """
+        Save the output of a claimed task, which makes it done.
+
+        Parameters:
+        - task (dict): The task, as returned by claim.
+        - worker (str): The ID of the worker that claimed it.
+        - output (str): The output of its stage.
+        - records (list, optional): The stage records collected by CallbackHandler.
+
+        Returns:
+        - bool: Whether the output was saved; False if the task was no longer
+          leased to the worker, or another worker finished it first.
+        """
+        running = self._leased(task, worker)
+        if running is None:
+            return False
+        running.update(
+            output=output, error=None, records=running["records"] + (records or [])
+        )
+        saved = self._write("done", running, exclusive=True)
+        self._remove("running", task["id"])
+        return saved
+
+    def fail(self, task, worker, error, records=None):
+        """
+        Report that a claimed task failed. It is claimed again unless it has
+        been attempted max_attempts times; it then fails, and so do the pending
+        tasks of its seed.
+
+        Parameters:
+        - task (dict): The task, as returned by claim.
+        - worker (str): The ID of the worker that claimed it.
+        - error (str): The error it failed with.
+        - records (list, optional): The stage records collected by CallbackHandler.
+
+        Returns:
+        - bool: Whether the failure was saved; False if the task was no longer
+          leased to the worker.
+        """
+        running = self._leased(task, worker)
+        if running is None:
+            return False
+        running.update(error=error, records=running["records"] + (records or []))
+        if running["attempts"] >= self.max_attempts:
+            self._fail(running, error)
+            return True
+        self._write("running", running)
+        with contextlib.suppress(FileNotFoundError):
+            os.rename(
+                self._path("running", task["id"]), self._path("pending", task["id"])
+            )
+        return True
+
+    def _fail(self, task, error):
+        self._write("failed", {**task, "error": error})
+        self._remove("running", task["id"])
+        for task_id in self._list("pending", f"{task['job']}-{task['seed_id']}-"):
+            pending = self._read("pending", task_id)
+            if pending is None:
+                continue
+            pending["error"] = f"Not run, as chain '{task['stage']}' failed"
+            self._write("failed", pending)
+            self._remove("pending", task_id)
+
+    def tasks(self, job):
+        """
+        List the tasks of a job.
+
+        Parameters:
+        - job (str): The ID of the job.
+
+        Returns:
+        - list: The "id", "seed_id", "stage", "status" ("pending", "running",
+          "done" or "failed"), "output", "error" and stage "records" of every task.
+        """
+        tasks = {}
+        # A task finished by two workers may also be listed as pending or running
+        for status in ["pending", "running", "failed", "done"]:
+            for task_id in self._list(status, f"{job}-"):
+                task = self._read(status, task_id)
+                if task is not None:
+                    tasks[task_id] = {
+                        **{
+                            key: task[key]
+                            for key in ("id", "seed_id", "stage", "output", "error")
+                        },
+                        "status": status,
+                        "records": task["records"],
+                    }
+        return list(tasks.values())
+
+    def counts(self, job=None):
+        """
+        Count the tasks of a job, or of all jobs, by status.
+
+        Returns:
+        - dict: The number of "pending", "running", "done" and "failed" tasks.
+        """
+        prefix = f"{job}-" if job else ""
+        return {status: len(self._list(status, prefix)) for status in QUEUE_STATUSES}
+
+    def remove(self, job):
+        """
+        Remove the tasks of a job, once the coordinator has collected them.
+        """
+        for status in QUEUE_STATUSES:
+            for task_id in self._list(status, f"{job}-"):
+                self._remove(status, task_id)
+
+
+def build_task_queue(queue_config):
+    """
+    Create the task queue configured in the "queue" section of the configuration.
+
+    Parameters:
+    - queue_config (dict): Optional "backend" ("sqlite" or "directory"), "path",
+      "lease" and "max_attempts" keys. The path defaults to "queue.db" for
+      SQLite and ".queue" for a directory.
+
+    Returns:
+    - SQLiteTaskQueue or DirectoryTaskQueue: The queue.
+    """
+    backend = queue_config.get("backend", DEFAULT_QUEUE_BACKEND)
+    queue_class = DirectoryTaskQueue if backend == "directory" else SQLiteTaskQueue
+    return queue_class(
+        queue_config.get("path", DEFAULT_QUEUE_PATHS[backend]),
+        lease=queue_config.get("lease", DEFAULT_QUEUE_LEASE),
+        max_attempts=queue_config.get("max_attempts", DEFAULT_QUEUE_MAX_ATTEMPTS),
+    )
+
+
+def default_worker_id():
+    """
+    Return an ID for this worker process, unique across the hosts sharing a queue.
+    """
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def write_metrics(metrics_file, metrics_format, records):
+    """
+    Export per-stage metrics in a machine-readable format.
+
+    The "jsonl" format appends one JSON object per stage to the file, building
+    up a history for tracking latency percentiles over time. The "prometheus"
+    format overwrites the file with the metrics of this run in the Prometheus
+    text exposition format, for the node exporter textfile collector.
+
+    Parameters:
+    - metrics_file (str): The path of the metrics file.
+    - metrics_format (str): Either "jsonl" or "prometheus".
+    - records (list): The stage records collected by CallbackHandler, optionally
+      with extra fields such as the seed file. Records of a variant are
+      summarized separately, with a "variant" label.
+
+    Returns:
+    - None
+    """
+    if metrics_format == "jsonl":
+        with open(metrics_file, "a") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+        return
+
+    metrics = [
+        ("duration_seconds", "Time taken by the stage.", "duration"),
+        (
+            "time_to_first_token_seconds",
+            "Time until the first streamed token of the stage.",
+            "time_to_first_token",
+        ),
+        ("prompt_tokens", "Prompt tokens used by the stage.", "prompt_tokens"),
+        (
+            "completion_tokens",
+            "Completion tokens used by the stage.",
+            "completion_tokens",
+        ),
+        ("cost_usd", "Cost of the stage in USD.", "cost"),
+    ]
+    lines = []
+    for name, description, field in metrics:
+        metric = f"business_modeler_stage_{name}"
+        lines.append(f"# HELP {metric} {description}")
+        lines.append(f"# TYPE {metric} summary")
+        samples = {}
+        for record in records:
+            if record[field] is not None and not record["reused"]:
+                key = (
+                    record["stage"],
+                    record["model"] or "",
+                    record.get("variant") or "",
+                )
+                samples.setdefault(key, []).append(record[field])
+        for (stage, model, variant), values in sorted(samples.items()):
+            values.sort()
+            label = f'stage="{stage}",model="{model}"'
+            if variant:
+                label += f',variant="{variant}"'
+            for quantile in (0.5, 0.95):
+                value = values[min(len(values) - 1, int(quantile * len(values)))]
+                lines.append(f'{metric}{{{label},quantile="{quantile}"}} {value}')
+            lines.append(f"{metric}_sum{{{label}}} {sum(values)}")
+            lines.append(f"{metric}_count{{{label}}} {len(values)}")
+
+    # Write atomically so the collector never reads a partial file
+    tmp_file = f"{metrics_file}.tmp"
+    with open(tmp_file, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp_file, metrics_file)
+
+
+def report_stage_metrics(records):
+    """
+    Reports the runtime, time to first token, tokens and cost of each stage.
+
+    Parameters:
+    - records (list): The stage records collected by CallbackHandler.
+
+    Returns:
+    - None
+    """
+    for record in sorted(records, key=lambda record: record["start"]):
+        stage = record["stage"]
+        if record.get("variant"):
+            stage += f" ({record['variant']})"
+        if record["reused"]:
+            click.secho(f"  {stage}: reused", fg="yellow")
+            continue
+        ttft = (
+            f", first token after {record['time_to_first_token']:.2f}s"
+            if record["time_to_first_token"] is not None
+            else ""
+        )
+        click.secho(
+            f"  {stage}: {record['duration']:.2f}s{ttft}, "
+            f"{record['prompt_tokens']} prompt + "
+            f"{record['completion_tokens']} completion tokens, "
+            f"${record['cost']:.2f}",
+            fg="yellow",
+        )
+
+
+def default_output_file():
+    """
+    Return the default base name of the output file, based on the current time.
+
+    Returns:
+    - str: The base name of the output file.
+    """
+    return f"output-{datetime.now().strftime('%Y-%m-%d-%H-%M-%S')}"
+
+
+def md2pdf(pdf_file_path, **kwargs):
+    """
+    Convert markdown to a PDF file with md2pdf, which is imported on first use.
+
+    Parameters:
+    - pdf_file_path (str): The path of the PDF file to create.
+    - kwargs: The arguments of md2pdf.core.md2pdf, e.g. md_content.
+
+    Returns:
+    - None
+    """
+    from md2pdf.core import md2pdf as convert
+
+    return convert(pdf_file_path, **kwargs)
+
+
+def markdown_to_html(markdown_text):
+    """
+    Convert markdown to HTML with the markdown package, which is imported on first use.
+
+    Parameters:
+    - markdown_text (str): The markdown to convert.
+
+    Returns:
+    - str: The HTML.
+    """
+    from markdown import markdown
+
+    return markdown(markdown_text)
+
+
+def load_stage_schema(stage, prompt_templates_dir):
+    """
+    Read the JSON schema of a template's structured output.
+
+    Parameters:
+    - stage (str): The name of the template, without its extension.
+    - prompt_templates_dir (str): Directory path containing prompt template files.
+
+    Returns:
+    - dict: The JSON schema, from "schemas/<stage>.json" in the templates directory.
+    """
+    with open(os.path.join(prompt_templates_dir, SCHEMAS_DIR, f"{stage}.json")) as f:
+        return json.load(f)
+
+
+def validate_schemas(chains_config, prompt_templates_dir):
+    """
+    Check that every template has a readable JSON schema for structured output.
+
+    Parameters:
+    - chains_config (list): The "chains" section of the configuration.
+    - prompt_templates_dir (str): Directory path containing prompt template files.
+
+    Returns:
+    - list: A description of every problem found; empty if there are none.
+    """
+    problems = []
+    for chain_config in chains_config:
+        stage = os.path.splitext(chain_config["template_file"])[0]
+        try:
+            load_stage_schema(stage, prompt_templates_dir)
+        except (OSError, ValueError) as e:
+            problems.append(f"Cannot read the schema of {stage}: {e}")
+    return problems
+
+
+def validate_document(document, schema, path="$"):
+    """
+    Check a JSON document against a JSON schema.
+
+    Only the "type", "properties", "required", "items", "minItems" and
+    "maxItems" keywords are checked, which is what the stage schemas use.
+
+    Parameters:
+    - document: The parsed JSON document.
+    - schema (dict): The JSON schema.
+    - path (str, optional): The location of the document, used in the problems.
+
+    Returns:
+    - list: A description of every problem found; empty if there are none.
+    """
+    expected = schema.get("type")
+    if expected in SCHEMA_TYPES and (
+        not isinstance(document, SCHEMA_TYPES[expected])
+        # bool is a subclass of int, but not a JSON number
+        or (isinstance(document, bool) and expected != "boolean")
+    ):
+        return [f"{path} should be of type {expected}"]
+
+    problems = []
+    if isinstance(document, dict):
+        properties = schema.get("properties", {})
+        problems += [
+            f"{path} is missing {key}"
+            for key in schema.get("required", [])
+            if key not in document
+        ]
+        for key, value in document.items():
+            if key in properties:
+                problems += validate_document(value, properties[key], f"{path}.{key}")
+    elif isinstance(document, list):
+        if len(document) < schema.get("minItems", 0):
+            problems.append(f"{path} should have at least {schema['minItems']} items")
+        if len(document) > schema.get("maxItems", len(document)):
+            problems.append(f"{path} should have at most {schema['maxItems']} items")
+        for i, item in enumerate(document):
+            problems += validate_document(item, schema.get("items", {}), f"{path}[{i}]")
+    return problems
+
+
+class OutputValidationError(ValueError):
+    """
+    Raised when the output of a chain fails the rules of its "validate" setting.
+
+    Attributes:
+        output_key (str): The output key of the chain.
+        problems (list): A description of every problem found.
+    """
+
+    def __init__(self, output_key, problems):
+        super().__init__(
+            f"The output of chain '{output_key}' failed validation: "
+            f"{'; '.join(problems)}"
+        )
+        self.output_key = output_key
+        self.problems = problems
+
+
+def validate_output(text, rules):
+    """
+    Check the markdown output of a chain against the rules of its "validate" setting.
+
+    Parameters:
+    - text (str): The output.
+    - rules (dict): Optional "required_headings" (the texts of headings the
+      output must have), "min_items" (list items), "min_length" and
+      "max_length" (characters), and "forbidden_patterns" (regular expressions,
+      e.g. of refusals, matched case-insensitively on every line).
+
+    Returns:
+    - list: A description of every problem found; empty if there are none.
+    """
+
+    def heading_text(heading):
+        return heading.strip().rstrip(".:").strip().lower()
+
+    problems = []
+    headings = {
+        heading_text(heading)
+        for heading in re.findall(r"^#{1,6}\s+(.+?)\s*#*\s*$", text, re.MULTILINE)
+    }
+    for heading in rules.get("required_headings", []):
+        if heading_text(heading) not in headings:
+            problems.append(f"is missing the heading '{heading}'")
+    items = sum(1 for line in text.splitlines() if LIST_ITEM.match(line))
+    if items < rules.get("min_items", 0):
+        problems.append(f"has {items} list items, fewer than {rules['min_items']}")
+    length = len(text.strip())
+    if length < rules.get("min_length", 0):
+        problems.append(
+            f"is {length} characters long, shorter than {rules['min_length']}"
+        )
+    if length > rules.get("max_length", length):
+        problems.append(
+            f"is {length} characters long, longer than {rules['max_length']}"
+        )
+    for pattern in rules.get("forbidden_patterns", []):
+        if re.search(pattern, text, re.IGNORECASE | re.MULTILINE):
+            problems.append(f"matches '{pattern}'")
+    return problems
+
+
+def validate_output_rules(chains_config):
+    """
+    Check the "validate" settings of the chains.
+
+    Parameters:
+    - chains_config (list): The "chains" section of the configuration.
+
+    Returns:
+    - list: A description of every problem found; empty if there are none.
+    """
+    problems = []
+    for chain_config in chains_config:
+        stage = os.path.splitext(chain_config["template_file"])[0]
+        rules = chain_config.get("validate", {})
+        for key in set(rules).difference(VALIDATION_RULES):
+            problems.append(f"{stage} has an unknown validation rule '{key}'")
+        if rules.get("on_failure", "abort") not in VALIDATION_FAILURE_ACTIONS:
+            problems.append(
+                f"The on_failure of {stage} must be one of "
+                f"{', '.join(VALIDATION_FAILURE_ACTIONS)}"
+            )
+        for key in ["min_items", "min_length", "max_length", "max_retries"]:
+            if key in rules and (not isinstance(rules[key], int) or rules[key] < 0):
+                problems.append(f"The {key} of {stage} must be a positive integer")
+        for pattern in rules.get("forbidden_patterns", []):
+            try:
+                re.compile(pattern)
+            except re.error as e:
+                problems.append(f"{stage} has an invalid pattern '{pattern}': {e}")
+    return problems
+
+
+def structured_instructions(schema):
+    """
+    Return the instructions added to a prompt to get a JSON document as output.
+
+    Parameters:
+    - schema (dict): The JSON schema of the output.
+
+    Returns:
+    - str: The instructions, ending with the schema.
+    """
+    return (
+        "\n\nInstead of markdown, respond only with a JSON document, "
+        "without any other text, that matches this JSON schema:\n" + json.dumps(schema)
+    )
+
+
+def parse_structured_output(text):
+    """
+    Parse the JSON document a language model responded with.
+
+    Parameters:
+    - text (str): The response, optionally wrapped in a markdown code block.
+
+    Returns:
+    - The parsed document.
+
+    Raises:
+    - ValueError: If the response is not valid JSON.
+    """
+    block = re.search(r"```(?:json)?\s*(.*?)```", text, re.DOTALL)
+    return json.loads(block.group(1) if block else text)
+
+
+def render_structured(document, schema):
+    """
+    Render a template's JSON document as a markdown section.
+
+    The schema's "title" is the heading of the section, and the title of each
+    property the heading of its value. Lists are numbered; the first field of
+    an object in a list is its text, and the other fields are listed below it.
+
+    Parameters:
+    - document: The parsed JSON document.
+    - schema (dict): The JSON schema of the document.
+
+    Returns:
+    - str: The markdown section.
+    """
+
+    def title(key, schema):
+        return schema.get("title", key.replace("_", " ").capitalize())
+
+    def fields(value, schema):
+        # The fields of an object, in the order of the schema's properties
+        properties = schema.get("properties", {})
+        keys = [key for key in properties if key in value]
+        keys += [key for key in value if key not in properties]
+        return [(key, value[key], properties.get(key, {})) for key in keys]
+
+    def render_item(item, schema):
+        if not isinstance(item, dict) or not item:
+            return str(item)
+        (_, text, _), *rest = fields(item, schema)
+        return "\n".join(
+            [str(text)]
+            + [f"   - **{title(key, field)}**: {value}" for key, value, field in rest]
+        )
+
+    def render(value, schema, level):
+        if isinstance(value, dict):
+            return "\n\n".join(
+                f"{'#' * level} {title(key, field)}\n\n{render(item, field, level + 1)}"
+                for key, item, field in fields(value, schema)
+            )
+        if isinstance(value, list):
+            return "\n".join(
+                f"{i}. {render_item(item, schema.get('items', {}))}"
+                for i, item in enumerate(value, 1)
+            )
+        return str(value)
+
+    body = render(document, schema, 2)
+    return f"# {schema['title']}\n\n{body}\n" if "title" in schema else f"{body}\n"
+
+
+class ReportStore:
+    """
+    JSON lines file holding the structured outputs of every report.
+
+    Each line is one report: its "id", "created" time, "seed", and the JSON
+    document of every stage in "stages". Reports are only ever appended, so
+    the file can be read while reports are added to it.
+
+    Attributes:
+        path (str): The path of the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def append(self, seed, documents):
+        """
+        Add a report to the store.
+
+        Parameters:
+        - seed (str): The contents of the seed file.
+        - documents (dict): The JSON document of every stage.
+
+        Returns:
+        - dict: The stored record.
+        """
+        record = {
+            "id": uuid.uuid4().hex,
+            "created": datetime.now().isoformat(),
+            "seed": seed,
+            "stages": documents,
+        }
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "a") as f:
+                f.write(f"{line}\n")
+        return record
+
+    def read(self):
+        """
+        Iterate over the stored reports, oldest first.
+
+        Returns:
+        - iterator: The records; a partly written last line is skipped.
+        """
+        try:
+            f = open(self.path)
+        except FileNotFoundError:
+            return
+        with f:
+            for line in f:
+                with contextlib.suppress(ValueError):
+                    yield json.loads(line)
+
+
+def render_record(record, schemas):
+    """
+    Render a stored report as the sections of the output template.
+
+    Parameters:
+    - record (dict): The report, as stored in the ReportStore.
+    - schemas (dict): The JSON schema of every stage.
+
+    Returns:
+    - dict: The seed and the markdown section of every stage, for generate_report.
+    """
+    return {
+        "seed": record["seed"],
+        **{
+            stage: render_structured(document, schemas.get(stage, {}))
+            for stage, document in record["stages"].items()
+        },
+    }
+
+
+def store_structured_outputs(output, schemas, store=None):
+    """
+    Store the JSON outputs of a structured run and render them for the report.
+
+    Parameters:
+    - output (dict): The output of the chain: the seed and the JSON text of
+      every stage.
+    - schemas (dict): The JSON schema of every stage.
+    - store (ReportStore, optional): The store the report is added to.
+
+    Returns:
+    - dict: The seed and the markdown section of every stage, for generate_report.
+    """
+    documents = {stage: json.loads(resolve_output(output[stage])) for stage in schemas}
+    record = (
+        store.append(output["seed"], documents)
+        if store
+        else {"seed": output["seed"], "stages": documents}
+    )
+    return render_record(record, schemas)
+
+
+def write_markdown_report(markdown_file, output_template, chain_output_dict):
+    """
+    Write the markdown report one section of the output template at a time.
+
+    Spilled outputs are copied from their files in chunks, so the report is
+    never held in memory as a whole.
+
+    Parameters:
+    - markdown_file (str): The path of the markdown file.
+    - output_template (str): The output template.
+    - chain_output_dict (dict): The outputs of the chains, as text or SpilledOutput.
+
+    Returns:
+    - None
+    """
+    formatter = string.Formatter()
+    with open(markdown_file, "w", encoding="utf-8") as f:
+        for literal_text, field_name, spec, conversion in formatter.parse(
+            output_template
+        ):
+            f.write(literal_text)
+            if field_name is None:
+                continue
+            value = chain_output_dict[field_name]
+            if isinstance(value, SpilledOutput) and not (spec or conversion):
+                value.copy_to(f)
+                continue
+            if conversion:
+                value = formatter.convert_field(resolve_output(value), conversion)
+            f.write(formatter.format_field(value, spec))
+
+
+def generate_report(output_file, formats, **chain_output_dict):
+    """
+    Generates a report by converting chain output to markdown and then to the
+    requested formats.
+
+    Parameters:
+    - output_file (str): The base name of the output file.
+    - formats (iterable): The formats to create: "md", "pdf" and/or "html".
+    - chain_output_dict (dict): Dictionary containing the output of the chains.
+
+    Returns:
+    - dict: The name of the created file for each format.
+    """
+    output_template = read_template(OUTPUT_TEMPLATE_FILE)
+    file_name = output_file or default_output_file()
+    report_files = {}
+
+    # Save markdown content to file, streaming the spilled outputs into it
+    if "md" in formats:
+        report_files["md"] = f"{file_name}.md"
+        write_markdown_report(report_files["md"], output_template, chain_output_dict)
+
+    # The other formats are converted from the whole markdown content
+    if "pdf" in formats or "html" in formats:
+        markdown_output = output_template.format(**chain_output_dict)
+
+    # Convert the markdown content to PDF
+    if "pdf" in formats:
+        report_files["pdf"] = f"{file_name}.pdf"
+        md2pdf(report_files["pdf"], md_content=markdown_output)
+
+    # Convert the markdown content to a standalone HTML page
+    if "html" in formats:
+        report_files["html"] = f"{file_name}.html"
+        with open(report_files["html"], "w") as f:
+            f.write(
+                '<!DOCTYPE html>\n<html>\n<head><meta charset="utf-8"></head>\n'
+                f"<body>\n{markdown_to_html(markdown_output)}\n</body>\n</html>\n"
+            )
+
+    # Return the names of the created files
+    return report_files
+
+
+class ReportRenderer:
+    """
+    Renders reports on a pool of worker processes.
+
+    Rendering PDFs is CPU-bound and slow compared to the rest of the pipeline
+    outside the language model calls. Submitting reports to the renderer lets
+    the caller move on to the next seed while earlier reports are rendered in
+    parallel, instead of gating chain throughput on rendering.
+
+    Attributes:
+        max_workers (int): Maximum number of reports rendered at once.
+    """
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        # Spawn rather than fork: the parent process is running chain threads.
+        # Workers ignore Ctrl+C and are shut down by the parent instead.
+        self._executor = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=signal.signal,
+            initargs=(signal.SIGINT, signal.SIG_IGN),
+        )
+
+    def submit(self, output_file, formats, chain_output_dict):
+        """
+        Schedules the generation of a report.
+
+        Parameters:
+        - output_file (str): The base name of the output file.
+        - formats (iterable): The formats to create.
+        - chain_output_dict (dict): Dictionary containing the output of the chains.
+
+        Returns:
+        - Future: A future resolving to the names of the created files.
+        """
+        return self._executor.submit(
+            generate_report, output_file, list(formats), **chain_output_dict
+        )
+
+    def shutdown(self):
+        """
+        Waits for the pending reports and stops the worker processes.
+        """
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+
+def parse_report_formats(report_format, markdown):
+    """
+    Parses a comma separated list of report formats.
+
+    Parameters:
+    - report_format (str): The formats, e.g. "md,pdf,html".
+    - markdown (bool): If True, the markdown format is added.
+
+    Returns:
+    - list: The formats, in the order of REPORT_FORMATS.
+
+    Raises:
+    - click.BadParameter: If a format is not supported.
+    """
+    formats = {name.strip() for name in report_format.split(",") if name.strip()}
+    if markdown:
+        formats.add("md")
+    unknown = formats.difference(REPORT_FORMATS)
+    if unknown:
+        raise click.BadParameter(
+            f"Unsupported report format(s): {', '.join(sorted(unknown))}. "
+            f"Choose from {', '.join(REPORT_FORMATS)}.",
+            param_hint="'--format'",
+        )
+    return [name for name in REPORT_FORMATS if name in formats]
+
+
+def report_results(report_files, monitor, duration, seed_match=None):
+    """
+    Reports the results of the report generation including file names,
+    total tokens, cost, and runtime.
+
+    Parameters:
+    - report_files (dict): The name of the created file for each format.
+    - monitor (CallbackHandler): The handler that recorded the stages of the run.
+    - duration (float): The total runtime in seconds.
+    - seed_match (dict, optional): The similar seed whose outputs were reused.
+
+    Returns:
+    - None
+    """
+    if seed_match:
+        click.secho(describe_seed_match(seed_match), fg="magenta")
+    for report_format, file_name in report_files.items():
+        click.secho(
+            f"{REPORT_FORMAT_NAMES[report_format]} file created: {file_name}",
+            fg="green",
+        )
+    click.secho(f"Total tokens: {monitor.total_tokens}", fg="yellow")
+    click.secho(f"Total cost: ${monitor.total_cost:.2f}", fg="yellow")
+    click.secho(f"Runtime: {duration:.2f} seconds", fg="yellow")
+
+
+def check_api_key():
+    """
+    Checks if the OPENAI_API_KEY environment variable is set.
+
+    Returns:
+    - str: The API key if it is set.
+
+    Raises:
+    - SystemExit: If the OPENAI_API_KEY environment variable is not set.
+    """
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        click.secho("Error: OPENAI_API_KEY environment variable is not set.", fg="red")
+        click.secho(
+            "Please set it by running: export OPENAI_API_KEY=your_api_key", fg="red"
+        )
+        exit(1)
+    return api_key
+
+
+def check_templates(
+    chains_config, prompt_templates_dir, common_prefix_file, structured=False
+):
+    """
+    Checks the templates of the chains before any request to the API is made.
+
+    Parameters:
+    - chains_config (list): The "chains" section of the configuration.
+    - prompt_templates_dir (str): Directory path containing prompt template files.
+    - common_prefix_file (str): Name of the file containing common prefix content.
+    - structured (bool, optional): If True, also checks the schemas of the templates.
+
+    Raises:
+    - SystemExit: If validate_templates, validate_output_rules or
+      validate_schemas finds any problem.
+    """
+    problems = validate_templates(
+        chains_config, prompt_templates_dir, common_prefix_file
+    )
+    problems += validate_output_rules(chains_config)
+    if structured:
+        problems += validate_schemas(chains_config, prompt_templates_dir)
+    for problem in problems:
+        click.secho(f"Template error: {problem}", fg="red")
+    if problems:
+        exit(1)
+
+
+def read_seed(seed_file):
+    """
+    Reads the content of a seed file or displays an example input if no file is provided.
+
+    Parameters:
+    - seed_file (str): The name of the seed file.
+
+    Returns:
+    - str: The contents of the seed file.
+    """
+    if seed_file is None:
+        click.secho(f"{read_template(EXAMPLE_INPUT_FILE)}", fg="white")
+        exit(0)
+    else:
+        click.secho(f"Using seed file: {seed_file}", fg="green")
+        with open(seed_file, "r") as f:
+            return f.read()
+
+
+@contextlib.contextmanager
+def measure_time():
+    """
+    Context manager for measuring the execution time of a code block.
+
+    Yields:
+    - function: A function that when called, returns the elapsed time in seconds.
+    """
+    start_time = time.time()
+    yield lambda: time.time() - start_time
+
+
+def find_seed_files(seed_dir, seed_pattern):
+    """
+    Find the seed files in a directory that match a glob pattern.
+
+    Parameters:
+    - seed_dir (str): The directory containing the seed files.
+    - seed_pattern (str): The glob pattern the seed file names must match.
+
+    Returns:
+    - list: The sorted paths of the matching seed files.
+    """
+    return sorted(
+        path
+        for path in glob.glob(os.path.join(seed_dir, seed_pattern))
+        if os.path.isfile(path)
+    )
+
+
+def report_batch_results(results, duration):
+    """
+    Reports the outcome of every seed in a batch followed by aggregate
+    tokens, cost and latency.
+
+    Parameters:
+    - results (list): The results returned by run_batch.
+    - duration (float): The total runtime of the batch in seconds.
+
+    Returns:
+    - None
+    """
+    for result in results:
+        if result["error"]:
+            click.secho(f"Failed: {result['seed_file']}: {result['error']}", fg="red")
+        else:
+            click.secho(
+                f"Created: {', '.join(result['report_files'].values())} "
+                f"({result['total_tokens']} tokens, ${result['total_cost']:.2f}, "
+                f"{result['duration']:.2f} seconds)",
+                fg="green",
+            )
+            if result.get("seed_match"):
+                click.secho(
+                    f"  {describe_seed_match(result['seed_match'])}", fg="magenta"
+                )
+            if result.get("duplicate_of"):
+                click.secho(
+                    f"  Same seed as {result['duplicate_of']}, its report was copied",
+                    fg="magenta",
+                )
+
+    failed = sum(1 for result in results if result["error"])
+    latencies = sorted(result["duration"] for result in results)
+    click.secho(
+        f"Seeds: {len(results) - failed} succeeded, {failed} failed", fg="yellow"
+    )
+    click.secho(
+        f"Total tokens: {sum(result['total_tokens'] for result in results)}",
+        fg="yellow",
+    )
+    click.secho(
+        f"Total cost: ${sum(result['total_cost'] for result in results):.2f}",
+        fg="yellow",
+    )
+    if latencies:
+        click.secho(
+            f"Latency per seed: mean {sum(latencies) / len(latencies):.2f}, "
+            f"median {latencies[len(latencies) // 2]:.2f}, "
+            f"max {latencies[-1]:.2f} seconds",
+            fg="yellow",
+        )
+    click.secho(f"Runtime: {duration:.2f} seconds", fg="yellow")
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handler of the server's HTTP job API.
+
+    - POST /jobs with a JSON body {"seed": "...", "formats": ["md"]} queues a job
+      and returns its status, including its "id".
+    - GET /jobs returns the status of all jobs.
+    - GET /jobs/<id> returns the status, progress and results of a job.
+    - GET /jobs/<id>/report/<format> returns a report file of a finished job.
+    - GET /health returns {"status": "ok"}.
+
+    The server's ReportJobs are available as server.jobs.
+    """
+
+    def do_GET(self):
+        jobs = self.server.jobs
+        parts = self.path.split("?")[0].strip("/").split("/")
+        if parts == ["health"]:
+            self._send_json(200, {"status": "ok"})
+        elif parts == ["jobs"]:
+            self._send_json(200, {"jobs": jobs.list()})
+        elif len(parts) in (2, 4) and parts[0] == "jobs":
+            job = jobs.get(parts[1])
+            if job is None:
+                self._send_json(404, {"error": f"Unknown job: {parts[1]}"})
+            elif len(parts) == 2:
+                self._send_json(200, job)
+            elif parts[2] == "report" and parts[3] in job["report_files"]:
+                self._send_file(job["report_files"][parts[3]])
+            else:
+                self._send_json(404, {"error": f"No such report: {parts[2:]}"})
+        else:
+            self._send_json(404, {"error": f"Not found: {self.path}"})
+
+    def do_POST(self):
+        if self.path.strip("/") != "jobs":
+            self._send_json(404, {"error": f"Not found: {self.path}"})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            seed = body["seed"]
+            if not isinstance(seed, str):
+                raise ValueError("'seed' must be a string")
+            formats = body.get("formats")
+            if formats is not None:
+                formats = parse_report_formats(",".join(formats), False)
+        except (TypeError, ValueError, KeyError, click.BadParameter) as e:
+            self._send_json(400, {"error": f"Invalid job: {e}"})
+            return
+        try:
+            job = self.server.jobs.submit(seed, formats)
+        except ValueError as e:
+            self._send_json(400, {"error": f"Invalid seed: {e}"})
+            return
+        self._send_json(202, job, {"Location": f"/jobs/{job['id']}"})
+
+    def address_string(self):
+        # Clients connected over a Unix socket have no address
+        return self.client_address[0] if self.client_address else "local"
+
+    def _send_json(self, status, data, headers=None):
+        body = json.dumps(data, indent=2).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_file(self, path):
+        content_types = {
+            ".md": "text/markdown",
+            ".html": "text/html",
+            ".pdf": "application/pdf",
+        }
+        with open(path, "rb") as f:
+            body = f.read()
+        self.send_response(200)
+        self.send_header(
+            "Content-Type",
+            content_types.get(os.path.splitext(path)[1], "application/octet-stream"),
+        )
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    """
+    HTTP server listening on a Unix socket, handling each request in a thread.
+    """
+
+    daemon_threads = True
+
+
+def create_server(
+    jobs, host=DEFAULT_SERVER_HOST, port=DEFAULT_SERVER_PORT, socket_path=None
+):
+    """
+    Create the HTTP server of the job API.
+
+    Parameters:
+    - jobs (ReportJobs): The jobs the server submits to and reports on.
+    - host (str, optional): The host to listen on. Defaults to "127.0.0.1".
+    - port (int, optional): The port to listen on. Defaults to 8000.
+    - socket_path (str, optional): Listen on this Unix socket instead of host and port.
+
+    Returns:
+    - socketserver.BaseServer: The server, ready to serve_forever.
+    """
+    if socket_path:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, JobRequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), JobRequestHandler)
+    server.jobs = jobs
+    return server
+
+
+def build_http_session(pool_size):
+    """
+    Create the HTTP session shared by all requests to the OpenAI API.
+
+    Parameters:
+    - pool_size (int): The number of connections to keep open.
+
+    Returns:
+    - requests.Session: The session.
+    """
+    import requests
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+@click.group(invoke_without_command=True)
+@click.option("--seed-file", default=None, help="Path to the seed file.")
+@click.option(
+    "--seed-dir",
+    default=None,
+    help="Generate a report for every seed file in this directory.",
+)
+@click.option(
+    "--seed-pattern",
+    default="*.md",
+    show_default=True,
+    help="Glob pattern for the seed files in --seed-dir.",
+)
+@click.option(
+    "--output-dir",
+    default=".",
+    show_default=True,
+    help="Directory for the reports generated with --seed-dir.",
+)
+@click.option(
+    "--batch-workers",
+    default=None,
+    type=int,
+    help="Maximum number of seed files to process concurrently.",
+)
+@click.option(
+    "--output-file", default=None, help="Specify the name of the output file."
+)
+@click.option(
+    "--markdown", is_flag=True, default=False, help="Save output as markdown."
+)
+@click.option(
+    "--format",
+    "report_format",
+    default="pdf",
+    show_default=True,
+    help="Comma separated report formats to create: md, pdf and/or html.",
+)
+@click.option(
+    "--render-workers",
+    default=None,
+    type=int,
+    help="Maximum number of reports rendered concurrently with --seed-dir.",
+)
+@click.option("--verbose", is_flag=True, default=False, help="Enable verbose output.")
+@click.option(
+    "--config-file", default="config.yaml", help="Path to the configuration file."
+)
+@click.option("--temperature", default=None, type=float, help="Set the temperature.")
+@click.option("--model-name", default=None, type=str, help="Set the model name.")
+@click.option(
+    "--backend",
+    type=click.Choice(BACKENDS),
+    default=None,
+    help="Language model backend; 'mock' runs offline with canned responses.",
+)
+@click.option(
+    "--max-workers",
+    default=None,
+    type=int,
+    help="Maximum number of chains to run concurrently.",
+)
+@click.option(
+    "--no-cache", is_flag=True, default=False, help="Disable the response cache."
+)
+@click.option(
+    "--refresh-stage",
+    multiple=True,
+    help="Ignore cached output for this chain (e.g. 'risks'). Can be repeated.",
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    default=False,
+    help="Only rerun chains whose template, settings or inputs changed since "
+    "the last run with the same output file.",
+)
+@click.option(
+    "--stream",
+    is_flag=True,
+    default=False,
+    help="Stream tokens to the terminal and write each section of the markdown "
+    "file as soon as it is generated. Implies --markdown.",
+)
+@click.option(
+    "--speculate",
+    is_flag=True,
+    default=False,
+    help="Start the chains with a speculate setting before the chains they "
+    "depend on finish, and run them again if those outputs change.",
+)
+@click.option(
+    "--resume",
+    "resume_run",
+    default=None,
+    metavar="RUN_ID",
+    help="Resume an interrupted run, only generating the stages it had not "
+    "finished. The seed and output file are those of the run.",
+)
+@click.option(
+    "--variants",
+    is_flag=True,
+    default=False,
+    help="Run the stages after the shared_stages once for every setting in "
+    "the variants section of the configuration file, and create one "
+    "report comparing them.",
+)
+@click.option(
+    "--structured",
+    is_flag=True,
+    default=False,
+    help="Have every template respond with a JSON document matching its schema, "
+    "append the documents to the report store, and render the report from them.",
+)
+@click.option(
+    "--bulk",
+    is_flag=True,
+    default=False,
+    help="With --seed-dir, submit the prompts of each stage for all seeds as "
+    "one batch job, configured in the bulk section of the configuration file.",
+)
+@click.option(
+    "--distributed",
+    is_flag=True,
+    default=False,
+    help="With --seed-dir, queue a task for every stage of every seed in the "
+    "queue section of the configuration file for worker commands to run, and "
+    "create the reports once they are done.",
+)
+@click.option(
+    "--low-memory",
+    is_flag=True,
+    default=False,
+    help="Write every chain output to disk and only keep it in memory until the "
+    "chains using it have started, so large batches run in flat memory.",
+)
+@click.option(
+    "--metrics-file",
+    default=None,
+    help="Export the latency, tokens and cost of every chain to this file.",
+)
+@click.option(
+    "--metrics-format",
+    type=click.Choice(["jsonl", "prometheus"]),
+    default="jsonl",
+    show_default=True,
+    help="Format of --metrics-file: appended JSON lines, or a Prometheus textfile.",
+)
+@click.pass_context
+def main(
+    ctx,
+    seed_file,
+    seed_dir,
+    seed_pattern,
+    output_dir,
+    batch_workers,
+    output_file,
+    markdown,
+    report_format,
+    render_workers,
+    verbose,
+    config_file,
+    temperature,
+    model_name,
+    backend,
+    max_workers,
+    no_cache,
+    refresh_stage,
+    incremental,
+    stream,
+    speculate,
+    resume_run,
+    variants,
+    structured,
+    bulk,
+    distributed,
+    low_memory,
+    metrics_file,
+    metrics_format,
+):
+    """Generate a business model from a hunch file.
+
+    The options also apply to the reports generated by the commands below.
+    """
+
+    # Load the configuration from the specified configuration file
+    chain_config = load_chain_config(config_file)
+
+    # Find the seed files of a batch, or read the single seed file (without
+    # one, the example input is shown). Then check the API key, which the
+    # offline mock backend does not need. Commands such as serve check it and
+    # receive their seeds in their own way.
+    backend = backend or chain_config.get("backend", DEFAULT_BACKEND)
+    if ctx.invoked_subcommand is None:
+        if seed_dir:
+            seed_files = find_seed_files(seed_dir, seed_pattern)
+            if not seed_files:
+                click.secho(
+                    f"No seed files matching {seed_pattern} in {seed_dir}", fg="red"
+                )
+                exit(1)
+        elif resume_run:
+            checkpoint = RunCheckpoint(
+                os.path.join(chain_config.get("runs_dir", DEFAULT_RUNS_DIR), resume_run)
+            )
+            try:
+                run, checkpointed_outputs = checkpoint.load()
+            except FileNotFoundError:
+                click.secho(f"Error: there is no run {resume_run} to resume.", fg="red")
+                exit(1)
+            seed = run["seed"]
+            output_file = output_file or run["output_file"]
+        else:
+            if incremental and not output_file:
+                click.secho("Error: --incremental requires --output-file.", fg="red")
+                exit(1)
+            seed = read_seed(seed_file)
+        if speculate and stream:
+            click.secho(
+                "Error: --speculate cannot be combined with --stream.", fg="red"
+            )
+            exit(1)
+        if resume_run and (seed_dir or variants):
+            click.secho(
+                "Error: --resume cannot be combined with --seed-dir or --variants.",
+                fg="red",
+            )
+            exit(1)
+        if variants and (seed_dir or incremental or stream):
+            click.secho(
+                "Error: --variants cannot be combined with --seed-dir, "
+                "--incremental or --stream.",
+                fg="red",
+            )
+            exit(1)
+        if structured and (variants or stream):
+            click.secho(
+                "Error: --structured cannot be combined with --variants or --stream.",
+                fg="red",
+            )
+            exit(1)
+        if bulk and (not seed_dir or incremental or stream or speculate):
+            click.secho(
+                "Error: --bulk requires --seed-dir and cannot be combined with "
+                "--incremental, --stream or --speculate.",
+                fg="red",
+            )
+            exit(1)
+        if distributed and (
+            not seed_dir or bulk or incremental or stream or speculate or low_memory
+        ):
+            click.secho(
+                "Error: --distributed requires --seed-dir and cannot be combined "
+                "with --bulk, --incremental, --stream, --speculate or --low-memory.",
+                fg="red",
+            )
+            exit(1)
+        if low_memory and (variants or bulk):
+            click.secho(
+                "Error: --low-memory cannot be combined with --variants or --bulk.",
+                fg="red",
+            )
+            exit(1)
+        api_key = check_api_key() if backend == "openai" else None
+
+    # Streamed sections are written to the markdown file
+    formats = parse_report_formats(report_format, markdown or stream)
+
+    # Override temperature and model_name if provided
+    temperature = temperature or chain_config.get("temperature", DEFAULT_TEMPERATURE)
+    model_name = model_name or chain_config.get("model_name", DEFAULT_MODEL_NAME)
+    max_workers = max_workers or chain_config.get("max_workers")
+    batch_workers = batch_workers or chain_config.get(
+        "batch_workers", DEFAULT_BATCH_WORKERS
+    )
+    render_workers = render_workers or chain_config.get(
+        "render_workers", DEFAULT_RENDER_WORKERS
+    )
+
+    # Get prompt_templates_dir and common_prefix_file from config or set defaults
+    prompt_templates_dir = chain_config.get(
+        "prompt_templates_dir", PROMPT_TEMPLATES_DIR
+    )
+    common_prefix_file = chain_config.get("common_prefix_file", COMMON_PREFIX_FILE)
+
+    # Reuse stage outputs from earlier runs unless caching is disabled
+    cache_config = chain_config.get("cache", {})
+    cache = (
+        None
+        if no_cache or not cache_config.get("enabled", True)
+        else build_response_cache(cache_config)
+    )
+    # Reuse the outputs of earlier seeds that are nearly the same, if enabled.
+    # The seed cache holds markdown outputs, so structured runs do not use it.
+    seed_cache_config = chain_config.get("seed_cache", {})
+    seed_cache = (
+        build_seed_cache(seed_cache_config)
+        if seed_cache_config.get("enabled", False) and not (no_cache or structured)
+        else None
+    )
+    report_store = (
+        ReportStore(chain_config.get("report_store", DEFAULT_REPORT_STORE))
+        if structured
+        else None
+    )
+    # Record every run with the settings it used, unless history_file is unset
+    history_file = chain_config.get("history_file", DEFAULT_HISTORY_FILE)
+    history = (
+        RunHistory(
+            history_file,
+            {
+                **chain_config,
+                "model_name": model_name,
+                "temperature": temperature,
+                "backend": backend,
+            },
+        )
+        if history_file
+        else None
+    )
+
+    # Clean up the seeds and check their size before any request is made
+    seed_preprocessor = build_seed_preprocessor(
+        chain_config.get("seed_preprocessing", {}),
+        chain_config.get("tokenizer", DEFAULT_TOKENIZER),
+    )
+
+    chain_options = dict(
+        chains_config=chain_config["chains"],
+        prompt_templates_dir=prompt_templates_dir,
+        common_prefix_file=common_prefix_file,
+        verbose=verbose,
+        model_name=model_name,
+        temperature=temperature,
+        max_workers=max_workers,
+        cache=cache,
+        refresh_stages=refresh_stage,
+        streaming=stream,
+        backend=backend,
+        mock_options=chain_config.get("mock"),
+        tokenizer=chain_config.get("tokenizer", DEFAULT_TOKENIZER),
+        rate_limits=chain_config.get("rate_limits"),
+        speculate=speculate,
+        structured=structured,
+        spill_dir=chain_config.get("spill_dir", DEFAULT_SPILL_DIR)
+        if low_memory
+        else None,
+    )
+
+    # Commands build the chain from these options once their own are parsed
+    if ctx.invoked_subcommand is not None:
+        ctx.obj = {
+            "backend": backend,
+            "chain_options": chain_options,
+            "formats": formats,
+            "output_dir": output_dir,
+            "seed_cache": seed_cache,
+            "report_store": report_store,
+            "history": history,
+            "seed_preprocessor": seed_preprocessor,
+            "queue_config": chain_config.get("queue", {}),
+            "batch_workers": batch_workers,
+            "render_workers": render_workers,
+        }
+        return
+
+    # Build the chain once; in batch mode it is shared between all seeds
+    check_templates(
+        chain_config["chains"],
+        prompt_templates_dir,
+        common_prefix_file,
+        structured=structured,
+    )
+    if variants:
+        shared_stages = chain_config.get("shared_stages", [])
+        variant_settings = chain_config.get("variants", [])
+        problems = validate_variants(
+            chain_config["chains"],
+            shared_stages,
+            variant_settings,
+            prompt_templates_dir,
+            common_prefix_file,
+        )
+        for problem in problems:
+            click.secho(f"Variant error: {problem}", fg="red")
+        if problems:
+            exit(1)
+    if not (seed_dir or resume_run) and seed_preprocessor:
+        try:
+            seed = seed_preprocessor.process(seed)
+        except ValueError as e:
+            click.secho(f"Error: {seed_file}: {e}", fg="red")
+            exit(1)
+    import business_modeler_chains as chains
+
+    if variants:
+        shared_chain, variant_chains = chains.build_variant_chains(
+            api_key,
+            shared_stages=shared_stages,
+            variants=variant_settings,
+            **chain_options,
+        )
+    else:
+        chain = chains.build_chain(api_key, **chain_options)
+
+    if seed_dir:
+        with measure_time() as duration:
+            if bulk:
+                bulk_config = chain_config.get("bulk", {})
+                results = chains.run_bulk(
+                    chain,
+                    seed_files,
+                    output_dir,
+                    formats,
+                    chains.build_batch_client(
+                        api_key, bulk_config, backend, chain_config.get("mock")
+                    ),
+                    bulk_config.get("poll_interval", DEFAULT_BULK_POLL_INTERVAL),
+                    render_workers,
+                    report_store,
+                    history,
+                    seed_preprocessor,
+                )
+            elif distributed:
+                queue_config = chain_config.get("queue", {})
+                results = chains.run_distributed(
+                    chain,
+                    seed_files,
+                    output_dir,
+                    formats,
+                    build_task_queue(queue_config),
+                    queue_config.get("poll_interval", DEFAULT_QUEUE_POLL_INTERVAL),
+                    render_workers,
+                    report_store,
+                    history,
+                    seed_preprocessor,
+                )
+            else:
+                results = chains.run_batch(
+                    chain,
+                    seed_files,
+                    output_dir,
+                    formats,
+                    batch_workers,
+                    incremental,
+                    stream,
+                    render_workers,
+                    seed_cache,
+                    report_store,
+                    history,
+                    seed_preprocessor,
+                )
+            report_batch_results(results, duration())
+        if metrics_file:
+            write_metrics(
+                metrics_file,
+                metrics_format,
+                [
+                    {"seed_file": result["seed_file"], **record}
+                    for result in results
+                    for record in result["stages"]
+                ],
+            )
+        if any(result["error"] for result in results):
+            exit(1)
+        return
+
+    with measure_time() as duration:
+        # Execute chain
+        manifest_file = f"{output_file}.manifest.json" if incremental else None
+        monitor = chains.CallbackHandler(
+            chain_config.get("tokenizer", DEFAULT_TOKENIZER)
+        )
+        callbacks = [monitor]
+        if stream:
+            output_file = output_file or default_output_file()
+            callbacks.append(
+                chains.StreamingReportHandler(
+                    f"{output_file}.md", read_template(OUTPUT_TEMPLATE_FILE)
+                )
+            )
+        seed_match = None
+        if variants:
+            variant_outputs = chains.run_variants(
+                shared_chain, variant_chains, seed, callbacks
+            )
+            output = combine_variant_outputs(
+                {
+                    variant_label(
+                        variant,
+                        model_name,
+                        temperature,
+                        chain_config["chains"],
+                        shared_stages,
+                    ): variant_outputs[variant["name"]]
+                    for variant in variant_settings
+                }
+            )
+            sections = output
+        else:
+            # Save every stage as it finishes, so the run can be resumed if it fails
+            if not resume_run:
+                checkpoint = RunCheckpoint.create(
+                    chain_config.get("runs_dir", DEFAULT_RUNS_DIR), seed, output_file
+                )
+                checkpointed_outputs = {}
+            callbacks.append(chains.CheckpointHandler(checkpoint))
+            try:
+                fingerprint = chains.chain_fingerprint(chain) if seed_cache else None
+                seed_match = (
+                    seed_cache.lookup(seed, fingerprint) if seed_cache else None
+                )
+                output = chains.run_chain(
+                    chain,
+                    seed,
+                    manifest_file,
+                    callbacks,
+                    {
+                        **(seed_match["outputs"] if seed_match else {}),
+                        **checkpointed_outputs,
+                    },
+                )
+                if seed_cache and not seed_match:
+                    seed_cache.add(seed, output, fingerprint)
+                schemas = chains.structured_schemas(chain)
+                sections = (
+                    store_structured_outputs(output, schemas, report_store)
+                    if schemas
+                    else output
+                )
+            except BaseException as e:
+                if history:
+                    history.record(
+                        seed,
+                        checkpoint.load()[1],
+                        monitor.records,
+                        seed_file=seed_file,
+                        output_file=output_file,
+                        total_tokens=monitor.total_tokens,
+                        total_cost=monitor.total_cost,
+                        duration=duration(),
+                        error=str(e) or e.__class__.__name__,
+                    )
+                click.secho(
+                    "The run was interrupted. Resume it with: "
+                    f"--resume {checkpoint.run_id}",
+                    fg="red",
+                )
+                if isinstance(e, OutputValidationError):
+                    click.secho(f"Error: {e}", fg="red")
+                    exit(1)
+                raise
+
+        # Generate report. The run directory and spilled outputs are removed
+        # even if rendering fails, so they do not pile up.
+        try:
+            report_files = generate_report(output_file, formats, **sections)
+        finally:
+            if not variants:
+                checkpoint.remove()
+            discard_spilled(output)
+        if history:
+            history.record(
+                seed,
+                output,
+                monitor.records,
+                seed_file=seed_file,
+                # The base name of the files, which may be the default one
+                output_file=next(
+                    (os.path.splitext(name)[0] for name in report_files.values()),
+                    output_file,
+                ),
+                total_tokens=monitor.total_tokens,
+                total_cost=monitor.total_cost,
+                duration=duration(),
+            )
+
+        # Reporting on result.
+        report_results(report_files, monitor, duration(), seed_match)
+        report_stage_metrics(monitor.records)
+        if metrics_file:
+            write_metrics(
+                metrics_file,
+                metrics_format,
+                [{"seed_file": seed_file, **record} for record in monitor.records],
+            )
+
+
+@main.command()
+@click.option(
+    "--host",
+    default=DEFAULT_SERVER_HOST,
+    show_default=True,
+    help="Host the job API listens on.",
+)
+@click.option(
+    "--port",
+    default=DEFAULT_SERVER_PORT,
+    type=int,
+    show_default=True,
+    help="Port the job API listens on.",
+)
+@click.option(
+    "--socket",
+    "socket_path",
+    default=None,
+    help="Listen on this Unix socket instead of --host and --port.",
+)
+@click.pass_obj
+def serve(settings, host, port, socket_path):
+    """Run a server that generates reports for seeds submitted over HTTP.
+
+    The chain, templates and HTTP connections are set up once and shared by
+    all jobs. Up to --batch-workers jobs run at once, and their reports are
+    written to --output-dir.
+    """
+    import openai
+
+    import business_modeler_chains as chains
+
+    api_key = check_api_key() if settings["backend"] == "openai" else None
+    chain_options = settings["chain_options"]
+    check_templates(
+        chain_options["chains_config"],
+        chain_options["prompt_templates_dir"],
+        chain_options["common_prefix_file"],
+        structured=chain_options["structured"],
+    )
+    chain = chains.build_chain(api_key, **chain_options)
+    # Keep the connections to the API open between jobs
+    openai.requestssession = build_http_session(
+        max(1, settings["batch_workers"] * len(chain.chains))
+    )
+    if getattr(chain, "token_budgets", None):
+        load_tokenizer(chain.tokenizer)
+
+    with ReportRenderer(settings["render_workers"]) as renderer:
+        jobs = chains.ReportJobs(
+            chain,
+            settings["output_dir"],
+            settings["formats"],
+            settings["batch_workers"],
+            renderer,
+            seed_cache=settings["seed_cache"],
+            report_store=settings["report_store"],
+            history=settings["history"],
+            preprocessor=settings["seed_preprocessor"],
+        )
+        server = create_server(jobs, host, port, socket_path)
+        click.secho(
+            f"Serving the job API on {socket_path or f'http://{host}:{port}'}",
+            fg="green",
+        )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            jobs.shutdown()
+            if socket_path:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(socket_path)
+
+
+@main.command()
+@click.option(
+    "--worker-id",
+    default=None,
+    help="ID of this worker in the queue. Defaults to the host name and process ID.",
+)
+@click.option(
+    "--exit-when-empty",
+    is_flag=True,
+    default=False,
+    help="Stop once the queue has no pending or running tasks, instead of "
+    "waiting for new jobs.",
+)
+@click.pass_obj
+def worker(settings, worker_id, exit_when_empty):
+    """Run the tasks queued by --distributed runs.
+
+    Start any number of workers, on any host sharing the queue of the queue
+    section of the configuration file. They must use the same configuration
+    and templates as the run that queued the tasks, and the same --structured.
+    """
+    import business_modeler_chains as chains
+
+    api_key = check_api_key() if settings["backend"] == "openai" else None
+    chain_options = settings["chain_options"]
+    check_templates(
+        chain_options["chains_config"],
+        chain_options["prompt_templates_dir"],
+        chain_options["common_prefix_file"],
+        structured=chain_options["structured"],
+    )
+    chain = chains.build_chain(api_key, **chain_options)
+    queue_config = settings["queue_config"]
+    task_queue = build_task_queue(queue_config)
+    worker_id = worker_id or default_worker_id()
+    click.secho(
+        f"Worker {worker_id} is running the tasks of {task_queue.path}", fg="green"
+    )
+    try:
+        count = chains.run_worker(
+            chain,
+            task_queue,
+            worker_id,
+            queue_config.get("poll_interval", DEFAULT_QUEUE_POLL_INTERVAL),
+            exit_when_empty,
+        )
+    except KeyboardInterrupt:
+        # The lease of the task it was running expires, and another worker runs it
+        return
+    click.secho(f"Worker {worker_id} ran {count} tasks", fg="green")
+
+
+@main.command()
+@click.option(
+    "--seed-file",
+    "history_seed_file",
+    default=None,
+    help="Only list the runs of the seed in this file.",
+)
+@click.option(
+    "--search", default=None, help="Only list the runs whose seed contains this text."
+)
+@click.option(
+    "--model",
+    "model_name",
+    default=None,
+    help="Only list the runs using this model for the run or one of its stages.",
+)
+@click.option(
+    "--since",
+    default=None,
+    metavar="DATE",
+    help="Only list the runs created on or after this date (YYYY-MM-DD).",
+)
+@click.option(
+    "--min-cost",
+    default=None,
+    type=float,
+    help="Only list the runs costing at least this many dollars.",
+)
+@click.option(
+    "--limit",
+    default=20,
+    type=int,
+    show_default=True,
+    help="Maximum number of runs to list.",
+)
+@click.option(
+    "--run",
+    "run_id",
+    default=None,
+    type=int,
+    help="Show this run with its settings and the output of every stage.",
+)
+@click.option(
+    "--json", "as_json", is_flag=True, default=False, help="Print the runs as JSON."
+)
+@click.pass_obj
+def history(
+    settings,
+    history_seed_file,
+    search,
+    model_name,
+    since,
+    min_cost,
+    limit,
+    run_id,
+    as_json,
+):
+    """List the recorded runs, most recent first, or show one of them."""
+    run_history = settings["history"]
+    if run_history is None or not os.path.exists(run_history.path):
+        click.secho("No runs have been recorded.", fg="yellow")
+        return
+
+    if run_id is not None:
+        run = run_history.get(run_id)
+        if run is None:
+            click.secho(f"Error: there is no run {run_id}.", fg="red")
+            exit(1)
+        if as_json:
+            click.echo(json.dumps(run, indent=2))
+            return
+        click.secho(
+            f"Run {run['id']} of {run['created']}: {run['model_name']}, "
+            f"{run['total_tokens']} tokens, ${run['total_cost']:.2f}, "
+            f"{run['duration']:.2f} seconds",
+            fg="red" if run["error"] else "green",
+        )
+        if run["error"]:
+            click.secho(f"Error: {run['error']}", fg="red")
+        click.echo(f"Seed file: {run['seed_file']}\nReport: {run['output_file']}")
+        click.echo(f"\n{run['seed']}")
+        for stage in run["stages"]:
+            click.secho(
+                f"\n## {stage['stage']} ({stage['model']}, {stage['duration']:.2f}s, "
+                f"{stage['total_tokens']} tokens, ${stage['cost']:.2f}"
+                f"{', reused' if stage['reused'] else ''})",
+                fg="cyan",
+            )
+            click.echo(stage["output"] or stage["error"] or "")
+        return
+
+    hash_of_seed = None
+    if history_seed_file:
+        with open(history_seed_file) as f:
+            seed = f.read()
+        # Runs record the hash of the seed as it was after preprocessing
+        preprocessor = settings["seed_preprocessor"]
+        if preprocessor:
+            try:
+                seed = preprocessor.process(seed)
+            except ValueError as e:
+                click.secho(f"Error: {history_seed_file}: {e}", fg="red")
+                exit(1)
+        hash_of_seed = seed_hash(seed)
+    runs = run_history.query(
+        seed_hash=hash_of_seed,
+        search=search,
+        model_name=model_name,
+        since=since,
+        min_cost=min_cost,
+        limit=limit,
+    )
+    for run in runs:
+        if as_json:
+            click.echo(json.dumps(run))
+            continue
+        seed_line = (run.pop("seed_start") or "").strip().split("\n")[0][:50]
+        click.secho(
+            f"{run['id']:>6}  {run['created'][:19]}  {run['model_name'] or '':<20} "
+            f"{run['total_tokens']:>7} tokens  ${run['total_cost']:>6.2f}  "
+            f"{run['duration']:>7.2f}s  {seed_line}",
+            fg="red" if run["error"] else None,
+        )
 
 
 if __name__ == "__main__":
+    # business_modeler_chains imports this module by name; make it share this
+    # instance instead of loading the script a second time
+    sys.modules.setdefault("business_modeler", sys.modules[__name__])
     load_dotenv()
     main()
@@ -0,0 +1,3036 @@
+"""
+The language model pipeline of the business modeler: the chains, the language
+model backends and callbacks, and running them for seeds.
+
+business_modeler imports this module only when it runs a chain, so that the
+command line starts without loading langchain and openai.
+"""
+
+import collections
+import contextlib
+import contextvars
+import functools
+import hashlib
+import json
+import os
+import queue
+import random
+import re
+import string
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import click
+import openai
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.callbacks.manager import CallbackManager, CallbackManagerForChainRun
+from langchain.callbacks.openai_info import (
+    MODEL_COST_PER_1K_TOKENS,
+    get_openai_token_cost_for_model,
+    standardize_model_name,
+)
+from langchain.chains import LLMChain, SequentialChain
+from langchain.chat_models import ChatOpenAI
+from langchain.chat_models.base import BaseChatModel
+from langchain.load.dump import dumpd
+from langchain.prompts import PromptTemplate
+from langchain.schema import AIMessage, ChatGeneration, ChatResult, HumanMessage
+
+from business_modeler import (
+    DEFAULT_BACKEND,
+    DEFAULT_BULK_DIR,
+    DEFAULT_BULK_POLL_INTERVAL,
+    DEFAULT_MAX_CONCURRENCY,
+    DEFAULT_MAX_JOBS,
+    DEFAULT_MAX_RETRIES,
+    DEFAULT_QUEUE_POLL_INTERVAL,
+    DEFAULT_RENDER_WORKERS,
+    DEFAULT_TOKENIZER,
+    DEFAULT_VALIDATION_RETRIES,
+    LIST_ITEM,
+    NON_SEMANTIC_LLM_PARAMS,
+    OUTPUT_TEMPLATE_FILE,
+    OutputSpill,
+    OutputValidationError,
+    ReportRenderer,
+    ResponseCache,
+    build_dependency_graph,
+    compact_inputs,
+    copy_duplicate_reports,
+    count_tokens,
+    discard_spilled,
+    find_duplicate_seeds,
+    generate_report,
+    get_template_registry,
+    load_manifest,
+    load_stage_schema,
+    measure_time,
+    parse_structured_output,
+    read_seed,
+    read_seeds,
+    read_template,
+    resolve_output,
+    save_manifest,
+    seed_hash,
+    store_structured_outputs,
+    structured_instructions,
+    validate_document,
+    validate_output,
+)
+
+# Language model settings a chain in the configuration can set for itself,
+# besides its model_name and temperature
+STAGE_LLM_SETTINGS = ("max_tokens", "request_timeout")
+
+# Requests sent through the Batch API cost half as much as synchronous ones
+BATCH_COST_FACTOR = 0.5
+# Statuses of a batch that will not change any more
+BATCH_FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+# Errors of the OpenAI API that are worth retrying
+RETRYABLE_ERRORS = (
+    openai.error.Timeout,
+    openai.error.APIError,
+    openai.error.APIConnectionError,
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+)
+
+# The name of the variant whose stages run in the current context, set by
+# run_variants so CallbackHandler can label their records
+current_variant = contextvars.ContextVar("current_variant", default=None)
+
+
+def create_llm_chain(
+    llm,
+    template_file,
+    prompt_templates_dir,
+    common_prefix_file,
+    schema=None,
+    input_fields=None,
+):
+    """
+    Create and return an LLMChain instance configured with the given parameters.
+
+    Parameters:
+    - llm (ChatOpenAI): An instance of ChatOpenAI which is used to perform the language model operations.
+    - template_file (str): The name of the template file to be used for prompt creation.
+    - prompt_templates_dir (str): Directory path containing prompt template files.
+    - common_prefix_file (str): Name of the file containing common prefix content to be appended before the template.
+    - schema (dict, optional): If given, the chain responds with a JSON document matching this JSON schema, and a StructuredLLMChain is returned.
+    - input_fields (dict, optional): The fields of the structured inputs to include in the prompt of a StructuredLLMChain.
+
+    Returns:
+    - LLMChain: An instance of LLMChain configured with the given parameters.
+    """
+    # The template's variable names are its input_keys
+    template = get_template_registry(prompt_templates_dir, common_prefix_file).prompt(
+        template_file
+    )
+    # Set output_key as the name of the template file without the file extension
+    output_key = os.path.splitext(template_file)[0]
+    if schema is None:
+        return LLMChain(
+            llm=llm,
+            prompt=PromptTemplate(
+                input_variables=template.variables, template=template.text
+            ),
+            output_key=output_key,
+            tags=[output_key],
+        )
+
+    # The braces of the schema are not template variables
+    instructions = structured_instructions(schema).replace("{", "{{").replace("}", "}}")
+    return StructuredLLMChain(
+        llm=llm,
+        prompt=PromptTemplate(
+            input_variables=template.variables,
+            template=template.text + instructions,
+        ),
+        output_key=output_key,
+        tags=[output_key],
+        output_schema=schema,
+        input_fields=input_fields or {},
+    )
+
+
+def select_fields(text, fields):
+    """
+    Keep only some fields of a JSON object.
+
+    Parameters:
+    - text (str): The JSON text of the object.
+    - fields (list): The names of the fields to keep.
+
+    Returns:
+    - str: The JSON text of the object with only those fields, or the text
+      unchanged if it is not a JSON object (e.g. shortened to fit a token budget).
+    """
+    try:
+        document = json.loads(text)
+    except ValueError:
+        return text
+    if not isinstance(document, dict):
+        return text
+    return json.dumps(
+        {field: document[field] for field in fields if field in document},
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+
+
+class StructuredLLMChain(LLMChain):
+    """
+    LLMChain responding with a JSON document that is validated against a schema.
+
+    The output is the document as compact JSON text, so it is cached,
+    checkpointed and passed to the chains depending on it like any other
+    output. Those chains can include only some fields of it in their prompts.
+
+    Attributes:
+        output_schema (dict): The JSON schema of the output.
+        input_fields (dict): For inputs holding the JSON output of another chain,
+            the fields to include in the prompt; other inputs are included whole.
+    """
+
+    output_schema: Dict[str, Any]
+    input_fields: Dict[str, List[str]] = {}
+
+    def select_inputs(self, inputs):
+        """
+        Return the inputs with only the input_fields of the structured inputs.
+        """
+        return {
+            key: select_fields(value, self.input_fields[key])
+            if key in self.input_fields
+            else value
+            for key, value in inputs.items()
+        }
+
+    def parse_output(self, text):
+        """
+        Parse and validate a response of the language model.
+
+        Parameters:
+        - text (str): The response.
+
+        Returns:
+        - str: The document as compact JSON text.
+
+        Raises:
+        - ValueError: If the response is not valid JSON or does not match the schema.
+        """
+        try:
+            document = parse_structured_output(text)
+        except ValueError as e:
+            raise ValueError(
+                f"The output of chain '{self.output_key}' is not valid JSON: {e}"
+            ) from e
+        problems = validate_document(document, self.output_schema)
+        if problems:
+            raise ValueError(
+                f"The output of chain '{self.output_key}' does not match its "
+                f"schema: {'; '.join(problems[:5])}"
+            )
+        return json.dumps(document, ensure_ascii=False, separators=(",", ":"))
+
+    def _call(
+        self,
+        inputs: Dict[str, Any],
+        run_manager: Optional[CallbackManagerForChainRun] = None,
+    ) -> Dict[str, str]:
+        text = super()._call(inputs, run_manager)[self.output_key]
+        return {self.output_key: self.parse_output(text)}
+
+
+def format_prompt(chain, inputs):
+    """
+    Return the prompt of an LLMChain for the given inputs.
+
+    Parameters:
+    - chain (LLMChain): The chain.
+    - inputs (dict): The inputs of the chain; others are ignored.
+
+    Returns:
+    - str: The rendered prompt.
+    """
+    return chain.prompt.format(
+        **{key: inputs[key] for key in chain.prompt.input_variables}
+    )
+
+
+def structured_schemas(chain):
+    """
+    Return the JSON schema of every stage of a chain built for structured output.
+
+    Parameters:
+    - chain (Chain): The chain.
+
+    Returns:
+    - dict: The schema of every StructuredLLMChain, by output key; empty if
+      the chain does not produce structured output.
+    """
+    return {
+        stage.output_key: stage.output_schema
+        for stage in getattr(chain, "chains", [])
+        if isinstance(stage, StructuredLLMChain)
+    }
+
+
+def stage_fingerprints(chain, inputs):
+    """
+    Compute a fingerprint for every stage of a chain.
+
+    A stage's fingerprint covers its prompt template, its language model
+    parameters, its token budget, the external inputs it uses and the
+    fingerprints of the stages it depends on. It therefore changes whenever the stage or anything upstream
+    of it changes.
+
+    Parameters:
+    - chain (SequentialChain): The chain whose stages are fingerprinted.
+    - inputs (dict): The external inputs of the chain (e.g. the seed).
+
+    Returns:
+    - dict: A mapping of output key to fingerprint. Stages that are not LLMChains
+      cannot be fingerprinted and are left out.
+    """
+    graph = build_dependency_graph(chain.chains)
+    token_budgets = getattr(chain, "token_budgets", {})
+    fingerprints = {}
+    for stage in chain.chains:
+        if not isinstance(stage, LLMChain):
+            continue
+        upstream = graph[stage.output_key]
+        if not all(key in fingerprints for key in upstream):
+            continue
+        llm_params = {
+            k: v
+            for k, v in stage.llm._identifying_params.items()
+            if k not in NON_SEMANTIC_LLM_PARAMS
+        }
+        fingerprint = {
+            "template": stage.prompt.template,
+            "llm": llm_params,
+            "inputs": {
+                key: inputs[key] for key in stage.input_keys if key not in graph
+            },
+            "upstream": {key: fingerprints[key] for key in upstream},
+        }
+        # Budgets change the prompt, but leave fingerprints without one unchanged
+        if stage.output_key in token_budgets:
+            fingerprint["token_budget"] = token_budgets[stage.output_key]
+        if getattr(stage, "input_fields", None):
+            fingerprint["input_fields"] = stage.input_fields
+        payload = json.dumps(
+            fingerprint,
+            sort_keys=True,
+            default=str,
+        )
+        fingerprints[stage.output_key] = hashlib.sha256(
+            payload.encode("utf-8")
+        ).hexdigest()
+    return fingerprints
+
+
+def chain_fingerprint(chain):
+    """
+    Compute a fingerprint of a chain, which is the same for two chains
+    generating the same outputs for a seed: it covers the fingerprints of
+    all its stages (see stage_fingerprints) and the language model backend
+    of each.
+
+    Parameters:
+    - chain (SequentialChain): The chain.
+
+    Returns:
+    - str: The fingerprint, as a hex digest.
+    """
+    # The stage fingerprints for any seed, as all stages would use the same one
+    fingerprints = stage_fingerprints(chain, collections.defaultdict(str))
+    backends = {
+        stage.output_key: stage.llm._llm_type
+        for stage in chain.chains
+        if isinstance(stage, LLMChain)
+    }
+    payload = json.dumps([fingerprints, backends], sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def run_chain(chain, seed, manifest_file=None, callbacks=None, outputs=None):
+    """
+    Runs the chain for a seed, optionally reusing the outputs of unchanged stages.
+
+    When a manifest file is given, stages whose fingerprint matches the one
+    recorded in the manifest reuse their recorded output instead of being run
+    again, and the manifest is updated with the results of this run.
+
+    Parameters:
+    - chain (SequentialChain): The chain to run.
+    - seed (str): The contents of the seed file.
+    - manifest_file (str, optional): The path to the run manifest.
+    - callbacks (list, optional): Callback handlers for this run.
+    - outputs (dict, optional): Outputs of stages that already ran, e.g. in an
+      interrupted run, which are reused instead of being run again.
+
+    Returns:
+    - dict: The output of the chain.
+    """
+    inputs = {"seed": seed}
+    if manifest_file is None:
+        return chain({**inputs, **(outputs or {})}, callbacks=callbacks)
+
+    stages = load_manifest(manifest_file)["stages"]
+    fingerprints = stage_fingerprints(chain, inputs)
+    reused = {
+        key: stages[key]["output"]
+        for key, fingerprint in fingerprints.items()
+        if stages.get(key, {}).get("fingerprint") == fingerprint
+    }
+    output = chain({**inputs, **reused, **(outputs or {})}, callbacks=callbacks)
+    save_manifest(
+        manifest_file,
+        {
+            "stages": {
+                key: {
+                    "fingerprint": fingerprint,
+                    "output": resolve_output(output[key]),
+                }
+                for key, fingerprint in fingerprints.items()
+            }
+        },
+    )
+    return output
+
+
+def is_list_prefix(prefix, output):
+    """
+    Check whether an output starts with a prefix and lists no further items.
+
+    Text after the prefix that is not a list item, such as a closing remark,
+    does not change the list, so a chain run on the prefix can be kept.
+
+    Parameters:
+    - prefix (str): The start of the output a speculative chain ran on.
+    - output (str): The whole output.
+
+    Returns:
+    - bool: True if the list in the output is the one in the prefix.
+    """
+    return output.startswith(prefix) and not any(
+        LIST_ITEM.match(line) for line in output[len(prefix) :].splitlines()
+    )
+
+
+class SpeculationCancelled(Exception):
+    """Raised to stop a chain that started early on an upstream output that changed."""
+
+
+class ListPrefixHandler(BaseCallbackHandler):
+    """
+    Callback handler following the list items of a streamed output.
+
+    Once the output has listed a number of items that a speculative chain is
+    waiting for, the text up to the end of that item is passed to on_prefix.
+
+    Attributes:
+        output_key (str): The output key of the chain being followed.
+        thresholds (list): The numbers of list items to report the prefix at.
+        on_prefix (callable): Called with the output key, the number of items
+            and the text listing them.
+    """
+
+    def __init__(self, output_key, thresholds, on_prefix):
+        self.output_key = output_key
+        self.thresholds = sorted(set(thresholds))
+        self.on_prefix = on_prefix
+        self._text = ""
+        self._lines = 0
+        self._items = 0
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> Any:
+        self._text += token
+        lines = self._text.split("\n")[:-1]
+        for line in lines[self._lines :]:
+            self._lines += 1
+            if not LIST_ITEM.match(line):
+                continue
+            self._items += 1
+            if self._items in self.thresholds:
+                prefix = "\n".join(lines[: self._lines]) + "\n"
+                self.on_prefix(self.output_key, self._items, prefix)
+
+
+class CancelHandler(BaseCallbackHandler):
+    """
+    Callback handler stopping a streamed language model call once cancelled.
+    """
+
+    raise_error = True
+
+    def __init__(self, stage, cancelled):
+        self.stage = stage
+        self.cancelled = cancelled
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> Any:
+        if self.cancelled.is_set():
+            raise SpeculationCancelled(
+                f"Stopped the early run of chain '{self.stage}', "
+                "as the output it started from changed"
+            )
+
+
+class DependencyGraphChain(SequentialChain):
+    """
+    SequentialChain that runs each chain as soon as all of its inputs exist.
+
+    The chains are validated exactly like a SequentialChain, but instead of
+    running them one after another, the dependency graph implied by their
+    input and output keys is used to dispatch independent chains concurrently
+    on a thread pool.
+
+    Attributes:
+        max_workers (int, optional): Maximum number of chains running at once.
+            Defaults to the number of chains.
+        cache (ResponseCache, optional): Cache for the outputs of LLMChains.
+        refresh_stages (list): Output keys of the chains that must bypass the
+            cache lookup; their fresh output is still stored in the cache.
+        token_budgets (dict): Maximum prompt tokens per output key. The inputs
+            of a chain whose prompt would exceed its budget are compacted.
+        tokenizer (str): Name of the tokenizer used to count prompt tokens.
+        speculation (dict): For the output keys of chains that may start before
+            their upstream chains finish, the number of list items each of
+            those upstream chains must have streamed first. The chain then runs
+            on that prefix of the upstream output. Its output is kept if the
+            upstream output lists no further items (see is_list_prefix);
+            otherwise it is stopped or discarded, and the chain runs again on
+            the whole upstream output.
+        spill_dir (str, optional): If set, every output is written to a run
+            directory in spill_dir as soon as it is generated, and only kept in
+            memory until the chains using it have started. The chain then
+            returns SpilledOutput handles instead of the outputs; their files
+            are removed with discard_spilled.
+        validators (dict): The rules of validate_output the outputs of LLMChains
+            must follow, by output key. An output that breaks them is never
+            cached; unless the rules set on_failure to "retry", the run is
+            aborted before the chains depending on it start.
+    """
+
+    max_workers: Optional[int] = None
+    cache: Optional[Any] = None
+    refresh_stages: List[str] = []
+    token_budgets: Dict[str, int] = {}
+    tokenizer: str = DEFAULT_TOKENIZER
+    speculation: Dict[str, Dict[str, int]] = {}
+    spill_dir: Optional[str] = None
+    validators: Dict[str, Dict[str, Any]] = {}
+
+    def _call(
+        self,
+        inputs: Dict[str, str],
+        run_manager: Optional[CallbackManagerForChainRun] = None,
+    ) -> Dict[str, Any]:
+        spill = OutputSpill(self.spill_dir) if self.spill_dir else None
+        try:
+            return self._run_graph(inputs, run_manager, spill)
+        except BaseException:
+            if spill:
+                spill.remove()
+            raise
+
+    def _run_graph(self, inputs, run_manager, spill):
+        known_values = inputs.copy()
+        _run_manager = run_manager or CallbackManagerForChainRun.get_noop_manager()
+        graph = build_dependency_graph(self.chains)
+        pending = list(self.chains)
+        # Running chains, with the upstream prefixes they started from (empty
+        # unless speculative) and the event that cancels them
+        running = {}
+        # Prefixes of upstream outputs, by output key and number of list items
+        prefixes = collections.defaultdict(dict)
+        # Outputs of speculative chains waiting for their upstream outputs
+        finished = {}
+        # Finished futures and new prefixes, in the order they happen
+        events = queue.Queue()
+        # Handles of the outputs written to the spill directory
+        spilled = {}
+
+        def store(outputs):
+            known_values.update(outputs)
+            if spill:
+                for key, value in outputs.items():
+                    spilled[key] = spill.write(key, value)
+                evict()
+
+        def evict():
+            # Only keep the outputs that chains yet to start need in memory
+            needed = {key for chain in pending for key in chain.input_keys}
+            for key, handle in spilled.items():
+                if key not in needed:
+                    known_values[key] = handle
+
+        # Outputs passed in as inputs (e.g. from a previous run) are not
+        # recomputed, unless they fail validation
+        for chain in [c for c in pending if set(c.output_keys) <= set(inputs)]:
+            if isinstance(chain, LLMChain) and self.output_problems(
+                chain, resolve_output(inputs[chain.output_key])
+            ):
+                click.secho(
+                    f"Running chain '{chain.output_key}' again, as its earlier "
+                    "output failed validation",
+                    fg="yellow",
+                )
+                del known_values[chain.output_key]
+                continue
+            pending.remove(chain)
+            self._report_reused(
+                chain,
+                {key: inputs[key] for key in chain.input_keys if key in inputs},
+                {key: inputs[key] for key in chain.output_keys},
+                _run_manager.get_child(),
+            )
+
+        # The thresholds at which the outputs of upstream chains are reported
+        thresholds = collections.defaultdict(list)
+        for key, upstream_items in self.speculation.items():
+            for upstream, items in upstream_items.items():
+                thresholds[upstream].append(items)
+
+        def diverged(used):
+            return any(
+                upstream in known_values
+                and not is_list_prefix(prefix, resolve_output(known_values[upstream]))
+                for upstream, prefix in used.items()
+            )
+
+        with ThreadPoolExecutor(
+            max_workers=self.max_workers or len(self.chains)
+        ) as executor:
+
+            def submit(chain, values, used):
+                if spill:
+                    values = {
+                        key: resolve_output(value)
+                        for key, value in values.items()
+                        if key in chain.input_keys
+                    }
+                callbacks = _run_manager.get_child()
+                key = "".join(chain.output_keys)
+                if key in thresholds:
+                    callbacks.add_handler(
+                        ListPrefixHandler(
+                            key,
+                            thresholds[key],
+                            lambda *prefix: events.put(prefix),
+                        )
+                    )
+                cancelled = threading.Event()
+                if used:
+                    callbacks.add_handler(CancelHandler(key, cancelled))
+                future = executor.submit(
+                    # Copy the context so that callbacks registered through
+                    # context variables (e.g. get_openai_callback) still see
+                    # the calls made on the worker threads.
+                    contextvars.copy_context().run,
+                    self._run_stage,
+                    chain,
+                    values,
+                    callbacks,
+                )
+                running[future] = (chain, used, cancelled)
+                future.add_done_callback(events.put)
+
+            try:
+                while pending or running:
+                    for chain in list(pending):
+                        used = self._speculation_inputs(
+                            chain, graph, known_values, prefixes
+                        )
+                        if used is not None:
+                            pending.remove(chain)
+                            submit(chain, {**known_values, **used}, used)
+                    if spill:
+                        evict()
+
+                    event = events.get()
+                    if isinstance(event, tuple):
+                        output_key, items, prefix = event
+                        prefixes[output_key][items] = prefix
+                        continue
+                    if event not in running:
+                        # A speculative chain that was cancelled
+                        continue
+                    chain, used, _ = running.pop(event)
+                    if used:
+                        finished["".join(chain.output_keys)] = (
+                            chain,
+                            used,
+                            event.result(),
+                        )
+                    else:
+                        store(event.result())
+
+                    # Keep the speculative outputs whose upstream outputs ended
+                    # where they started, and run the others again
+                    settled = True
+                    while settled:
+                        settled = False
+                        for key, (chain, used, outputs) in list(finished.items()):
+                            if diverged(used):
+                                del finished[key]
+                                self._rerun(chain, pending)
+                            elif all(upstream in known_values for upstream in used):
+                                del finished[key]
+                                store(outputs)
+                                settled = True
+                    for future, (chain, used, cancelled) in list(running.items()):
+                        if used and diverged(used):
+                            del running[future]
+                            cancelled.set()
+                            self._rerun(chain, pending)
+            finally:
+                for _, _, cancelled in running.values():
+                    cancelled.set()
+
+        return {k: known_values[k] for k in self.output_variables}
+
+    def _speculation_inputs(self, chain, graph, known_values, prefixes):
+        # Return the upstream prefixes a pending chain can start from, an empty
+        # dict if all of its inputs are known, or None if it has to wait
+        key = "".join(chain.output_keys)
+        missing = [upstream for upstream in graph[key] if upstream not in known_values]
+        if not missing:
+            return {}
+        speculation = self.speculation.get(key, {})
+        if any(
+            speculation.get(upstream) not in prefixes.get(upstream, {})
+            for upstream in missing
+        ):
+            return None
+        return {
+            upstream: prefixes[upstream][speculation[upstream]] for upstream in missing
+        }
+
+    @staticmethod
+    def _rerun(chain, pending):
+        click.secho(
+            f"Running chain '{''.join(chain.output_keys)}' again, as the output "
+            "it started from early changed",
+            fg="yellow",
+        )
+        pending.append(chain)
+
+    def prepare_inputs(self, chain, inputs):
+        """
+        Return the inputs of an LLMChain as they go into its prompt: only the
+        fields a structured chain uses, compacted to fit its token budget.
+        """
+        if isinstance(chain, StructuredLLMChain):
+            inputs = chain.select_inputs(inputs)
+
+        budget = self.token_budgets.get(chain.output_key)
+        if budget is not None:
+            inputs = self._compact_inputs(chain, inputs, budget)
+        return inputs
+
+    def cached_output(self, chain, prompt):
+        """
+        Look up the cached output of an LLMChain for a prompt.
+
+        Returns:
+        - tuple: The cache key, or None without a cache, and the cached output,
+          or None if there is none or the chain is refreshed.
+        """
+        if self.cache is None:
+            return None, None
+        key = ResponseCache.make_key(prompt, chain.llm._identifying_params)
+        if chain.output_key in self.refresh_stages:
+            return key, None
+        return key, self.cache.get(key)
+
+    def output_problems(self, chain, text):
+        """
+        Check the output of an LLMChain against its validators.
+
+        Returns:
+        - list: A description of every problem found; empty if there are none.
+        """
+        rules = self.validators.get(chain.output_key)
+        return validate_output(text, rules) if rules else []
+
+    def validation_retries(self, chain):
+        """
+        Return the number of times an LLMChain runs again when its output fails
+        validation.
+        """
+        rules = self.validators.get(chain.output_key, {})
+        if rules.get("on_failure") != "retry":
+            return 0
+        return rules.get("max_retries", DEFAULT_VALIDATION_RETRIES)
+
+    def run_stage(self, output_key, inputs, callbacks=None):
+        """
+        Run one chain on its own, as a task of a distributed run. It is cached
+        and validated as in a regular run.
+
+        Parameters:
+        - output_key (str): The output key of the chain.
+        - inputs (dict): The external inputs and the outputs of its upstream chains.
+        - callbacks (list, optional): Callback handlers, e.g. a CallbackHandler.
+
+        Returns:
+        - dict: The outputs of the chain.
+
+        Raises:
+        - ValueError: If no chain has this output key.
+        """
+        chains = {key: chain for chain in self.chains for key in chain.output_keys}
+        if output_key not in chains:
+            raise ValueError(f"There is no chain '{output_key}'")
+        return self._run_stage(
+            chains[output_key], inputs, CallbackManager.configure(callbacks)
+        )
+
+    def _run_stage(self, chain, inputs, callbacks):
+        if not isinstance(chain, LLMChain):
+            return chain(inputs, return_only_outputs=True, callbacks=callbacks)
+
+        inputs = self.prepare_inputs(chain, inputs)
+        if self.cache is not None:
+            key, cached = self.cached_output(chain, format_prompt(chain, inputs))
+            if cached is not None and not self.output_problems(chain, cached):
+                outputs = {chain.output_key: cached}
+                self._report_reused(chain, inputs, outputs, callbacks)
+                return outputs
+
+        retries = self.validation_retries(chain)
+        for attempt in range(retries + 1):
+            try:
+                outputs = self._call_validated(chain, inputs, callbacks)
+                break
+            except OutputValidationError as e:
+                if attempt == retries:
+                    raise
+                click.secho(
+                    f"Running chain '{chain.output_key}' again, as its output "
+                    f"{'; '.join(e.problems)}",
+                    fg="yellow",
+                )
+
+        if self.cache is not None:
+            self.cache.put(key, outputs[chain.output_key])
+        return outputs
+
+    def _call_validated(self, chain, inputs, callbacks):
+        # Call an LLMChain like Chain.__call__ does, but validate its output
+        # before the callbacks see it, so an output failing validation is
+        # reported as an error and never checkpointed or streamed
+        if not self.validators.get(chain.output_key):
+            return chain(inputs, return_only_outputs=True, callbacks=callbacks)
+        inputs = chain.prep_inputs(inputs)
+        run_manager = CallbackManager.configure(
+            callbacks, chain.callbacks, chain.verbose, None, chain.tags
+        ).on_chain_start(dumpd(chain), inputs)
+        try:
+            outputs = chain._call(inputs, run_manager=run_manager)
+            problems = self.output_problems(chain, outputs[chain.output_key])
+            if problems:
+                raise OutputValidationError(chain.output_key, problems)
+        except (KeyboardInterrupt, Exception) as e:
+            run_manager.on_chain_error(e)
+            raise
+        run_manager.on_chain_end(outputs)
+        return chain.prep_outputs(inputs, outputs, return_only_outputs=True)
+
+    def _compact_inputs(self, chain, inputs, budget):
+        count = functools.partial(count_tokens, tokenizer_name=self.tokenizer)
+        compacted = compact_inputs(chain.prompt, inputs, budget, count)
+        if compacted != inputs:
+            click.secho(
+                f"Compacted the inputs of chain '{chain.output_key}' "
+                f"to fit its budget of {budget} tokens",
+                fg="yellow",
+            )
+        return compacted
+
+    @staticmethod
+    def _report_reused(chain, inputs, outputs, callbacks):
+        # Report a stage whose output was reused to the callbacks like a regular
+        # run, tagged with the stage name and flagged as reused
+        stage = "".join(chain.output_keys)
+        callbacks.add_tags([stage], False)
+        run_manager = callbacks.on_chain_start({"name": stage, "reused": True}, inputs)
+        run_manager.on_chain_end(outputs)
+
+
+def mock_document(schema, count, label):
+    """
+    Build a JSON document matching a JSON schema, for mock_response.
+
+    Parameters:
+    - schema (dict): The JSON schema.
+    - count (int): The number of items of lists without a maxItems.
+    - label (str): The text the strings of the document start with.
+
+    Returns:
+    - The document.
+    """
+    label = schema.get("title", label)
+    if schema.get("type") == "object":
+        return {
+            key: mock_document(field, count, key.replace("_", " ").capitalize())
+            for key, field in schema.get("properties", {}).items()
+        }
+    if schema.get("type") == "array":
+        items = schema.get("items", {})
+        return [
+            mock_document(items, count, f"{label} item {i}")
+            for i in range(1, schema.get("maxItems", count) + 1)
+        ]
+    if schema.get("type") in ("integer", "number"):
+        return count
+    if schema.get("type") == "boolean":
+        return True
+    return f"{label}."
+
+
+def mock_response(prompt):
+    """
+    Build a canned response for a prompt from the instructions in its template.
+
+    The response is a markdown section titled as the template asks for, with as
+    many list items as the template asks to list. If the prompt asks for a JSON
+    document matching a schema instead, the response is such a document.
+
+    Parameters:
+    - prompt (str): The rendered prompt.
+
+    Returns:
+    - str: The canned markdown or JSON response.
+    """
+    title = re.search(r'title[^"]*"([^"]+)"', prompt)
+    title = title.group(1).rstrip(".") if title else "Response"
+    count = re.search(r"\b(?:List|list)\D*?(\d+)", prompt)
+    count = int(count.group(1)) if count else 10
+    schema = re.search(r"JSON schema:\n(.*)\Z", prompt, re.DOTALL)
+    if schema:
+        return json.dumps(mock_document(json.loads(schema.group(1)), count, title))
+    items = "\n".join(f"{i}. {title} item {i}." for i in range(1, count + 1))
+    return f"# {title}\n\n{items}\n"
+
+
+class MockChatModel(BaseChatModel):
+    """
+    Offline stand-in for ChatOpenAI, used to measure the pipeline's own overhead.
+
+    Responses are built from the prompt's template by mock_response, unless a
+    canned response is configured for the requested section title. Latency and
+    generation speed are simulated, and token usage is reported like the
+    OpenAI API does, counting whitespace separated words as tokens; like the
+    API, streamed responses report none.
+
+    Attributes:
+        model_name (str): The model name reported in the token usage.
+        latency (float): Seconds to wait before the first token.
+        tokens_per_second (float): Simulated generation speed; 0 is instant.
+        streaming (bool): If True, tokens are streamed to the callbacks.
+        responses (dict): Canned responses keyed by section title.
+    """
+
+    model_name: str = "mock"
+    latency: float = 0.0
+    tokens_per_second: float = 0.0
+    streaming: bool = False
+    responses: Dict[str, str] = {}
+
+    @property
+    def _llm_type(self) -> str:
+        return "mock-chat"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"model_name": self.model_name}
+
+    def _combine_llm_outputs(self, llm_outputs: List[Optional[dict]]) -> dict:
+        token_usage: Dict[str, int] = {}
+        for llm_output in llm_outputs:
+            for key, value in (llm_output or {}).get("token_usage", {}).items():
+                token_usage[key] = token_usage.get(key, 0) + value
+        return {"token_usage": token_usage, "model_name": self.model_name}
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        prompt = "\n".join(message.content for message in messages)
+        title = re.search(r'title[^"]*"([^"]+)"', prompt)
+        text = self.responses.get(title.group(1).rstrip(".") if title else None)
+        text = text or mock_response(prompt)
+
+        time.sleep(self.latency)
+        tokens = re.findall(r"\S+\s*", text)
+        for token in tokens:
+            if self.tokens_per_second:
+                time.sleep(1 / self.tokens_per_second)
+            if self.streaming and run_manager:
+                run_manager.on_llm_new_token(token)
+
+        generations = [ChatGeneration(message=AIMessage(content=text))]
+        if self.streaming:
+            # Like the OpenAI API, streamed responses have no token usage
+            return ChatResult(generations=generations)
+        return ChatResult(
+            generations=generations,
+            llm_output={
+                "token_usage": {
+                    "prompt_tokens": len(prompt.split()),
+                    "completion_tokens": len(tokens),
+                    "total_tokens": len(prompt.split()) + len(tokens),
+                },
+                "model_name": self.model_name,
+            },
+        )
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        return self._generate(messages, stop=stop, **kwargs)
+
+
+class RateLimiter:
+    """
+    Process-wide scheduler for the requests made to one model.
+
+    Requests wait for a free slot before they are sent, so that no more than
+    `concurrency` run at once and the requests and tokens sent in the last
+    minute stay within the configured budgets. Failed requests are retried
+    with jittered exponential backoff. Rate limit errors halve the concurrency
+    and honour their Retry-After header; every successful request raises the
+    concurrency by one again, up to max_concurrency. The budgets are lowered
+    to the limits reported in the headers of every response (see
+    update_limits).
+
+    Attributes:
+        requests_per_minute (int): Maximum requests per minute, or None.
+        tokens_per_minute (int): Maximum tokens per minute, or None.
+        max_concurrency (int): Maximum number of requests running at once.
+        concurrency (int): Current number of requests allowed to run at once.
+        max_retries (int): Number of times a failed request is retried.
+        window (float): Length of the rate limit window in seconds.
+    """
+
+    window = 60.0
+
+    def __init__(
+        self,
+        requests_per_minute=None,
+        tokens_per_minute=None,
+        max_concurrency=DEFAULT_MAX_CONCURRENCY,
+        max_retries=DEFAULT_MAX_RETRIES,
+        min_backoff=1.0,
+        max_backoff=60.0,
+    ):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_concurrency = max_concurrency
+        self.concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self._running = 0
+        # [start time, tokens] of the requests sent within the window
+        self._requests = collections.deque()
+        self._condition = threading.Condition()
+
+    def _wait_time(self, tokens, now):
+        # Seconds until a request of this size may be sent, None if it must
+        # wait for a running request to finish
+        while self._requests and now - self._requests[0][0] >= self.window:
+            self._requests.popleft()
+        if self._running >= self.concurrency:
+            return None
+
+        wait_time = 0.0
+        if self.requests_per_minute and len(self._requests) >= self.requests_per_minute:
+            oldest = self._requests[len(self._requests) - self.requests_per_minute]
+            wait_time = oldest[0] + self.window - now
+        if self.tokens_per_minute:
+            excess = sum(t for _, t in self._requests) + tokens - self.tokens_per_minute
+            for start, used in self._requests:
+                if excess <= 0:
+                    break
+                excess -= used
+                wait_time = max(wait_time, start + self.window - now)
+        return wait_time
+
+    def acquire(self, tokens):
+        """
+        Wait until a request of the given size may be sent and reserve it.
+
+        Parameters:
+        - tokens (int): The estimated number of tokens of the request.
+
+        Returns:
+        - list: The reservation, to be passed to release.
+        """
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                wait_time = self._wait_time(tokens, now)
+                if wait_time is not None and wait_time <= 0:
+                    break
+                self._condition.wait(wait_time)
+            self._running += 1
+            reservation = [now, tokens]
+            self._requests.append(reservation)
+            return reservation
+
+    def release(self, reservation, tokens=None):
+        """
+        Mark a request as finished, correcting its size if it is known.
+
+        Parameters:
+        - reservation (list): The reservation returned by acquire.
+        - tokens (int, optional): The number of tokens the request actually used.
+
+        Returns:
+        - None
+        """
+        with self._condition:
+            self._running -= 1
+            if tokens is not None:
+                reservation[1] = tokens
+            self._condition.notify_all()
+
+    def call(self, request, tokens, used_tokens=None, stream=False):
+        """
+        Send a request through the scheduler, retrying it if it fails.
+
+        Parameters:
+        - request (callable): Function sending the request.
+        - tokens (int): The estimated number of tokens of the request.
+        - used_tokens (callable, optional): Function returning the number of
+          tokens used from the response, or from the list of its chunks if it
+          is streamed.
+        - stream (bool, optional): If True, the response is an iterator and the
+          request is running until it is exhausted.
+
+        Returns:
+        - Any: The response.
+        """
+        for attempt in range(self.max_retries + 1):
+            reservation = self.acquire(tokens)
+            try:
+                response = request()
+            except RETRYABLE_ERRORS as e:
+                self.release(reservation)
+                delay = self._backoff(attempt, e)
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(delay)
+                continue
+            except BaseException:
+                self.release(reservation)
+                raise
+
+            with self._condition:
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+            if stream:
+                return self._release_when_exhausted(reservation, response, used_tokens)
+            self.release(reservation, used_tokens(response) if used_tokens else None)
+            return response
+
+    def _release_when_exhausted(self, reservation, response, used_tokens):
+        chunks = []
+        try:
+            for chunk in response:
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            self.release(reservation, used_tokens(chunks) if used_tokens else None)
+
+    def update_limits(self, headers):
+        """
+        Lower the budgets to the limits reported in the headers of a response.
+
+        Parameters:
+        - headers (dict): The headers of the response.
+
+        Returns:
+        - None
+        """
+        with self._condition:
+            for attribute, header in (
+                ("requests_per_minute", "x-ratelimit-limit-requests"),
+                ("tokens_per_minute", "x-ratelimit-limit-tokens"),
+            ):
+                with contextlib.suppress(KeyError, ValueError):
+                    limit = int(headers[header])
+                    setattr(
+                        self, attribute, min(getattr(self, attribute) or limit, limit)
+                    )
+
+    def _backoff(self, attempt, error):
+        # Adapt to a failed request and return the seconds to wait before
+        # retrying it; rate limit errors lower the concurrency and budgets
+        delay = random.uniform(
+            0, min(self.max_backoff, self.min_backoff * 2**attempt)
+        )
+        if not isinstance(error, openai.error.RateLimitError):
+            return delay
+
+        headers = error.headers or {}
+        with self._condition:
+            self.concurrency = max(1, self.concurrency // 2)
+        self.update_limits(headers)
+        with contextlib.suppress(KeyError, ValueError):
+            return float(headers["retry-after"]) + random.uniform(0, self.min_backoff)
+        return delay
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(model_name, rate_limit_config=None):
+    """
+    Return the process-wide RateLimiter of a model, creating it if needed.
+
+    Parameters:
+    - model_name (str): The name of the model.
+    - rate_limit_config (dict, optional): The "rate_limits" section of the
+      configuration: "max_concurrency" and "max_retries", and the
+      "requests_per_minute" and "tokens_per_minute" of each model under "models".
+
+    Returns:
+    - RateLimiter: The rate limiter shared by all requests to the model.
+    """
+    rate_limit_config = rate_limit_config or {}
+    with _rate_limiters_lock:
+        if model_name not in _rate_limiters:
+            _rate_limiters[model_name] = RateLimiter(
+                max_concurrency=rate_limit_config.get(
+                    "max_concurrency", DEFAULT_MAX_CONCURRENCY
+                ),
+                max_retries=rate_limit_config.get("max_retries", DEFAULT_MAX_RETRIES),
+                **rate_limit_config.get("models", {}).get(model_name, {}),
+            )
+        return _rate_limiters[model_name]
+
+
+class RateLimitedChatOpenAI(ChatOpenAI):
+    """
+    ChatOpenAI that sends its requests through a RateLimiter.
+
+    The rate limiter replaces the retries of ChatOpenAI. The size of a request
+    is estimated from its messages and max_tokens, and corrected with the
+    token usage of the response, or for streamed responses, which report
+    none, with the tokens of the streamed text. The rate limits in the headers
+    of every response are passed to the rate limiter.
+
+    Attributes:
+        rate_limiter (RateLimiter, optional): The scheduler of the requests.
+        tokenizer (str): The tokenizer counting the tokens of the messages and
+            streamed responses.
+    """
+
+    rate_limiter: Optional[Any] = None
+    tokenizer: str = DEFAULT_TOKENIZER
+
+    def completion_with_retry(self, **kwargs: Any) -> Any:
+        if self.rate_limiter is None:
+            return super().completion_with_retry(**kwargs)
+        prompt_tokens = sum(
+            count_tokens(message["content"] or "", self.tokenizer)
+            for message in kwargs["messages"]
+        )
+        stream = kwargs.get("stream", False)
+
+        def used_tokens(response):
+            if not stream:
+                return response["usage"]["total_tokens"]
+            text = "".join(
+                chunk["choices"][0]["delta"].get("content") or ""
+                for chunk in response
+                if chunk["choices"]
+            )
+            return prompt_tokens + count_tokens(text, self.tokenizer)
+
+        return self.rate_limiter.call(
+            functools.partial(self._create, **kwargs),
+            prompt_tokens + (kwargs.get("max_tokens") or 0),
+            used_tokens=used_tokens,
+            stream=stream,
+        )
+
+    def _create(self, **kwargs):
+        # Send the request like openai.ChatCompletion.create, keeping the
+        # headers of the response, which that drops; OpenAIResponse only has
+        # them as _headers
+        requestor = openai.api_requestor.APIRequestor(
+            key=kwargs.pop("api_key", None),
+            api_base=kwargs.pop("api_base", None),
+            organization=kwargs.pop("organization", None),
+        )
+        request_timeout = kwargs.pop("request_timeout", None)
+        stream = kwargs.get("stream", False)
+        response, _, api_key = requestor.request(
+            "post",
+            "/chat/completions",
+            params=kwargs,
+            stream=stream,
+            request_timeout=request_timeout,
+        )
+        if not stream:
+            self.rate_limiter.update_limits(response._headers)
+            return openai.util.convert_to_openai_object(response, api_key)
+        return self._stream_chunks(response, api_key)
+
+    def _stream_chunks(self, response, api_key):
+        for i, line in enumerate(response):
+            if i == 0:
+                self.rate_limiter.update_limits(line._headers)
+            yield openai.util.convert_to_openai_object(line, api_key)
+
+
+def build_chain(
+    api_key,
+    chains_config,
+    prompt_templates_dir,
+    common_prefix_file,
+    verbose=False,
+    model_name="gpt-3.5-turbo-16k",
+    temperature=0.7,
+    max_workers=None,
+    cache=None,
+    refresh_stages=(),
+    streaming=False,
+    backend=DEFAULT_BACKEND,
+    mock_options=None,
+    tokenizer=DEFAULT_TOKENIZER,
+    rate_limits=None,
+    speculate=False,
+    structured=False,
+    spill_dir=None,
+):
+    """
+    Build and return a DependencyGraphChain that runs several LLMChains, each
+    as soon as the outputs it depends on are available.
+
+    Parameters:
+    - api_key (str): The API key to access the language model.
+    - chains_config (list): A list of dictionaries, each containing configuration for a chain (e.g., template file).
+    - prompt_templates_dir (str): Directory path containing prompt template files.
+    - common_prefix_file (str): Name of the file containing common prefix content to be appended before the template.
+    - verbose (bool, optional): If True, prints verbose output. Defaults to False.
+    - model_name (str, optional): The name of the language model to be used, unless a chain sets its own "model_name". Defaults to "gpt-3.5-turbo-16k".
+    - temperature (float, optional): The temperature parameter for the language model, unless a chain sets its own "temperature". Defaults to 0.7.
+    - max_workers (int, optional): Maximum number of chains to run concurrently. Defaults to one per chain.
+    - cache (ResponseCache, optional): Cache for the chain outputs. Defaults to no caching.
+    - refresh_stages (iterable, optional): Names of the chains that must not use cached outputs.
+    - streaming (bool, optional): If True, the language model streams its tokens to the callbacks. Defaults to False.
+    - backend (str, optional): "openai", or "mock" to use the offline MockChatModel. Defaults to "openai".
+    - mock_options (dict, optional): Extra MockChatModel settings, e.g. latency and tokens_per_second.
+    - tokenizer (str, optional): The tokenizer counting prompt tokens against each chain's "token_budget". Defaults to "gpt2".
+    - rate_limits (dict, optional): The "rate_limits" configuration of the process-wide RateLimiter of the model.
+    - speculate (bool, optional): If True, chains with a "speculate" setting start as soon as the chains they depend on have streamed the given number of list items. Defaults to False.
+    - structured (bool, optional): If True, every chain responds with a JSON document matching the schema of its template, and includes only the "fields" it sets of the outputs it uses, and the "validate" settings of the chains are not used. Defaults to False.
+    - spill_dir (str, optional): If set, the outputs are spilled to this directory once the chains using them have started, and the chain returns SpilledOutput handles. Defaults to None.
+
+    Returns:
+    - DependencyGraphChain: An instance of DependencyGraphChain configured with the chains created from chains_config.
+    """
+
+    # Chains may start before the chains they depend on finish, from the
+    # first list items of their streamed outputs
+    speculation = {
+        os.path.splitext(chain_config["template_file"])[0]: chain_config["speculate"]
+        for chain_config in chains_config
+        if speculate and "speculate" in chain_config
+    }
+    streamed = {upstream for items in speculation.values() for upstream in items}
+
+    # Initialize the language models. A chain can set its own model_name,
+    # temperature, max_tokens and request_timeout; chains with the same
+    # settings share one model, and so its connections and rate limiter.
+    llms = {}
+
+    def stage_llm(chain_config):
+        settings = {
+            "streaming": streaming
+            or os.path.splitext(chain_config["template_file"])[0] in streamed
+        }
+        if backend != "mock":
+            settings["model"] = chain_config.get("model_name", model_name)
+            settings["temperature"] = chain_config.get("temperature", temperature)
+            settings.update(
+                (key, chain_config[key])
+                for key in STAGE_LLM_SETTINGS
+                if key in chain_config
+            )
+        key = tuple(sorted(settings.items()))
+        if key not in llms:
+            if backend == "mock":
+                llms[key] = MockChatModel(**settings, **(mock_options or {}))
+            else:
+                llms[key] = RateLimitedChatOpenAI(
+                    openai_api_key=api_key,
+                    rate_limiter=get_rate_limiter(settings["model"], rate_limits),
+                    tokenizer=tokenizer,
+                    **settings,
+                )
+        return llms[key]
+
+    # Chains created using the create_llm_chain function
+    chains = [
+        create_llm_chain(
+            stage_llm(chain_config),
+            chain_config["template_file"],
+            prompt_templates_dir,
+            common_prefix_file,
+            schema=load_stage_schema(
+                os.path.splitext(chain_config["template_file"])[0],
+                prompt_templates_dir,
+            )
+            if structured
+            else None,
+            input_fields=chain_config.get("fields"),
+        )
+        for chain_config in chains_config
+    ]
+
+    # Calculate input_variables and output_variables. The inputs are the
+    # variables no chain produces: the seed, and the outputs of the shared
+    # stages when the chain only runs the stages of a variant.
+    output_variables = [
+        os.path.splitext(chain_config["template_file"])[0]
+        for chain_config in chains_config
+    ]
+    registry = get_template_registry(prompt_templates_dir, common_prefix_file)
+    input_variables = list(
+        dict.fromkeys(
+            variable
+            for chain_config in chains_config
+            for variable in registry.prompt(chain_config["template_file"]).variables
+            if variable not in output_variables
+        )
+    )
+
+    # Dependency graph chain
+    graph_chain = DependencyGraphChain(
+        chains=chains,
+        input_variables=input_variables,
+        output_variables=output_variables,
+        verbose=verbose,
+        max_workers=max_workers,
+        cache=cache,
+        refresh_stages=list(refresh_stages),
+        token_budgets={
+            os.path.splitext(chain_config["template_file"])[0]: chain_config[
+                "token_budget"
+            ]
+            for chain_config in chains_config
+            if "token_budget" in chain_config
+        },
+        tokenizer=tokenizer,
+        speculation=speculation,
+        spill_dir=spill_dir,
+        # Structured outputs are checked against their schemas instead
+        validators={}
+        if structured
+        else {
+            os.path.splitext(chain_config["template_file"])[0]: chain_config["validate"]
+            for chain_config in chains_config
+            if "validate" in chain_config
+        },
+    )
+
+    return graph_chain
+
+
+class CallbackHandler(BaseCallbackHandler):
+    """
+    Custom callback handler class for monitoring the progress of the chains.
+
+    This class is a subclass of BaseCallbackHandler and is used to output
+    progress information when a chain starts executing, and to record the
+    latency, tokens and cost of every chain (stage) it sees.
+
+    Attributes:
+        records (list): One dict per finished stage with its name, model,
+            start and end timestamps, duration, time to first token, prompt,
+            completion and total tokens, cost, whether its output was reused,
+            and the error if it failed. Stages run by run_variants also have
+            the name of their "variant".
+        tokenizer (str): The tokenizer counting the tokens of responses without
+            token usage, such as streamed ones.
+    """
+
+    def __init__(self, tokenizer=DEFAULT_TOKENIZER):
+        self.records = []
+        self.tokenizer = tokenizer
+        self._running = {}
+        # The prompts and model of every running language model call
+        self._llm_calls = {}
+        self._lock = threading.Lock()
+
+    @property
+    def total_tokens(self):
+        return sum(record["total_tokens"] for record in self.records)
+
+    @property
+    def total_cost(self):
+        return sum(record["cost"] for record in self.records)
+
+    def on_chain_start(
+        self, serialized: Dict[str, Any], inputs: Dict[str, Any], **kwargs: Any
+    ) -> Any:
+        """
+        Callback function that is executed when a chain starts.
+
+        Parameters:
+        - serialized (dict): The serialized chain information.
+        - inputs (dict): The inputs passed to the chain.
+        - kwargs (dict): Additional keyword arguments containing tags.
+
+        Returns:
+        - None
+        """
+        tags = kwargs.get("tags")
+        if not tags:
+            # The chain running the stages, rather than a stage itself
+            return
+        stage = "".join(tags)
+        reused = bool(serialized.get("reused"))
+        if reused:
+            click.secho(f"Reusing output for chain '{stage}'", fg="cyan")
+        else:
+            click.secho(f"Running chain '{stage}'", fg="cyan")
+        with self._lock:
+            self._running[kwargs.get("run_id")] = {
+                "stage": stage,
+                "model": None,
+                "start": time.time(),
+                "end": None,
+                "duration": None,
+                "time_to_first_token": None,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "total_tokens": 0,
+                "cost": 0.0,
+                "reused": reused,
+                "error": None,
+            }
+            variant = current_variant.get()
+            if variant is not None:
+                self._running[kwargs.get("run_id")]["variant"] = variant
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> Any:
+        with self._lock:
+            record = self._running.get(kwargs.get("parent_run_id"))
+            if record is not None and record["time_to_first_token"] is None:
+                record["time_to_first_token"] = time.time() - record["start"]
+
+    def on_llm_start(
+        self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any
+    ) -> Any:
+        params = kwargs.get("invocation_params") or {}
+        with self._lock:
+            self._llm_calls[kwargs.get("run_id")] = (
+                prompts,
+                params.get("model_name") or params.get("model"),
+            )
+
+    def on_llm_error(self, error: BaseException, **kwargs: Any) -> Any:
+        with self._lock:
+            self._llm_calls.pop(kwargs.get("run_id"), None)
+
+    def on_llm_end(self, response: Any, **kwargs: Any) -> Any:
+        with self._lock:
+            prompts, invoked_model = self._llm_calls.pop(
+                kwargs.get("run_id"), ([], None)
+            )
+        llm_output = response.llm_output or {}
+        token_usage = llm_output.get("token_usage")
+        model = llm_output.get("model_name") or invoked_model
+        if token_usage:
+            prompt_tokens = token_usage.get("prompt_tokens", 0)
+            completion_tokens = token_usage.get("completion_tokens", 0)
+        else:
+            # Streamed responses come without token usage, so count it here
+            prompt_tokens = sum(
+                count_tokens(prompt, self.tokenizer) for prompt in prompts
+            )
+            completion_tokens = sum(
+                count_tokens(generation.text, self.tokenizer)
+                for generations in response.generations
+                for generation in generations
+            )
+        with self._lock:
+            record = self._running.get(kwargs.get("parent_run_id"))
+            if record is None:
+                return
+            record["model"] = model
+            record["prompt_tokens"] += prompt_tokens
+            record["completion_tokens"] += completion_tokens
+            record["total_tokens"] += prompt_tokens + completion_tokens
+            record["cost"] += get_token_cost(model, prompt_tokens, completion_tokens)
+
+    def on_chain_end(self, outputs: Dict[str, Any], **kwargs: Any) -> Any:
+        self._finish_stage(kwargs.get("run_id"), None)
+
+    def on_chain_error(self, error: BaseException, **kwargs: Any) -> Any:
+        self._finish_stage(kwargs.get("run_id"), str(error) or error.__class__.__name__)
+
+    def _finish_stage(self, run_id, error):
+        with self._lock:
+            record = self._running.pop(run_id, None)
+            if record is None:
+                return
+            record["end"] = time.time()
+            record["duration"] = record["end"] - record["start"]
+            record["error"] = error
+            self.records.append(record)
+
+
+def get_token_cost(model, prompt_tokens, completion_tokens):
+    """
+    Return the cost in USD of a language model call.
+
+    Parameters:
+    - model (str): The name of the model; unknown models cost nothing.
+    - prompt_tokens (int): The number of tokens in the prompt.
+    - completion_tokens (int): The number of tokens in the completion.
+
+    Returns:
+    - float: The cost of the call.
+    """
+    if not model or standardize_model_name(model) not in MODEL_COST_PER_1K_TOKENS:
+        return 0.0
+    return get_openai_token_cost_for_model(
+        model, prompt_tokens
+    ) + get_openai_token_cost_for_model(model, completion_tokens, is_completion=True)
+
+
+class CheckpointHandler(BaseCallbackHandler):
+    """
+    Callback handler saving the output of every stage to a RunCheckpoint as
+    soon as the stage finishes.
+
+    Attributes:
+        checkpoint (RunCheckpoint): The checkpoint of the run.
+    """
+
+    def __init__(self, checkpoint):
+        self.checkpoint = checkpoint
+        self._stages = {}
+
+    def on_chain_start(
+        self, serialized: Dict[str, Any], inputs: Dict[str, Any], **kwargs: Any
+    ) -> Any:
+        tags = kwargs.get("tags")
+        if tags:
+            self._stages[kwargs.get("run_id")] = "".join(tags)
+
+    def on_chain_end(self, outputs: Dict[str, Any], **kwargs: Any) -> Any:
+        stage = self._stages.pop(kwargs.get("run_id"), None)
+        if stage in outputs:
+            self.checkpoint.save_stage(stage, outputs[stage])
+
+    def on_chain_error(self, error: BaseException, **kwargs: Any) -> Any:
+        self._stages.pop(kwargs.get("run_id"), None)
+
+
+class StreamingReportHandler(BaseCallbackHandler):
+    """
+    Callback handler that streams the report while the chains are running.
+
+    Tokens are echoed to the terminal as the language model generates them,
+    one chain at a time: tokens of chains running concurrently are buffered
+    until the chain before them has finished. As chain outputs arrive, the
+    sections of the output template are appended to the markdown file in
+    template order, so a failure in a late chain keeps the earlier sections.
+    Outputs failing validation end their chain with an error rather than its
+    outputs, so only validated sections are written.
+
+    Attributes:
+        markdown_file_name (str): The markdown file the report is written to.
+        echo_tokens (bool): If True, tokens are echoed to the terminal.
+    """
+
+    def __init__(self, markdown_file_name, output_template, echo_tokens=True):
+        self.markdown_file_name = markdown_file_name
+        self.echo_tokens = echo_tokens
+        self._sections = list(string.Formatter().parse(output_template))
+        self._written = 0
+        self._values = {}
+        self._active = None
+        self._buffers = {}
+        self._finished = set()
+        self._lock = threading.Lock()
+        # Start with an empty file so sections are appended to this run only
+        open(markdown_file_name, "w").close()
+
+    def on_llm_start(
+        self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any
+    ) -> Any:
+        with self._lock:
+            if self._active is None:
+                self._active = kwargs["run_id"]
+            else:
+                self._buffers[kwargs["run_id"]] = []
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> Any:
+        if not self.echo_tokens:
+            return
+        with self._lock:
+            if kwargs["run_id"] == self._active:
+                click.echo(token, nl=False)
+            else:
+                self._buffers.setdefault(kwargs["run_id"], []).append(token)
+
+    def on_llm_end(self, response: Any, **kwargs: Any) -> Any:
+        self._finish_llm_run(kwargs["run_id"])
+
+    def on_llm_error(self, error: BaseException, **kwargs: Any) -> Any:
+        self._finish_llm_run(kwargs["run_id"])
+
+    def on_chain_start(
+        self, serialized: Dict[str, Any], inputs: Dict[str, Any], **kwargs: Any
+    ) -> Any:
+        """
+        Take the inputs of the whole run (e.g. the seed), which the stages do
+        not return, when the chain running the stages starts.
+
+        Parameters:
+        - serialized (dict): The serialized chain information.
+        - inputs (dict): The inputs passed to the chain.
+
+        Returns:
+        - None
+        """
+        if kwargs.get("parent_run_id") is None:
+            self._write_sections(inputs)
+
+    def on_chain_end(self, outputs: Dict[str, Any], **kwargs: Any) -> Any:
+        """
+        Append every section of the report whose fields are now available.
+
+        Parameters:
+        - outputs (dict): The outputs of the chain that finished.
+
+        Returns:
+        - None
+        """
+        self._write_sections(outputs)
+
+    def _write_sections(self, values):
+        with self._lock:
+            self._values.update(values)
+            with open(self.markdown_file_name, "a") as f:
+                while self._written < len(self._sections):
+                    literal_text, field_name, format_spec, _ = self._sections[
+                        self._written
+                    ]
+                    if field_name is not None and field_name not in self._values:
+                        break
+                    f.write(literal_text)
+                    if field_name is not None:
+                        f.write(format(self._values[field_name], format_spec))
+                    self._written += 1
+
+    def _finish_llm_run(self, run_id):
+        with self._lock:
+            if run_id != self._active:
+                self._finished.add(run_id)
+                return
+            if self.echo_tokens:
+                click.echo()
+            # Hand the terminal over to the next buffered run
+            self._active = None
+            while self._buffers:
+                run_id = next(iter(self._buffers))
+                tokens = self._buffers.pop(run_id)
+                if self.echo_tokens:
+                    click.echo("".join(tokens), nl=False)
+                if run_id not in self._finished:
+                    self._active = run_id
+                    break
+                self._finished.discard(run_id)
+                if self.echo_tokens:
+                    click.echo()
+
+
+def run_seed(
+    chain,
+    seed_file,
+    output_file,
+    formats,
+    incremental=False,
+    stream=False,
+    renderer=None,
+    monitor=None,
+    seed_cache=None,
+    report_store=None,
+    history=None,
+    preprocessor=None,
+    seed=None,
+):
+    """
+    Runs the chain for a single seed file and generates its report.
+
+    Any error raised while processing the seed is captured in the result
+    rather than raised, so that one bad seed does not stop a batch.
+
+    Parameters:
+    - chain (Chain): The chain to run.
+    - seed_file (str): The path to the seed file.
+    - output_file (str): The base name of the output file.
+    - formats (list): The report formats to create.
+    - incremental (bool, optional): If True, reuses unchanged stage outputs recorded
+      in the "<output_file>.manifest.json" run manifest.
+    - stream (bool, optional): If True, appends each section to the markdown file as
+      soon as it is generated.
+    - renderer (ReportRenderer, optional): If given, the report is submitted to it
+      and the result holds the pending "rendering" instead of the report files.
+    - monitor (CallbackHandler, optional): The handler recording the stages of the
+      run, e.g. to follow its progress. Defaults to a new one.
+    - seed_cache (SeedCache, optional): If given, reuses the outputs of a similar
+      earlier seed and records the outputs of new ones.
+    - report_store (ReportStore, optional): The store the outputs of a chain built
+      for structured output are added to.
+    - history (RunHistory, optional): The history the run is recorded in, whether
+      it succeeds or not.
+    - preprocessor (SeedPreprocessor, optional): Cleans up the seed read from seed_file.
+    - seed (str, optional): The seed, already read and preprocessed. If None, it
+      is read from seed_file.
+
+    Returns:
+    - dict: The seed file, created files, tokens, cost, runtime, per-stage metrics,
+      reused similar seed (if any) and error (if any).
+    """
+    result = {
+        "seed_file": seed_file,
+        "report_files": {},
+        "total_tokens": 0,
+        "total_cost": 0.0,
+        "duration": 0.0,
+        "error": None,
+        "stages": [],
+        "seed_match": None,
+    }
+    monitor = monitor or CallbackHandler(getattr(chain, "tokenizer", DEFAULT_TOKENIZER))
+    output = {}
+    with measure_time() as duration:
+        try:
+            if seed is None:
+                seed = read_seed(seed_file)
+                seed = preprocessor.process(seed) if preprocessor else seed
+            manifest_file = f"{output_file}.manifest.json" if incremental else None
+            callbacks = [monitor]
+            if stream:
+                callbacks.append(
+                    StreamingReportHandler(
+                        f"{output_file}.md",
+                        read_template(OUTPUT_TEMPLATE_FILE),
+                        echo_tokens=False,
+                    )
+                )
+            fingerprint = chain_fingerprint(chain) if seed_cache else None
+            seed_match = seed_cache.lookup(seed, fingerprint) if seed_cache else None
+            result["seed_match"] = seed_match
+            output = run_chain(
+                chain,
+                seed,
+                manifest_file,
+                callbacks,
+                seed_match["outputs"] if seed_match else None,
+            )
+            if seed_cache and not seed_match:
+                seed_cache.add(seed, output, fingerprint)
+            sections = output
+            schemas = structured_schemas(chain)
+            if schemas:
+                sections = store_structured_outputs(output, schemas, report_store)
+            if renderer is None:
+                result["report_files"] = generate_report(
+                    output_file, formats, **sections
+                )
+            else:
+                result["rendering"] = renderer.submit(output_file, formats, sections)
+        except Exception as e:
+            result["error"] = str(e) or e.__class__.__name__
+        result["total_tokens"] = monitor.total_tokens
+        result["total_cost"] = monitor.total_cost
+        result["duration"] = duration()
+        result["stages"] = monitor.records
+    try:
+        if history:
+            history.record(
+                seed,
+                output,
+                result["stages"],
+                seed_file=seed_file,
+                output_file=output_file,
+                total_tokens=result["total_tokens"],
+                total_cost=result["total_cost"],
+                duration=result["duration"],
+                error=result["error"],
+            )
+    finally:
+        # Remove the spilled outputs once the report no longer needs them
+        if "rendering" in result:
+            result["rendering"].add_done_callback(lambda _: discard_spilled(output))
+        else:
+            discard_spilled(output)
+    return result
+
+
+def build_variant_chains(
+    api_key,
+    chains_config,
+    shared_stages,
+    variants,
+    model_name="gpt-3.5-turbo-16k",
+    temperature=0.7,
+    **chain_options,
+):
+    """
+    Build the chains of a variant run: one for the shared stages, and one per
+    variant for the other stages.
+
+    Parameters:
+    - api_key (str): The API key to access the language model.
+    - chains_config (list): The "chains" section of the configuration.
+    - shared_stages (list): The names of the stages run once for all variants.
+    - variants (list): The variant settings: a "name", and optionally the
+      "model_name" and "temperature" replacing those of the shared stages,
+      and those a chain sets itself.
+    - model_name (str, optional): The model of the shared stages.
+    - temperature (float, optional): The temperature of the shared stages.
+    - chain_options: Other arguments of build_chain.
+
+    Returns:
+    - tuple: The chain of the shared stages (None if there are none), and a
+      dict with the chain of each variant name.
+    """
+    shared_config = [
+        chain_config
+        for chain_config in chains_config
+        if os.path.splitext(chain_config["template_file"])[0] in shared_stages
+    ]
+    variant_config = [
+        chain_config
+        for chain_config in chains_config
+        if chain_config not in shared_config
+    ]
+
+    shared_chain = (
+        build_chain(
+            api_key,
+            shared_config,
+            model_name=model_name,
+            temperature=temperature,
+            **chain_options,
+        )
+        if shared_config
+        else None
+    )
+    # The settings of a variant take precedence over those of the chains, so
+    # the variants differ in what they set
+    variant_chains = {
+        variant["name"]: build_chain(
+            api_key,
+            [
+                {
+                    key: value
+                    for key, value in chain_config.items()
+                    if key not in ("model_name", "temperature") or key not in variant
+                }
+                for chain_config in variant_config
+            ],
+            model_name=variant.get("model_name", model_name),
+            temperature=variant.get("temperature", temperature),
+            **chain_options,
+        )
+        for variant in variants
+    }
+    return shared_chain, variant_chains
+
+
+def run_variants(shared_chain, variant_chains, seed, callbacks=None):
+    """
+    Runs the shared stages once, then the stages of every variant concurrently.
+
+    Parameters:
+    - shared_chain (Chain): The chain of the shared stages, or None.
+    - variant_chains (dict): The chain of each variant name.
+    - seed (str): The contents of the seed file.
+    - callbacks (list, optional): Callback handlers for this run.
+
+    Returns:
+    - dict: The output of each variant, including the seed and shared stages.
+    """
+    inputs = {"seed": seed}
+    if shared_chain is not None:
+        inputs = shared_chain(inputs, callbacks=callbacks)
+
+    def run_variant(name, chain):
+        current_variant.set(name)
+        return chain(inputs, callbacks=callbacks)
+
+    with ThreadPoolExecutor(max_workers=len(variant_chains)) as executor:
+        futures = {
+            name: executor.submit(
+                contextvars.copy_context().run, run_variant, name, chain
+            )
+            for name, chain in variant_chains.items()
+        }
+        return {name: future.result() for name, future in futures.items()}
+
+
+def run_batch(
+    chain,
+    seed_files,
+    output_dir,
+    formats,
+    batch_workers,
+    incremental=False,
+    stream=False,
+    render_workers=DEFAULT_RENDER_WORKERS,
+    seed_cache=None,
+    report_store=None,
+    history=None,
+    preprocessor=None,
+):
+    """
+    Runs the chain for several seed files concurrently.
+
+    Each report is named after its seed file and written to output_dir. Reports
+    are rendered by a ReportRenderer, so a seed's worker moves on to the next
+    seed as soon as its chain has finished. The seeds are read and preprocessed
+    first, and a seed that is the same as an earlier one gets a copy of its
+    report instead of running the chain again.
+
+    Parameters:
+    - chain (Chain): The chain to run; it is shared by all seeds.
+    - seed_files (list): The paths of the seed files.
+    - output_dir (str): The directory the reports are written to.
+    - formats (list): The report formats to create.
+    - batch_workers (int): Maximum number of seeds to process at once.
+    - incremental (bool, optional): If True, reuses unchanged stage outputs from each
+      seed's previous run.
+    - stream (bool, optional): If True, writes each report's sections as they are generated.
+    - render_workers (int, optional): Maximum number of reports rendered at once.
+    - seed_cache (SeedCache, optional): Reuses the outputs of similar earlier seeds.
+    - report_store (ReportStore, optional): Stores the outputs of a structured chain.
+    - history (RunHistory, optional): The history every seed's run is recorded in.
+    - preprocessor (SeedPreprocessor, optional): Cleans up the seeds.
+
+    Returns:
+    - list: The result of run_seed for each seed file, in the same order. The
+      result of a duplicate seed names the seed file it is a copy of under
+      "duplicate_of".
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    output_files = [
+        os.path.join(output_dir, os.path.splitext(os.path.basename(seed_file))[0])
+        for seed_file in seed_files
+    ]
+    # Seeds that cannot be read are left to run_seed, which reports them
+    seeds, _ = read_seeds(seed_files, preprocessor)
+    duplicates = find_duplicate_seeds(seeds)
+    results = [
+        {
+            "seed_file": seed_file,
+            "report_files": {},
+            "total_tokens": 0,
+            "total_cost": 0.0,
+            "duration": 0.0,
+            "error": None,
+            "stages": [],
+            "seed_match": None,
+        }
+        for seed_file in seed_files
+    ]
+    originals = [i for i in range(len(seed_files)) if i not in duplicates]
+    with ReportRenderer(render_workers) as renderer, ThreadPoolExecutor(
+        max_workers=batch_workers
+    ) as executor:
+        for i, result in zip(
+            originals,
+            executor.map(
+                lambda i: run_seed(
+                    chain,
+                    seed_files[i],
+                    output_files[i],
+                    formats,
+                    incremental,
+                    stream,
+                    renderer,
+                    seed_cache=seed_cache,
+                    report_store=report_store,
+                    history=history,
+                    preprocessor=preprocessor,
+                    seed=seeds[i],
+                ),
+                originals,
+            ),
+        ):
+            results[i] = result
+        for result in results:
+            rendering = result.pop("rendering", None)
+            if rendering is None:
+                continue
+            try:
+                result["report_files"] = rendering.result()
+            except Exception as e:
+                result["error"] = str(e) or e.__class__.__name__
+    copy_duplicate_reports(results, duplicates, output_files)
+    return results
+
+
+def chat_request(custom_id, llm, prompt):
+    """
+    Build the line of a Batch API request file asking a chat model for a completion.
+
+    Parameters:
+    - custom_id (str): The ID the response is matched to the request by.
+    - llm (BaseChatModel): The model, whose name, temperature and max_tokens are used.
+    - prompt (str): The prompt, sent as a single user message.
+
+    Returns:
+    - dict: The request.
+    """
+    body = {
+        "model": llm.model_name,
+        "messages": [{"role": "user", "content": prompt}],
+    }
+    for key in ("temperature", "max_tokens"):
+        if getattr(llm, key, None) is not None:
+            body[key] = getattr(llm, key)
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": body,
+    }
+
+
+def batch_response(line):
+    """
+    Extract the completion from a line of a Batch API output file.
+
+    Parameters:
+    - line (dict): The output line, or None if the request has no response.
+
+    Returns:
+    - tuple: The text of the completion, the token usage and the error; the
+      text is None if the request failed.
+    """
+    if line is None:
+        return None, {}, "The batch has no response for this request"
+    if line.get("error"):
+        return None, {}, line["error"].get("message") or str(line["error"])
+    response = line.get("response") or {}
+    body = response.get("body") or {}
+    if response.get("status_code") != 200:
+        error = (body.get("error") or {}).get("message")
+        return None, {}, error or f"HTTP {response.get('status_code')}"
+    return body["choices"][0]["message"]["content"], body.get("usage", {}), None
+
+
+def read_jsonl(path):
+    """
+    Read the objects of a JSON lines file.
+    """
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def write_jsonl(path, lines):
+    """
+    Write objects to a JSON lines file.
+    """
+    with open(path, "w") as f:
+        for line in lines:
+            f.write(json.dumps(line) + "\n")
+
+
+class LocalBatchClient:
+    """
+    File-based stand-in for the OpenAI Batch API, used for testing and with the
+    mock backend.
+
+    A batch is a request file and a status file in batch_dir. The requests are
+    answered by a chat model, by default MockChatModel, the first time the
+    batch is retrieved, and the responses are written to an output file in the
+    format of the Batch API.
+
+    Attributes:
+        batch_dir (str): The directory holding the batch files.
+        llm (BaseChatModel): The model answering the requests.
+    """
+
+    def __init__(self, batch_dir=DEFAULT_BULK_DIR, llm=None):
+        self.batch_dir = batch_dir
+        self.llm = llm or MockChatModel()
+
+    def _path(self, batch_id, kind):
+        return os.path.join(self.batch_dir, f"{batch_id}.{kind}")
+
+    def submit(self, requests):
+        """
+        Submit a batch of requests.
+
+        Parameters:
+        - requests (list): The requests, as built by chat_request.
+
+        Returns:
+        - str: The ID of the batch.
+        """
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        os.makedirs(self.batch_dir, exist_ok=True)
+        write_jsonl(self._path(batch_id, "input.jsonl"), requests)
+        with open(self._path(batch_id, "json"), "w") as f:
+            json.dump({"id": batch_id, "status": "in_progress"}, f)
+        return batch_id
+
+    def retrieve(self, batch_id):
+        """
+        Return the status of a batch, answering its requests if they are pending.
+
+        Parameters:
+        - batch_id (str): The ID of the batch.
+
+        Returns:
+        - dict: The "id" and "status" of the batch, and its "output_file" once
+          it is completed.
+        """
+        with open(self._path(batch_id, "json")) as f:
+            batch = json.load(f)
+        if batch["status"] != "in_progress":
+            return batch
+
+        output = []
+        for request in read_jsonl(self._path(batch_id, "input.jsonl")):
+            message = HumanMessage(content=request["body"]["messages"][-1]["content"])
+            result = self.llm.generate([[message]])
+            output.append(
+                {
+                    "id": f"response_{uuid.uuid4().hex}",
+                    "custom_id": request["custom_id"],
+                    "response": {
+                        "status_code": 200,
+                        "body": {
+                            "model": request["body"]["model"],
+                            "choices": [
+                                {
+                                    "index": 0,
+                                    "message": {
+                                        "role": "assistant",
+                                        "content": result.generations[0][0].text,
+                                    },
+                                }
+                            ],
+                            "usage": (result.llm_output or {}).get("token_usage", {}),
+                        },
+                    },
+                    "error": None,
+                }
+            )
+        batch.update(
+            status="completed", output_file=self._path(batch_id, "output.jsonl")
+        )
+        write_jsonl(batch["output_file"], output)
+        with open(self._path(batch_id, "json"), "w") as f:
+            json.dump(batch, f)
+        return batch
+
+    def results(self, batch):
+        """
+        Return the output lines of a finished batch.
+
+        Parameters:
+        - batch (dict): The batch, as returned by retrieve.
+
+        Returns:
+        - list: The output lines.
+        """
+        return read_jsonl(batch["output_file"]) if batch.get("output_file") else []
+
+
+class OpenAIBatchClient:
+    """
+    Client of the OpenAI Batch API.
+
+    The request file is uploaded with the "batch" purpose and a batch is
+    created for it. Once the batch has finished, its output and error files
+    are downloaded. A copy of every request file is kept in batch_dir.
+
+    Attributes:
+        api_key (str): The API key.
+        batch_dir (str): The directory the request files are written to.
+        completion_window (str): The time frame within which the batch must finish.
+    """
+
+    def __init__(self, api_key, batch_dir=DEFAULT_BULK_DIR, completion_window="24h"):
+        self.api_key = api_key
+        self.batch_dir = batch_dir
+        self.completion_window = completion_window
+
+    def _request(self, method, url, params=None):
+        requestor = openai.api_requestor.APIRequestor(key=self.api_key)
+        response, _, _ = requestor.request(method, url, params)
+        return response.data
+
+    def submit(self, requests):
+        """
+        Upload the requests and create a batch for them.
+
+        Parameters:
+        - requests (list): The requests, as built by chat_request.
+
+        Returns:
+        - str: The ID of the batch.
+        """
+        os.makedirs(self.batch_dir, exist_ok=True)
+        path = os.path.join(self.batch_dir, f"{uuid.uuid4().hex}.input.jsonl")
+        write_jsonl(path, requests)
+        with open(path, "rb") as f:
+            input_file = openai.File.create(
+                file=f, purpose="batch", api_key=self.api_key
+            )
+        batch = self._request(
+            "post",
+            "/batches",
+            {
+                "input_file_id": input_file["id"],
+                "endpoint": "/v1/chat/completions",
+                "completion_window": self.completion_window,
+            },
+        )
+        return batch["id"]
+
+    def retrieve(self, batch_id):
+        """
+        Return the status of a batch.
+
+        Parameters:
+        - batch_id (str): The ID of the batch.
+
+        Returns:
+        - dict: The batch, with its "status" and, once it has finished, its
+          "output_file_id" and "error_file_id".
+        """
+        return self._request("get", f"/batches/{batch_id}")
+
+    def results(self, batch):
+        """
+        Download the output and error lines of a finished batch.
+
+        Parameters:
+        - batch (dict): The batch, as returned by retrieve.
+
+        Returns:
+        - list: The output lines.
+        """
+        lines = []
+        for key in ("output_file_id", "error_file_id"):
+            if batch.get(key):
+                content = openai.File.download(batch[key], api_key=self.api_key)
+                lines += [
+                    json.loads(line)
+                    for line in content.decode("utf-8").splitlines()
+                    if line.strip()
+                ]
+        return lines
+
+
+def build_batch_client(
+    api_key, bulk_config=None, backend=DEFAULT_BACKEND, mock_options=None
+):
+    """
+    Create the batch client configured in the "bulk" section of the configuration.
+
+    Parameters:
+    - api_key (str): The API key.
+    - bulk_config (dict, optional): Optional "client" ("openai" or "local"),
+      "dir" and "completion_window" keys. The client defaults to "local" with
+      the mock backend and "openai" otherwise.
+    - backend (str, optional): The language model backend.
+    - mock_options (dict, optional): The MockChatModel settings of the local client.
+
+    Returns:
+    - LocalBatchClient or OpenAIBatchClient: The client.
+    """
+    bulk_config = bulk_config or {}
+    batch_dir = bulk_config.get("dir", DEFAULT_BULK_DIR)
+    client = bulk_config.get("client", "local" if backend == "mock" else "openai")
+    if client == "local":
+        return LocalBatchClient(batch_dir, MockChatModel(**(mock_options or {})))
+    return OpenAIBatchClient(
+        api_key, batch_dir, bulk_config.get("completion_window", "24h")
+    )
+
+
+def wait_for_batch(client, batch_id, poll_interval=DEFAULT_BULK_POLL_INTERVAL):
+    """
+    Poll a batch until it has finished.
+
+    Parameters:
+    - client (LocalBatchClient or OpenAIBatchClient): The batch client.
+    - batch_id (str): The ID of the batch.
+    - poll_interval (float, optional): Seconds between two polls.
+
+    Returns:
+    - dict: The finished batch. It may have failed, expired or been
+      cancelled, in which case some or all of its requests have no response.
+    """
+    while True:
+        batch = client.retrieve(batch_id)
+        if batch["status"] in BATCH_FINAL_STATUSES:
+            return batch
+        time.sleep(poll_interval)
+
+
+def run_bulk(
+    chain,
+    seed_files,
+    output_dir,
+    formats,
+    client,
+    poll_interval=DEFAULT_BULK_POLL_INTERVAL,
+    render_workers=DEFAULT_RENDER_WORKERS,
+    report_store=None,
+    history=None,
+    preprocessor=None,
+):
+    """
+    Runs the chain for many seed files through a batch API.
+
+    The stages run in waves: every stage whose inputs are available for all
+    seeds. The prompts of a wave, for every seed, are written to one request
+    file and submitted as a batch, which is polled until it has finished. Its
+    responses are the inputs of the next wave. Outputs failing validation are
+    requested again in another batch if their chain retries them. A seed whose
+    request fails is left out of the later waves. Cached outputs are reused and new ones cached
+    as in a regular run. Each report is named after its seed file and written
+    to output_dir; a seed that is the same as an earlier one gets a copy of its
+    report.
+
+    Parameters:
+    - chain (DependencyGraphChain): The chain to run; all its stages must be LLMChains.
+    - seed_files (list): The paths of the seed files.
+    - output_dir (str): The directory the reports are written to.
+    - formats (list): The report formats to create.
+    - client (LocalBatchClient or OpenAIBatchClient): The batch client.
+    - poll_interval (float, optional): Seconds between two polls of a batch.
+    - render_workers (int, optional): Maximum number of reports rendered at once.
+    - report_store (ReportStore, optional): Stores the outputs of a structured chain.
+    - history (RunHistory, optional): The history every seed's run is recorded in.
+    - preprocessor (SeedPreprocessor, optional): Cleans up the seeds.
+
+    Returns:
+    - list: A result like that of run_batch for each seed file, in the same order.
+      The duration of each seed is that of the whole bulk run.
+    """
+    results = [
+        {
+            "seed_file": seed_file,
+            "report_files": {},
+            "total_tokens": 0,
+            "total_cost": 0.0,
+            "duration": 0.0,
+            "error": None,
+            "stages": [],
+        }
+        for seed_file in seed_files
+    ]
+    seeds, errors = read_seeds(seed_files, preprocessor)
+    duplicates = find_duplicate_seeds(seeds)
+    values = []
+    for i, result in enumerate(results):
+        result["error"] = errors[i]
+        values.append(
+            None if seeds[i] is None or i in duplicates else {"seed": seeds[i]}
+        )
+    stages = {stage.output_key: stage for stage in chain.chains}
+    graph = build_dependency_graph(chain.chains)
+    done = set()
+    with measure_time() as duration:
+        while len(done) < len(stages):
+            wave = [
+                key
+                for key in stages
+                if key not in done and all(upstream in done for upstream in graph[key])
+            ]
+            requests, pending = [], {}
+            start = time.time()
+            for i, known in enumerate(values):
+                if known is None or results[i]["error"]:
+                    continue
+                for key in wave:
+                    stage = stages[key]
+                    prompt = format_prompt(stage, chain.prepare_inputs(stage, known))
+                    cache_key, cached = chain.cached_output(stage, prompt)
+                    if cached is not None and not chain.output_problems(stage, cached):
+                        known[key] = cached
+                        results[i]["stages"].append(
+                            bulk_stage_record(key, None, start, {}, reused=True)
+                        )
+                        continue
+                    requests.append(chat_request(f"{i}-{key}", stage.llm, prompt))
+                    pending[f"{i}-{key}"] = (i, key, cache_key)
+            done.update(wave)
+            if not requests:
+                continue
+
+            # Requests whose output fails validation are sent again in another
+            # batch, as many times as their chain's validators allow
+            attempts = collections.Counter()
+            while requests:
+                batch_id = client.submit(requests)
+                click.secho(
+                    f"Submitted batch {batch_id}: {len(requests)} requests for "
+                    f"{', '.join(wave)}",
+                    fg="cyan",
+                )
+                batch = wait_for_batch(client, batch_id, poll_interval)
+                responses = {line["custom_id"]: line for line in client.results(batch)}
+                retries = []
+                for request in requests:
+                    custom_id = request["custom_id"]
+                    i, key, cache_key = pending[custom_id]
+                    stage = stages[key]
+                    text, usage, error = batch_response(responses.get(custom_id))
+                    if error is None and isinstance(stage, StructuredLLMChain):
+                        try:
+                            text = stage.parse_output(text)
+                        except ValueError as e:
+                            error = str(e)
+                    problems = [] if error else chain.output_problems(stage, text)
+                    if problems:
+                        error = f"The output failed validation: {'; '.join(problems)}"
+                    record = bulk_stage_record(key, stage.llm.model_name, start, usage)
+                    record["error"] = error
+                    results[i]["stages"].append(record)
+                    if problems and attempts[custom_id] < chain.validation_retries(
+                        stage
+                    ):
+                        attempts[custom_id] += 1
+                        retries.append(request)
+                        continue
+                    if error is not None:
+                        results[i]["error"] = f"{key}: {error}"
+                        continue
+                    values[i][key] = text
+                    if cache_key is not None:
+                        chain.cache.put(cache_key, text)
+                requests = retries
+
+        render_seed_reports(
+            chain,
+            results,
+            seeds,
+            values,
+            duplicates,
+            output_dir,
+            formats,
+            duration,
+            render_workers,
+            report_store,
+            history,
+        )
+    return results
+
+
+def render_seed_reports(
+    chain,
+    results,
+    seeds,
+    values,
+    duplicates,
+    output_dir,
+    formats,
+    duration,
+    render_workers=DEFAULT_RENDER_WORKERS,
+    report_store=None,
+    history=None,
+):
+    """
+    Finish the seeds of a bulk or distributed run once their stages have run:
+    render the report of every seed without an error, copy it for the seeds
+    that are the same, and total and record the run of every seed.
+
+    Parameters:
+    - chain (DependencyGraphChain): The chain that was run.
+    - results (list): The result of each seed, updated in place.
+    - seeds (list): The preprocessed seeds, or None for those that could not be read.
+    - values (list): The inputs and outputs of each seed, or None if it was not run.
+    - duplicates (dict): The index of the earlier, same seed of every duplicate.
+    - output_dir (str): The directory the reports are written to, named after
+      their seed files.
+    - formats (list): The report formats to create.
+    - duration (callable): Returns the duration of the whole run.
+    - render_workers (int, optional): Maximum number of reports rendered at once.
+    - report_store (ReportStore, optional): Stores the outputs of a structured chain.
+    - history (RunHistory, optional): The history every seed's run is recorded in.
+    """
+    output_files = [
+        os.path.join(
+            output_dir, os.path.splitext(os.path.basename(result["seed_file"]))[0]
+        )
+        for result in results
+    ]
+    schemas = structured_schemas(chain)
+    os.makedirs(output_dir, exist_ok=True)
+    with ReportRenderer(render_workers) as renderer:
+        renderings = {}
+        for i, result in enumerate(results):
+            if values[i] is None or result["error"]:
+                continue
+            sections = values[i]
+            if schemas:
+                sections = store_structured_outputs(values[i], schemas, report_store)
+            renderings[i] = renderer.submit(output_files[i], formats, sections)
+        for i, rendering in renderings.items():
+            try:
+                results[i]["report_files"] = rendering.result()
+            except Exception as e:
+                results[i]["error"] = str(e) or e.__class__.__name__
+    copy_duplicate_reports(results, duplicates, output_files)
+
+    for i, result in enumerate(results):
+        result["total_tokens"] = sum(r["total_tokens"] for r in result["stages"])
+        result["total_cost"] = sum(r["cost"] for r in result["stages"])
+        result["duration"] = duration()
+        if history and i not in duplicates:
+            history.record(
+                seeds[i],
+                values[i] or {},
+                result["stages"],
+                seed_file=result["seed_file"],
+                output_file=next(
+                    (os.path.splitext(f)[0] for f in result["report_files"].values()),
+                    None,
+                ),
+                total_tokens=result["total_tokens"],
+                total_cost=result["total_cost"],
+                duration=result["duration"],
+                error=result["error"],
+            )
+
+
+def bulk_stage_record(stage, model, start, usage, reused=False):
+    """
+    Build the record of a stage run through a batch, like those of CallbackHandler.
+
+    Parameters:
+    - stage (str): The name of the stage.
+    - model (str): The model that ran it, or None if its output was reused.
+    - start (float): When the batch of the stage was submitted.
+    - usage (dict): The token usage of its response.
+    - reused (bool, optional): Whether its output was reused from the cache.
+
+    Returns:
+    - dict: The record; its cost is that of the Batch API.
+    """
+    prompt_tokens = usage.get("prompt_tokens", 0)
+    completion_tokens = usage.get("completion_tokens", 0)
+    end = time.time()
+    return {
+        "stage": stage,
+        "model": model,
+        "start": start,
+        "end": end,
+        "duration": end - start,
+        "time_to_first_token": None,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "cost": get_token_cost(model, prompt_tokens, completion_tokens)
+        * BATCH_COST_FACTOR,
+        "reused": reused,
+        "error": None,
+    }
+
+
+def run_distributed(
+    chain,
+    seed_files,
+    output_dir,
+    formats,
+    task_queue,
+    poll_interval=DEFAULT_QUEUE_POLL_INTERVAL,
+    render_workers=DEFAULT_RENDER_WORKERS,
+    report_store=None,
+    history=None,
+    preprocessor=None,
+):
+    """
+    Runs the chain for many seed files on the workers of a task queue.
+
+    A job with a task for every stage of every seed, keyed by the seed's hash
+    and the stage, is added to the queue. Workers (see run_worker) claim each
+    task once its upstream tasks are done, on this host or any other sharing
+    the queue. The queue is polled until every task is done or failed; a seed
+    fails with its first failed stage. The reports are then rendered here as in
+    run_bulk, and the job is removed from the queue, also if the run is
+    interrupted.
+
+    Parameters:
+    - chain (DependencyGraphChain): The chain the workers run; it is only used
+      for its dependency graph and to render the reports.
+    - seed_files (list): The paths of the seed files.
+    - output_dir (str): The directory the reports are written to.
+    - formats (list): The report formats to create.
+    - task_queue (SQLiteTaskQueue or DirectoryTaskQueue): The queue shared
+      with the workers.
+    - poll_interval (float, optional): Seconds between two polls of the queue.
+    - render_workers (int, optional): Maximum number of reports rendered at once.
+    - report_store (ReportStore, optional): Stores the outputs of a structured chain.
+    - history (RunHistory, optional): The history every seed's run is recorded in.
+    - preprocessor (SeedPreprocessor, optional): Cleans up the seeds.
+
+    Returns:
+    - list: A result like that of run_batch for each seed file, in the same order.
+      The duration of each seed is that of the whole run.
+    """
+    results = [
+        {
+            "seed_file": seed_file,
+            "report_files": {},
+            "total_tokens": 0,
+            "total_cost": 0.0,
+            "duration": 0.0,
+            "error": None,
+            "stages": [],
+        }
+        for seed_file in seed_files
+    ]
+    seeds, errors = read_seeds(seed_files, preprocessor)
+    duplicates = find_duplicate_seeds(seeds)
+    values, queued = [], {}
+    for i, result in enumerate(results):
+        result["error"] = errors[i]
+        if seeds[i] is None or i in duplicates:
+            values.append(None)
+            continue
+        values.append({"seed": seeds[i]})
+        queued[seed_hash(seeds[i])[:16]] = i
+
+    job = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{os.urandom(3).hex()}"
+    # The chains in the order of the configuration, where each stage comes
+    # after the stages it depends on
+    order = {
+        key: n for n, stage in enumerate(chain.chains) for key in stage.output_keys
+    }
+    with measure_time() as duration:
+        try:
+            task_queue.add(
+                job,
+                {seed_id: values[i] for seed_id, i in queued.items()},
+                build_dependency_graph(chain.chains),
+            )
+            click.secho(
+                f"Queued job {job}: {len(queued) * len(order)} tasks for "
+                f"{len(queued)} seeds",
+                fg="cyan",
+            )
+            finished = None
+            while True:
+                counts = task_queue.counts(job)
+                if counts["done"] + counts["failed"] != finished:
+                    finished = counts["done"] + counts["failed"]
+                    click.secho(
+                        f"Tasks: {counts['done']} done, {counts['failed']} failed, "
+                        f"{counts['running']} running, {counts['pending']} pending",
+                        fg="cyan",
+                    )
+                if not (counts["pending"] or counts["running"]):
+                    break
+                time.sleep(poll_interval)
+            tasks = task_queue.tasks(job)
+        finally:
+            task_queue.remove(job)
+
+        for task in sorted(tasks, key=lambda task: order[task["stage"]]):
+            i = queued[task["seed_id"]]
+            results[i]["stages"] += task["records"]
+            if task["status"] == "done":
+                values[i][task["stage"]] = task["output"]
+            elif results[i]["error"] is None:
+                results[i]["error"] = f"{task['stage']}: {task['error']}"
+
+        render_seed_reports(
+            chain,
+            results,
+            seeds,
+            values,
+            duplicates,
+            output_dir,
+            formats,
+            duration,
+            render_workers,
+            report_store,
+            history,
+        )
+    return results
+
+
+def run_worker(
+    chain,
+    task_queue,
+    worker_id,
+    poll_interval=DEFAULT_QUEUE_POLL_INTERVAL,
+    exit_when_empty=False,
+):
+    """
+    Claims the tasks of a task queue and runs them, one at a time.
+
+    Any number of workers, on any number of hosts, can share a queue. A worker
+    waiting for tasks polls the queue every poll_interval seconds.
+
+    Parameters:
+    - chain (DependencyGraphChain): The chain whose stages the tasks run. It must
+      be built from the same configuration as that of the coordinator.
+    - task_queue (SQLiteTaskQueue or DirectoryTaskQueue): The queue.
+    - worker_id (str): The ID of the worker, unique among those of the queue.
+    - poll_interval (float, optional): Seconds between two polls of the queue.
+    - exit_when_empty (bool, optional): Return once the queue has no pending or
+      running tasks, instead of waiting for new jobs.
+
+    Returns:
+    - int: The number of tasks run.
+    """
+    count = 0
+    while True:
+        task = task_queue.claim(worker_id)
+        if task is not None:
+            run_task(chain, task_queue, task, worker_id)
+            count += 1
+            continue
+        if exit_when_empty:
+            counts = task_queue.counts()
+            if not (counts["pending"] or counts["running"]):
+                return count
+        time.sleep(poll_interval)
+
+
+def run_task(chain, task_queue, task, worker_id):
+    """
+    Run a claimed task and save its output or error in the queue.
+
+    Its lease is renewed every third of the lease while it runs. If the lease
+    expired anyway, e.g. because the worker was suspended, its result is dropped,
+    as another worker may have claimed the task.
+
+    Parameters:
+    - chain (DependencyGraphChain): The chain whose stage the task runs.
+    - task_queue (SQLiteTaskQueue or DirectoryTaskQueue): The queue.
+    - task (dict): The task, as returned by the queue's claim.
+    - worker_id (str): The ID of the worker that claimed it.
+
+    Returns:
+    - bool: Whether the task succeeded and its output was saved.
+    """
+    stop = threading.Event()
+
+    def renew_lease():
+        while not stop.wait(task_queue.lease / 3):
+            if not task_queue.heartbeat(task, worker_id):
+                return
+
+    heartbeat = threading.Thread(target=renew_lease, daemon=True)
+    heartbeat.start()
+    monitor = CallbackHandler(chain.tokenizer)
+    output, error = None, None
+    try:
+        output = chain.run_stage(task["stage"], task["inputs"], [monitor])[
+            task["stage"]
+        ]
+    except Exception as e:
+        error = str(e) or e.__class__.__name__
+    finally:
+        stop.set()
+        heartbeat.join()
+
+    if error is None:
+        saved = task_queue.complete(task, worker_id, output, monitor.records)
+    else:
+        click.secho(
+            f"Task {task['id']} failed on attempt {task['attempts']}: {error}",
+            fg="red",
+        )
+        saved = task_queue.fail(task, worker_id, error, monitor.records)
+    if not saved:
+        click.secho(
+            f"The lease of task {task['id']} expired before it finished; "
+            "its result was dropped",
+            fg="yellow",
+        )
+    return saved and error is None
+
+
+class ReportJobs:
+    """
+    Runs the report jobs submitted to the server and keeps track of them.
+
+    Every job writes its seed to "<job id>.seed.md" in the output directory and
+    its report to "<job id>.<format>", using the chain that was built when the
+    server started. The status of the most recent jobs is kept in memory.
+
+    Attributes:
+        chain (Chain): The chain shared by all jobs.
+        output_dir (str): The directory the seeds and reports are written to.
+        formats (list): The report formats created when a job does not ask for others.
+        renderer (ReportRenderer, optional): Renders the reports; if None, each
+            job renders its own report.
+        max_jobs (int): Number of finished jobs whose status is kept.
+        seed_cache (SeedCache, optional): Reuses the outputs of similar earlier seeds.
+        report_store (ReportStore, optional): Stores the outputs of a structured chain.
+        history (RunHistory, optional): The history every job is recorded in.
+        preprocessor (SeedPreprocessor, optional): Cleans up the seeds when
+            their jobs are submitted.
+    """
+
+    def __init__(
+        self,
+        chain,
+        output_dir,
+        formats,
+        max_workers,
+        renderer=None,
+        max_jobs=DEFAULT_MAX_JOBS,
+        seed_cache=None,
+        report_store=None,
+        history=None,
+        preprocessor=None,
+    ):
+        self.chain = chain
+        self.output_dir = output_dir
+        self.formats = formats
+        self.renderer = renderer
+        self.max_jobs = max_jobs
+        self.seed_cache = seed_cache
+        self.report_store = report_store
+        self.history = history
+        self.preprocessor = preprocessor
+        self._jobs = {}
+        self._monitors = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def submit(self, seed, formats=None):
+        """
+        Queue a job generating the report for a seed.
+
+        Parameters:
+        - seed (str): The contents of the seed.
+        - formats (list, optional): The report formats to create.
+
+        Returns:
+        - dict: The status of the new job.
+
+        Raises:
+        - ValueError: If the preprocessor rejects the seed.
+        """
+        if self.preprocessor:
+            seed = self.preprocessor.process(seed)
+        job_id = uuid.uuid4().hex
+        os.makedirs(self.output_dir, exist_ok=True)
+        seed_file = os.path.join(self.output_dir, f"{job_id}.seed.md")
+        with open(seed_file, "w") as f:
+            f.write(seed)
+
+        job = {
+            "id": job_id,
+            "status": "queued",
+            "created": datetime.now().isoformat(),
+            "seed_file": seed_file,
+            "formats": formats or self.formats,
+            "report_files": {},
+            "total_tokens": 0,
+            "total_cost": 0.0,
+            "duration": 0.0,
+            "error": None,
+        }
+        with self._lock:
+            self._jobs[job_id] = job
+            self._monitors[job_id] = CallbackHandler(self.chain.tokenizer)
+            self._forget_finished_jobs()
+        self._executor.submit(self._run, job_id)
+        return self.get(job_id)
+
+    def get(self, job_id):
+        """
+        Return the status of a job, including the stages it has finished.
+
+        Parameters:
+        - job_id (str): The ID of the job.
+
+        Returns:
+        - dict: The status of the job, or None if there is no such job.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            records = list(self._monitors[job_id].records)
+            return {
+                **job,
+                "progress": {
+                    "stages": [record["stage"] for record in records],
+                    "completed": len(records),
+                    "total": len(self.chain.chains),
+                },
+            }
+
+    def list(self):
+        """
+        Return the status of all known jobs, oldest first.
+        """
+        with self._lock:
+            job_ids = list(self._jobs)
+        return [job for job in map(self.get, job_ids) if job is not None]
+
+    def shutdown(self):
+        """
+        Cancel the queued jobs and wait for the running ones to finish.
+        """
+        self._executor.shutdown(cancel_futures=True)
+
+    def _run(self, job_id):
+        with self._lock:
+            job = self._jobs[job_id]
+            job["status"] = "running"
+            monitor = self._monitors[job_id]
+        result = run_seed(
+            self.chain,
+            job["seed_file"],
+            os.path.join(self.output_dir, job_id),
+            job["formats"],
+            renderer=self.renderer,
+            monitor=monitor,
+            seed_cache=self.seed_cache,
+            report_store=self.report_store,
+            history=self.history,
+        )
+        rendering = result.pop("rendering", None)
+        if rendering is not None:
+            try:
+                result["report_files"] = rendering.result()
+            except Exception as e:
+                result["error"] = str(e) or e.__class__.__name__
+        del result["stages"]
+        with self._lock:
+            job.update(result, status="failed" if result["error"] else "done")
+
+    def _forget_finished_jobs(self):
+        finished = [
+            job_id
+            for job_id, job in self._jobs.items()
+            if job["status"] in ("done", "failed")
+        ]
+        for job_id in finished[: max(0, len(finished) - self.max_jobs)]:
+            del self._jobs[job_id]
+            del self._monitors[job_id]
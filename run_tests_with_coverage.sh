@@ -1 +1 @@
-pytest --cov=business_modeler --cov-report html
\ No newline at end of file
+pytest --cov=business_modeler --cov=business_modeler_chains --cov-report html
\ No newline at end of file
@@ -0,0 +1,160 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import ANY, MagicMock, patch
+
+from click.testing import CliRunner
+
+import business_modeler
+from business_modeler import find_seed_files, report_batch_results
+from business_modeler_chains import run_batch, run_seed
+
+
+class TestFindSeedFiles(unittest.TestCase):
+    def test_find_seed_files_matches_pattern(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for name in ["b.md", "a.md", "notes.txt"]:
+                with open(os.path.join(tmp_dir, name), "w") as f:
+                    f.write("seed")
+            os.mkdir(os.path.join(tmp_dir, "dir.md"))
+
+            self.assertEqual(
+                find_seed_files(tmp_dir, "*.md"),
+                [os.path.join(tmp_dir, "a.md"), os.path.join(tmp_dir, "b.md")],
+            )
+
+
+@patch("business_modeler_chains.read_seed")
+@patch("business_modeler_chains.generate_report")
+class TestRunSeed(unittest.TestCase):
+    def test_run_seed_success(self, mock_generate_report, mock_read_seed):
+        mock_read_seed.return_value = "seed"
+        mock_generate_report.return_value = {"pdf": "out.pdf"}
+
+        def run_chain(inputs, callbacks):
+            callbacks[0].records.append({"total_tokens": 42, "cost": 0.5})
+            return {"canvas": "canvas"}
+
+        chain = MagicMock(side_effect=run_chain)
+
+        result = run_seed(chain, "seed.md", "out", ["pdf"])
+
+        chain.assert_called_once_with({"seed": "seed"}, callbacks=ANY)
+        mock_generate_report.assert_called_once_with("out", ["pdf"], canvas="canvas")
+        self.assertIsNone(result["error"])
+        self.assertEqual(result["report_files"], {"pdf": "out.pdf"})
+        self.assertEqual(result["total_tokens"], 42)
+        self.assertEqual(result["total_cost"], 0.5)
+
+    def test_run_seed_captures_errors(self, mock_generate_report, mock_read_seed):
+        mock_read_seed.return_value = "seed"
+        chain = MagicMock(side_effect=RuntimeError("API error"))
+
+        result = run_seed(chain, "seed.md", "out", ["pdf"])
+
+        self.assertEqual(result["error"], "API error")
+        self.assertEqual(result["report_files"], {})
+        mock_generate_report.assert_not_called()
+
+
+class TestRunBatch(unittest.TestCase):
+    @patch("business_modeler_chains.ReportRenderer")
+    @patch("business_modeler_chains.run_seed")
+    def test_run_batch_names_reports_after_seeds(self, mock_run_seed, mock_renderer):
+        mock_run_seed.side_effect = (
+            lambda chain, seed_file, output_file, *args, **kwargs: {
+                "seed_file": seed_file,
+                "output_file": output_file,
+            }
+        )
+        chain = MagicMock()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_dir = os.path.join(tmp_dir, "reports")
+            results = run_batch(
+                chain, ["seeds/a.md", "seeds/b.md"], output_dir, ["md"], 2
+            )
+
+            self.assertTrue(os.path.isdir(output_dir))
+        self.assertEqual(
+            [result["output_file"] for result in results],
+            [os.path.join(output_dir, "a"), os.path.join(output_dir, "b")],
+        )
+
+
+@patch("business_modeler.click.secho")
+def test_report_batch_results(mock_secho):
+    results = [
+        {
+            "seed_file": "a.md",
+            "report_files": {"pdf": "a.pdf"},
+            "total_tokens": 100,
+            "total_cost": 0.25,
+            "duration": 2.0,
+            "error": None,
+        },
+        {
+            "seed_file": "b.md",
+            "report_files": {},
+            "total_tokens": 50,
+            "total_cost": 0.5,
+            "duration": 1.0,
+            "error": "boom",
+        },
+    ]
+
+    report_batch_results(results, 3.0)
+
+    mock_secho.assert_any_call("Failed: b.md: boom", fg="red")
+    mock_secho.assert_any_call("Seeds: 1 succeeded, 1 failed", fg="yellow")
+    mock_secho.assert_any_call("Total tokens: 150", fg="yellow")
+    mock_secho.assert_any_call("Total cost: $0.75", fg="yellow")
+
+
+class TestMainBatch(unittest.TestCase):
+    @patch("business_modeler.check_templates")
+    @patch("business_modeler.report_batch_results")
+    @patch("business_modeler_chains.run_batch")
+    @patch("business_modeler_chains.build_chain")
+    @patch("business_modeler.find_seed_files")
+    @patch("business_modeler.load_chain_config")
+    @patch("business_modeler.check_api_key")
+    def test_main_batch(
+        self,
+        mock_check_api_key,
+        mock_load_chain_config,
+        mock_find_seed_files,
+        mock_build_chain,
+        mock_run_batch,
+        mock_report_batch_results,
+        mock_check_templates,
+    ):
+        mock_load_chain_config.return_value = {"chains": "config", "batch_workers": 3}
+        mock_find_seed_files.return_value = ["a.md", "b.md"]
+        mock_run_batch.return_value = [{"error": None}, {"error": "boom"}]
+
+        runner = CliRunner()
+        result = runner.invoke(
+            business_modeler.main, ["--seed-dir", "seeds", "--output-dir", "out"]
+        )
+
+        # A failed seed is reported through the exit code
+        self.assertEqual(result.exit_code, 1)
+        mock_find_seed_files.assert_called_once_with("seeds", "*.md")
+        mock_build_chain.assert_called_once()
+        mock_run_batch.assert_called_once_with(
+            mock_build_chain.return_value,
+            ["a.md", "b.md"],
+            "out",
+            ["pdf"],
+            3,
+            False,
+            False,
+            2,
+            None,
+            None,
+            ANY,
+            ANY,
+        )
+        mock_report_batch_results.assert_called_once_with(
+            mock_run_batch.return_value, ANY
+        )
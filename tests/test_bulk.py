@@ -0,0 +1,190 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import yaml
+from click.testing import CliRunner
+
+import business_modeler
+from business_modeler import load_chain_config
+from business_modeler_chains import (
+    LocalBatchClient,
+    MockChatModel,
+    batch_response,
+    build_chain,
+    chat_request,
+    run_bulk,
+)
+
+
+class FailingBatchClient(LocalBatchClient):
+    # Drops the responses of the requests of one seed
+    def __init__(self, batch_dir, failing_seed):
+        super().__init__(batch_dir)
+        self.failing_seed = failing_seed
+        self.batches = 0
+
+    def submit(self, requests):
+        self.batches += 1
+        return super().submit(requests)
+
+    def results(self, batch):
+        return [
+            line
+            for line in super().results(batch)
+            if not line["custom_id"].startswith(f"{self.failing_seed}-")
+        ]
+
+
+class TestLocalBatchClient(unittest.TestCase):
+    def test_round_trip(self):
+        llm = MockChatModel(responses={"Risks": "# Risks"})
+        with tempfile.TemporaryDirectory() as temp_dir:
+            client = LocalBatchClient(temp_dir, llm)
+            batch_id = client.submit(
+                [
+                    chat_request("0-risks", llm, 'The title "Risks".'),
+                    chat_request("1-risks", llm, 'The title "Risks".'),
+                ]
+            )
+
+            batch = client.retrieve(batch_id)
+            lines = client.results(batch)
+
+        self.assertEqual(batch["status"], "completed")
+        self.assertEqual([line["custom_id"] for line in lines], ["0-risks", "1-risks"])
+        text, usage, error = batch_response(lines[0])
+        self.assertEqual(text, "# Risks")
+        self.assertEqual(usage["completion_tokens"], 2)
+        self.assertIsNone(error)
+
+    def test_batch_response_errors(self):
+        self.assertEqual(
+            batch_response(None)[2], "The batch has no response for this request"
+        )
+        self.assertEqual(
+            batch_response({"error": {"message": "Invalid model"}})[2], "Invalid model"
+        )
+        self.assertEqual(
+            batch_response({"response": {"status_code": 500, "body": {}}})[2],
+            "HTTP 500",
+        )
+
+
+class TestRunBulk(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.seed_files = []
+        for name in ["coffee", "bakery", "dentists"]:
+            seed_file = os.path.join(self.temp_dir.name, f"{name}.md")
+            with open(seed_file, "w") as f:
+                f.write(f"An idea about {name}")
+            self.seed_files.append(seed_file)
+        self.chain = build_chain(
+            None,
+            load_chain_config("config.yaml")["chains"],
+            "templates",
+            "_common.txt",
+            backend="mock",
+        )
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def run_bulk(self, client):
+        return run_bulk(
+            self.chain,
+            self.seed_files,
+            os.path.join(self.temp_dir.name, "reports"),
+            ["md"],
+            client,
+            poll_interval=0,
+        )
+
+    def test_creates_reports_with_one_batch_per_wave(self):
+        client = FailingBatchClient(os.path.join(self.temp_dir.name, "batches"), None)
+
+        results = self.run_bulk(client)
+
+        # canvas, then assumptions and alternatives, then risks, then experiments
+        self.assertEqual(client.batches, 4)
+        for result in results:
+            self.assertIsNone(result["error"])
+            self.assertEqual(len(result["stages"]), 5)
+            self.assertGreater(result["total_tokens"], 0)
+            with open(result["report_files"]["md"]) as f:
+                self.assertIn("# Risks", f.read())
+        with open(results[1]["report_files"]["md"]) as f:
+            self.assertIn("An idea about bakery", f.read())
+
+    def test_failed_requests_fail_their_seed(self):
+        client = FailingBatchClient(os.path.join(self.temp_dir.name, "batches"), 1)
+
+        results = self.run_bulk(client)
+
+        self.assertIsNone(results[0]["error"])
+        self.assertEqual(
+            results[1]["error"], "canvas: The batch has no response for this request"
+        )
+        self.assertEqual(results[1]["report_files"], {})
+        self.assertEqual(len(results[1]["stages"]), 1)
+        self.assertIsNone(results[2]["error"])
+
+
+class TestMainBulk(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        config = load_chain_config("config.yaml")
+        config.update(
+            backend="mock",
+            cache={"enabled": False},
+            history_file=os.path.join(self.temp_dir.name, "history.db"),
+            bulk={"dir": os.path.join(self.temp_dir.name, "batches")},
+        )
+        self.config_file = os.path.join(self.temp_dir.name, "config.yaml")
+        with open(self.config_file, "w") as f:
+            yaml.safe_dump(config, f)
+        self.seed_dir = os.path.join(self.temp_dir.name, "seeds")
+        os.makedirs(self.seed_dir)
+        for name in ["coffee", "bakery"]:
+            with open(os.path.join(self.seed_dir, f"{name}.md"), "w") as f:
+                f.write(f"An idea about {name}")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_bulk_batch(self):
+        output_dir = os.path.join(self.temp_dir.name, "reports")
+
+        result = CliRunner().invoke(
+            business_modeler.main,
+            [
+                "--config-file",
+                self.config_file,
+                "--format",
+                "md",
+                "--seed-dir",
+                self.seed_dir,
+                "--output-dir",
+                output_dir,
+                "--bulk",
+            ],
+        )
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(result.output.count("Submitted batch"), 4)
+        self.assertEqual(sorted(os.listdir(output_dir)), ["bakery.md", "coffee.md"])
+
+    @patch("business_modeler.read_seed", return_value="seed")
+    def test_requires_seed_dir(self, _):
+        result = CliRunner().invoke(
+            business_modeler.main, ["--config-file", self.config_file, "--bulk"]
+        )
+
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("--bulk requires --seed-dir", result.output)
+
+
+if __name__ == "__main__":
+    unittest.main()
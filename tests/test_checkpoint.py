@@ -0,0 +1,149 @@
+import os
+import re
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import yaml
+from click.testing import CliRunner
+
+import business_modeler
+from business_modeler import RunCheckpoint, load_chain_config
+from business_modeler_chains import mock_response
+
+
+class TestRunCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_saves_and_loads_stages(self):
+        checkpoint = RunCheckpoint.create(self.temp_dir.name, "An idea", "report")
+        checkpoint.save_stage("canvas", "The canvas")
+        checkpoint.save_stage("risks", "The risks")
+
+        run, outputs = RunCheckpoint(checkpoint.run_dir).load()
+
+        self.assertEqual(run, {"seed": "An idea", "output_file": "report"})
+        self.assertEqual(outputs, {"canvas": "The canvas", "risks": "The risks"})
+        self.assertEqual(
+            [name for name in os.listdir(checkpoint.run_dir) if name.endswith(".tmp")],
+            [],
+        )
+
+        checkpoint.remove()
+        self.assertFalse(os.path.exists(checkpoint.run_dir))
+
+    def test_missing_run(self):
+        with self.assertRaises(FileNotFoundError):
+            RunCheckpoint(os.path.join(self.temp_dir.name, "unknown")).load()
+
+
+class TestResume(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.runs_dir = os.path.join(self.temp_dir.name, "runs")
+        config = load_chain_config("config.yaml")
+        config.update(
+            backend="mock",
+            runs_dir=self.runs_dir,
+            cache={"enabled": False},
+            history_file=os.path.join(self.temp_dir.name, "history.db"),
+        )
+        self.config_file = os.path.join(self.temp_dir.name, "config.yaml")
+        with open(self.config_file, "w") as f:
+            yaml.safe_dump(config, f)
+        self.seed_file = os.path.join(self.temp_dir.name, "seed.md")
+        with open(self.seed_file, "w") as f:
+            f.write("A coffee shop that delivers with drones")
+        self.output_file = os.path.join(self.temp_dir.name, "report")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def run_main(self, *args):
+        return CliRunner().invoke(
+            business_modeler.main,
+            ["--config-file", self.config_file, "--format", "md", *args],
+        )
+
+    def test_resumes_from_first_missing_stage(self):
+        def failing_response(prompt):
+            if "alternative business models" in prompt:
+                raise ConnectionError("network down")
+            return mock_response(prompt)
+
+        with patch("business_modeler_chains.mock_response", failing_response):
+            result = self.run_main(
+                "--seed-file", self.seed_file, "--output-file", self.output_file
+            )
+        self.assertIsInstance(result.exception, ConnectionError)
+        run_id = re.search(r"--resume (\S+)", result.output).group(1)
+        _, outputs = RunCheckpoint(os.path.join(self.runs_dir, run_id)).load()
+        self.assertNotIn("alternatives", outputs)
+        self.assertIn("canvas", outputs)
+
+        with patch(
+            "business_modeler_chains.mock_response", wraps=mock_response
+        ) as mock_mock_response:
+            result = self.run_main("--resume", run_id)
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Reusing output for chain 'canvas'", result.output)
+        self.assertEqual(mock_mock_response.call_count, 5 - len(outputs))
+        with open(f"{self.output_file}.md") as f:
+            report = f.read()
+        self.assertIn("A coffee shop that delivers with drones", report)
+        self.assertIn("Alternative", report)
+        self.assertFalse(os.path.exists(os.path.join(self.runs_dir, run_id)))
+
+    def test_resume_runs_stages_failing_validation_again(self):
+        short = "# Assumptions\n\n1. One assumption."
+        config = load_chain_config(self.config_file)
+        config["mock"]["responses"] = {"Assumptions": short}
+        failing_config_file = os.path.join(self.temp_dir.name, "failing.yaml")
+        with open(failing_config_file, "w") as f:
+            yaml.safe_dump(config, f)
+
+        result = CliRunner().invoke(
+            business_modeler.main,
+            [
+                "--config-file",
+                failing_config_file,
+                "--seed-file",
+                self.seed_file,
+                "--output-file",
+                self.output_file,
+            ],
+        )
+        self.assertEqual(result.exit_code, 1, result.output)
+        self.assertIsInstance(result.exception, SystemExit)
+        self.assertIn(
+            "Error: The output of chain 'assumptions' failed validation", result.output
+        )
+        run_id = re.search(r"--resume (\S+)", result.output).group(1)
+        checkpoint = RunCheckpoint(os.path.join(self.runs_dir, run_id))
+        _, outputs = checkpoint.load()
+        self.assertIn("canvas", outputs)
+        self.assertNotIn("assumptions", outputs)
+
+        # Checkpoints saved by earlier versions may hold outputs failing validation
+        checkpoint.save_stage("assumptions", short)
+        result = self.run_main("--resume", run_id)
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Running chain 'assumptions' again", result.output)
+        with open(f"{self.output_file}.md") as f:
+            self.assertNotIn(short, f.read())
+
+    def test_unknown_run(self):
+        result = self.run_main("--resume", "unknown")
+
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("there is no run unknown to resume", result.output)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,49 +1,50 @@
 import unittest
-from unittest.mock import MagicMock, patch
+from unittest.mock import ANY, MagicMock, patch
 
-from business_modeler import CallbackHandler, build_chain, create_llm_chain
+from business_modeler import CompiledTemplate
+from business_modeler_chains import CallbackHandler, build_chain, create_llm_chain
 
 
 class TestCreateLLMChain(unittest.TestCase):
-    @patch("business_modeler.LLMChain")
-    @patch("business_modeler.CallbackHandler")
-    @patch("business_modeler.extract_variable_names")
-    @patch("business_modeler.read_prompt_template")
+    @patch("business_modeler_chains.LLMChain")
+    @patch("business_modeler_chains.CallbackHandler")
+    @patch("business_modeler_chains.get_template_registry")
     def test_create_llm_chain(
         self,
-        mock_read_prompt_template,
-        mock_extract_variable_names,
+        mock_get_template_registry,
         mock_callback_handler,
         mock_llm_chain,
     ):
         # Mocking the return values
-        mock_read_prompt_template.return_value = "{var1} {var2}"
-        mock_extract_variable_names.return_value = ["var1", "var2"]
+        mock_get_template_registry.return_value.prompt.return_value = CompiledTemplate(
+            "{var1} {var2}", ("var1", "var2")
+        )
 
         # Calling the function
         llm = MagicMock()
         create_llm_chain(llm, "template.txt", "dir", "common.txt")
 
         # Assertions
-        mock_read_prompt_template.assert_called_once_with(
-            "template.txt", "dir", "common.txt"
+        mock_get_template_registry.assert_called_once_with("dir", "common.txt")
+        mock_get_template_registry.return_value.prompt.assert_called_once_with(
+            "template.txt"
         )
-        mock_extract_variable_names.assert_called_once_with("{var1} {var2}")
         mock_llm_chain.assert_called_once()
+        prompt = mock_llm_chain.call_args.kwargs["prompt"]
+        self.assertEqual(prompt.input_variables, ["var1", "var2"])
+        self.assertEqual(prompt.template, "{var1} {var2}")
 
 
 class TestBuildChain(unittest.TestCase):
-    @patch("business_modeler.create_llm_chain")
-    @patch("business_modeler.SequentialChain")
-    @patch("business_modeler.ChatOpenAI")
-    @patch("business_modeler.extract_variable_names")
-    @patch("business_modeler.read_prompt_template")
+    @patch("business_modeler_chains.create_llm_chain")
+    @patch("business_modeler_chains.DependencyGraphChain")
+    @patch("business_modeler_chains.RateLimitedChatOpenAI")
+    @patch("business_modeler_chains.get_template_registry")
     def test_build_chain(
         self,
-        mock_read_prompt_template,
-        mock_extract_variable_names,
+        mock_get_template_registry,
         mock_chat_openai,
-        mock_sequential_chain,
+        mock_graph_chain,
         mock_create_llm_chain,
     ):
         # Sample chains_config
@@ -58,10 +59,62 @@ class TestBuildChain(unittest.TestCase):
 
         # Assertions
         mock_chat_openai.assert_called_once_with(
-            openai_api_key=api_key, model="gpt-3.5-turbo-16k", temperature=0.7
+            openai_api_key=api_key,
+            model="gpt-3.5-turbo-16k",
+            temperature=0.7,
+            streaming=False,
+            rate_limiter=ANY,
+            tokenizer="gpt2",
         )
         mock_create_llm_chain.assert_called()
-        mock_sequential_chain.assert_called_once()
+        mock_graph_chain.assert_called_once()
+
+    @patch("business_modeler_chains.create_llm_chain")
+    @patch("business_modeler_chains.DependencyGraphChain")
+    @patch("business_modeler_chains.RateLimitedChatOpenAI")
+    @patch("business_modeler_chains.get_template_registry")
+    def test_build_chain_per_stage_models(
+        self,
+        mock_get_template_registry,
+        mock_chat_openai,
+        mock_graph_chain,
+        mock_create_llm_chain,
+    ):
+        mock_chat_openai.side_effect = lambda **kwargs: MagicMock()
+        chains_config = [
+            {"template_file": "canvas.txt", "model_name": "gpt-4", "max_tokens": 2000},
+            {"template_file": "assumptions.txt"},
+            {"template_file": "risks.txt", "temperature": 0.2, "request_timeout": 30},
+            {"template_file": "experiments.txt"},
+        ]
+
+        build_chain("API_KEY", chains_config, "dir", "common.txt")
+
+        settings = [
+            {
+                key: value
+                for key, value in call.kwargs.items()
+                if key
+                not in ("openai_api_key", "streaming", "rate_limiter", "tokenizer")
+            }
+            for call in mock_chat_openai.call_args_list
+        ]
+        self.assertEqual(
+            settings,
+            [
+                {"model": "gpt-4", "temperature": 0.7, "max_tokens": 2000},
+                {"model": "gpt-3.5-turbo-16k", "temperature": 0.7},
+                {
+                    "model": "gpt-3.5-turbo-16k",
+                    "temperature": 0.2,
+                    "request_timeout": 30,
+                },
+            ],
+        )
+        # The stages without settings of their own share one model
+        llms = [call.args[0] for call in mock_create_llm_chain.call_args_list]
+        self.assertIs(llms[1], llms[3])
+        self.assertIsNot(llms[0], llms[1])
 
 
 def test_on_chain_start_output():
@@ -0,0 +1,110 @@
+import time
+import unittest
+from typing import Any, Dict, List
+
+from langchain.chains.base import Chain
+
+from business_modeler import build_dependency_graph
+from business_modeler_chains import DependencyGraphChain
+
+
+class FakeChain(Chain):
+    """Chain that joins its inputs after an optional delay."""
+
+    inputs: List[str]
+    output: str
+    delay: float = 0.0
+    calls: Any = None
+
+    @property
+    def _chain_type(self) -> str:
+        return "fake_chain"
+
+    @property
+    def input_keys(self) -> List[str]:
+        return self.inputs
+
+    @property
+    def output_keys(self) -> List[str]:
+        return [self.output]
+
+    def _call(self, inputs: Dict[str, Any], run_manager=None) -> Dict[str, str]:
+        self.calls.append((self.output, "start", time.monotonic()))
+        time.sleep(self.delay)
+        self.calls.append((self.output, "end", time.monotonic()))
+        value = "+".join(inputs[key] for key in self.inputs)
+        return {self.output: f"{self.output}({value})"}
+
+
+def make_chains(delay=0.0):
+    calls = []
+    chains = [
+        FakeChain(inputs=["seed"], output="canvas", delay=delay, calls=calls),
+        FakeChain(inputs=["canvas"], output="assumptions", delay=delay, calls=calls),
+        FakeChain(inputs=["assumptions"], output="risks", delay=delay, calls=calls),
+        FakeChain(
+            inputs=["seed", "canvas"], output="alternatives", delay=delay, calls=calls
+        ),
+    ]
+    return chains, calls
+
+
+class TestBuildDependencyGraph(unittest.TestCase):
+    def test_external_inputs_are_not_dependencies(self):
+        chains, _ = make_chains()
+        self.assertEqual(
+            build_dependency_graph(chains),
+            {
+                "canvas": [],
+                "assumptions": ["canvas"],
+                "risks": ["assumptions"],
+                "alternatives": ["canvas"],
+            },
+        )
+
+
+class TestDependencyGraphChain(unittest.TestCase):
+    def build(self, chains, **kwargs):
+        return DependencyGraphChain(
+            chains=chains,
+            input_variables=["seed"],
+            output_variables=[chain.output for chain in chains],
+            **kwargs,
+        )
+
+    def test_outputs_match_sequential_execution(self):
+        chains, _ = make_chains()
+        output = self.build(chains)({"seed": "s"})
+        self.assertEqual(output["canvas"], "canvas(s)")
+        self.assertEqual(output["risks"], "risks(assumptions(canvas(s)))")
+        self.assertEqual(output["alternatives"], "alternatives(s+canvas(s))")
+
+    def test_independent_chains_run_concurrently(self):
+        chains, calls = make_chains(delay=0.2)
+        self.build(chains)({"seed": "s"})
+        events = {(name, event): at for name, event, at in calls}
+        # "alternatives" only needs the canvas, so it overlaps "assumptions".
+        self.assertLess(
+            events[("alternatives", "start")], events[("assumptions", "end")]
+        )
+        self.assertGreaterEqual(
+            events[("alternatives", "start")], events[("canvas", "end")]
+        )
+
+    def test_max_workers_limits_concurrency(self):
+        chains, calls = make_chains(delay=0.05)
+        self.build(chains, max_workers=1)({"seed": "s"})
+        running = 0
+        for _, event, _ in sorted(calls, key=lambda call: call[2]):
+            running += 1 if event == "start" else -1
+            self.assertLessEqual(running, 1)
+
+    def test_errors_are_raised(self):
+        class FailingChain(FakeChain):
+            def _call(self, inputs, run_manager=None):
+                raise RuntimeError("boom")
+
+        chains, calls = make_chains()
+        chains[2] = FailingChain(inputs=["assumptions"], output="risks", calls=calls)
+        with self.assertRaises(RuntimeError):
+            self.build(chains)({"seed": "s"})
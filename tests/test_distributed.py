@@ -0,0 +1,219 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from click.testing import CliRunner
+
+import business_modeler
+from business_modeler import DirectoryTaskQueue, SQLiteTaskQueue, load_chain_config
+from business_modeler_chains import (
+    build_chain,
+    mock_response,
+    run_distributed,
+    run_worker,
+)
+
+GRAPH = {"canvas": [], "risks": ["canvas"]}
+
+
+class TaskQueueTests:
+    # Tests shared by both queue backends
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_claims_tasks_once_their_upstream_tasks_are_done(self):
+        queue = self.create_queue()
+        queue.add("job", {"a": {"seed": "An idea"}}, GRAPH)
+
+        canvas = queue.claim("w1")
+        self.assertEqual(canvas["stage"], "canvas")
+        self.assertEqual(canvas["inputs"], {"seed": "An idea"})
+        self.assertIsNone(queue.claim("w2"))
+        self.assertTrue(queue.heartbeat(canvas, "w1"))
+        self.assertFalse(queue.heartbeat(canvas, "w2"))
+        self.assertTrue(queue.complete(canvas, "w1", "# Canvas", [{"stage": "canvas"}]))
+
+        risks = queue.claim("w2")
+        self.assertEqual(risks["stage"], "risks")
+        self.assertEqual(risks["inputs"], {"seed": "An idea", "canvas": "# Canvas"})
+        self.assertEqual(
+            queue.counts("job"), {"pending": 0, "running": 1, "done": 1, "failed": 0}
+        )
+        tasks = {task["stage"]: task for task in queue.tasks("job")}
+        self.assertEqual(tasks["canvas"]["output"], "# Canvas")
+        self.assertEqual(tasks["canvas"]["records"], [{"stage": "canvas"}])
+
+        queue.remove("job")
+        self.assertEqual(queue.tasks("job"), [])
+
+    def test_failed_task_is_retried_then_fails_its_seed(self):
+        queue = self.create_queue(max_attempts=2)
+        queue.add("job", {"a": {"seed": "An idea"}, "b": {"seed": "Other"}}, GRAPH)
+
+        first = queue.claim("w1")
+        self.assertTrue(queue.fail(first, "w1", "Timeout"))
+        retried = queue.claim("w1")
+        self.assertEqual((retried["id"], retried["attempts"]), (first["id"], 2))
+        self.assertTrue(queue.fail(retried, "w1", "Timeout again"))
+
+        tasks = {task["id"]: task for task in queue.tasks("job")}
+        self.assertEqual(tasks["job-a-canvas"]["status"], "failed")
+        self.assertEqual(tasks["job-a-canvas"]["error"], "Timeout again")
+        self.assertEqual(tasks["job-a-risks"]["status"], "failed")
+        self.assertEqual(
+            tasks["job-a-risks"]["error"], "Not run, as chain 'canvas' failed"
+        )
+        self.assertEqual(tasks["job-b-canvas"]["status"], "pending")
+
+    def test_expired_lease_is_claimed_again(self):
+        queue = self.create_queue(lease=0.2)
+        queue.add("job", {"a": {"seed": "An idea"}}, {"canvas": []})
+        stalled = queue.claim("w1")
+
+        time.sleep(0.5)
+        reclaimed = queue.claim("w2")
+
+        self.assertEqual((reclaimed["id"], reclaimed["attempts"]), (stalled["id"], 2))
+        self.assertFalse(queue.heartbeat(stalled, "w1"))
+        self.assertFalse(queue.complete(stalled, "w1", "Late"))
+        self.assertTrue(queue.complete(reclaimed, "w2", "# Canvas"))
+        (task,) = queue.tasks("job")
+        self.assertEqual((task["status"], task["output"]), ("done", "# Canvas"))
+
+    def test_runs_seeds_on_workers(self):
+        queue = self.create_queue()
+        chain = build_chain(
+            None,
+            load_chain_config("config.yaml")["chains"],
+            "templates",
+            "_common.txt",
+            backend="mock",
+        )
+        seed_files = []
+        for name in ["coffee", "bakery", "coffee-again"]:
+            seed_files.append(os.path.join(self.temp_dir.name, f"{name}.md"))
+            with open(seed_files[-1], "w") as f:
+                f.write(f"An idea about {name.split('-')[0]}")
+        output_dir = os.path.join(self.temp_dir.name, "reports")
+        results = []
+        coordinator = threading.Thread(
+            target=lambda: results.extend(
+                run_distributed(
+                    chain, seed_files, output_dir, ["md"], queue, poll_interval=0.05
+                )
+            )
+        )
+        coordinator.start()
+        while not queue.counts()["pending"]:
+            time.sleep(0.01)
+
+        counts = []
+        workers = [
+            threading.Thread(
+                target=lambda worker_id=worker_id: counts.append(
+                    run_worker(
+                        chain,
+                        queue,
+                        worker_id,
+                        poll_interval=0.05,
+                        exit_when_empty=True,
+                    )
+                )
+            )
+            for worker_id in ["w1", "w2"]
+        ]
+        for worker in workers:
+            worker.start()
+        for thread in [*workers, coordinator]:
+            thread.join()
+
+        self.assertEqual(sum(counts), 10)
+        self.assertEqual([result["error"] for result in results], [None] * 3)
+        self.assertEqual(
+            [record["stage"] for record in results[1]["stages"]],
+            ["canvas", "assumptions", "risks", "experiments", "alternatives"],
+        )
+        with open(results[2]["report_files"]["md"]) as f:
+            self.assertIn("An idea about coffee", f.read())
+        self.assertEqual(queue.counts(), dict.fromkeys(queue.counts(), 0))
+
+    def test_failed_stage_fails_its_seed(self):
+        queue = self.create_queue(max_attempts=1)
+        chain = build_chain(
+            None,
+            load_chain_config("config.yaml")["chains"],
+            "templates",
+            "_common.txt",
+            backend="mock",
+        )
+        seed_file = os.path.join(self.temp_dir.name, "seed.md")
+        with open(seed_file, "w") as f:
+            f.write("An idea")
+
+        def failing_response(prompt):
+            if "overall assumptions" in prompt:
+                raise ConnectionError("network down")
+            return mock_response(prompt)
+
+        def work():
+            while not queue.counts()["pending"]:
+                time.sleep(0.01)
+            run_worker(chain, queue, "w1", poll_interval=0.05, exit_when_empty=True)
+
+        worker = threading.Thread(target=work)
+        with patch("business_modeler_chains.mock_response", failing_response):
+            worker.start()
+            (result,) = run_distributed(
+                chain, [seed_file], self.temp_dir.name, ["md"], queue, 0.05
+            )
+            worker.join()
+
+        self.assertEqual(result["error"], "assumptions: network down")
+        self.assertEqual(result["report_files"], {})
+        stages = [record["stage"] for record in result["stages"]]
+        self.assertNotIn("risks", stages)
+
+
+class TestSQLiteTaskQueue(TaskQueueTests, unittest.TestCase):
+    def create_queue(self, **options):
+        return SQLiteTaskQueue(os.path.join(self.temp_dir.name, "queue.db"), **options)
+
+
+class TestDirectoryTaskQueue(TaskQueueTests, unittest.TestCase):
+    def create_queue(self, **options):
+        return DirectoryTaskQueue(os.path.join(self.temp_dir.name, "queue"), **options)
+
+    def test_keeps_first_output_of_task_finished_twice(self):
+        queue = self.create_queue()
+        queue.add("job", {"a": {"seed": "An idea"}}, {"canvas": []})
+        task = queue.claim("w1")
+        # Another worker finished the task while w1 still held its lease
+        queue._write("done", {**queue._read("running", task["id"]), "output": "First"})
+
+        self.assertFalse(queue.complete(task, "w1", "Second"))
+        (done,) = queue.tasks("job")
+        self.assertEqual((done["status"], done["output"]), ("done", "First"))
+        self.assertEqual(
+            os.listdir(os.path.join(queue.path, "done")), [f"{task['id']}.json"]
+        )
+
+
+class TestMainDistributed(unittest.TestCase):
+    @patch("business_modeler.read_seed", return_value="seed")
+    def test_requires_seed_dir(self, _):
+        result = CliRunner().invoke(
+            business_modeler.main, ["--backend", "mock", "--distributed"]
+        )
+
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("--distributed requires --seed-dir", result.output)
+
+
+if __name__ == "__main__":
+    unittest.main()
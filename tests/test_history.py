@@ -0,0 +1,198 @@
+import json
+import os
+import tempfile
+import unittest
+
+import yaml
+from click.testing import CliRunner
+
+import business_modeler
+from business_modeler import RunHistory, load_chain_config, seed_hash
+from business_modeler_chains import build_chain, run_seed
+
+
+def stage_record(stage, model="gpt-3.5-turbo-16k", cost=0.01, error=None):
+    return {
+        "stage": stage,
+        "model": model,
+        "start": 1.0,
+        "end": 2.0,
+        "duration": 1.0,
+        "time_to_first_token": None,
+        "prompt_tokens": 10,
+        "completion_tokens": 5,
+        "total_tokens": 15,
+        "cost": cost,
+        "reused": False,
+        "error": error,
+    }
+
+
+class TestRunHistory(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.history = RunHistory(
+            os.path.join(self.temp_dir.name, "history.db"),
+            {"model_name": "gpt-3.5-turbo-16k", "temperature": 0.7},
+        )
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_records_run_with_stages(self):
+        run_id = self.history.record(
+            "A coffee shop",
+            {"seed": "A coffee shop", "canvas": "The canvas"},
+            [stage_record("canvas"), stage_record("risks", error="timeout")],
+            seed_file="seed.md",
+            output_file="report",
+            total_tokens=30,
+            total_cost=0.02,
+            duration=2.5,
+        )
+
+        run = self.history.get(run_id)
+
+        self.assertEqual(run["seed_hash"], seed_hash("A coffee shop"))
+        self.assertEqual(run["config"]["temperature"], 0.7)
+        self.assertEqual(run["total_cost"], 0.02)
+        self.assertEqual(
+            [
+                (stage["stage"], stage["output"], stage["error"])
+                for stage in run["stages"]
+            ],
+            [("canvas", "The canvas", None), ("risks", None, "timeout")],
+        )
+        self.assertIsNone(self.history.get(run_id + 1))
+
+    def test_query(self):
+        coffee = self.history.record(
+            "A coffee shop", {}, [stage_record("canvas", model="gpt-4")], total_cost=1.5
+        )
+        bakery = self.history.record("A bakery for dogs", {}, [], total_cost=0.1)
+
+        def ids(**criteria):
+            return [run["id"] for run in self.history.query(**criteria)]
+
+        self.assertEqual(ids(), [bakery, coffee])
+        self.assertEqual(ids(limit=1), [bakery])
+        self.assertEqual(ids(seed_hash=seed_hash("A coffee shop")), [coffee])
+        self.assertEqual(ids(search="BAKERY"), [bakery])
+        self.assertEqual(ids(model_name="gpt-4"), [coffee])
+        self.assertEqual(ids(model_name="gpt-3.5-turbo-16k"), [bakery])
+        self.assertEqual(ids(min_cost=1.0), [coffee])
+        self.assertEqual(ids(since="2000-01-01"), [bakery, coffee])
+        self.assertEqual(ids(since="9999-01-01"), [])
+
+    def test_records_models_the_stages_used(self):
+        def model_name(stage_records, backend=None):
+            self.history.config["backend"] = backend
+            run_id = self.history.record("A coffee shop", {}, stage_records)
+            return self.history.get(run_id)["model_name"]
+
+        self.assertEqual(model_name([stage_record("canvas", model="mock")]), "mock")
+        self.assertEqual(
+            model_name(
+                [
+                    stage_record("canvas", model="gpt-4"),
+                    stage_record("risks"),
+                    stage_record("experiments", model=None, error="timeout"),
+                ]
+            ),
+            "gpt-3.5-turbo-16k, gpt-4",
+        )
+        self.assertEqual(model_name([], backend="mock"), "mock")
+        self.assertEqual(model_name([]), "gpt-3.5-turbo-16k")
+
+    def test_run_seed_records_failed_runs(self):
+        chain = build_chain(
+            None,
+            load_chain_config("config.yaml")["chains"],
+            "templates",
+            "_common.txt",
+            backend="mock",
+        )
+
+        result = run_seed(
+            chain,
+            os.path.join(self.temp_dir.name, "missing.md"),
+            os.path.join(self.temp_dir.name, "report"),
+            ["md"],
+            history=self.history,
+        )
+
+        (run,) = self.history.query()
+        self.assertEqual(run["error"], result["error"])
+        self.assertIsNone(run["seed_hash"])
+
+
+class TestHistoryCommand(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        config = load_chain_config("config.yaml")
+        config.update(
+            backend="mock",
+            runs_dir=os.path.join(self.temp_dir.name, "runs"),
+            cache={"enabled": False},
+            history_file=os.path.join(self.temp_dir.name, "history.db"),
+        )
+        self.config_file = os.path.join(self.temp_dir.name, "config.yaml")
+        with open(self.config_file, "w") as f:
+            yaml.safe_dump(config, f)
+        self.seed_file = os.path.join(self.temp_dir.name, "seed.md")
+        with open(self.seed_file, "w") as f:
+            f.write("A coffee shop that delivers with drones")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def invoke(self, *args):
+        result = CliRunner().invoke(
+            business_modeler.main, ["--config-file", self.config_file, *args]
+        )
+        self.assertEqual(result.exit_code, 0, result.output)
+        return result
+
+    def test_lists_and_shows_recorded_runs(self):
+        self.assertIn("No runs have been recorded", self.invoke("history").output)
+
+        self.invoke(
+            "--format",
+            "md",
+            "--seed-file",
+            self.seed_file,
+            "--output-file",
+            os.path.join(self.temp_dir.name, "report"),
+        )
+
+        listing = self.invoke("history", "--seed-file", self.seed_file).output
+        self.assertIn("A coffee shop that delivers with drones", listing)
+        (run,) = [
+            json.loads(line)
+            for line in self.invoke("history", "--json").output.splitlines()
+        ]
+        self.assertEqual(run["backend"], "mock")
+        shown = self.invoke("history", "--run", str(run["id"])).output
+        self.assertIn("## canvas (mock", shown)
+        self.assertIn("# Lean Business Model Canvas", shown)
+        self.assertEqual(self.invoke("history", "--search", "bakery").output, "")
+
+    def test_finds_runs_of_a_seed_file_needing_preprocessing(self):
+        with open(self.seed_file, "w") as f:
+            f.write("A coffee  shop\r\n\n## Who has this problem?\n\n")
+        self.invoke(
+            "--format",
+            "md",
+            "--seed-file",
+            self.seed_file,
+            "--output-file",
+            os.path.join(self.temp_dir.name, "report"),
+        )
+
+        listing = self.invoke("history", "--seed-file", self.seed_file).output
+
+        self.assertIn("A coffee shop", listing)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+import os
+import tempfile
+import unittest
+
+from langchain.chains import LLMChain
+from langchain.llms.fake import FakeListLLM
+from langchain.prompts import PromptTemplate
+
+from business_modeler import load_manifest
+from business_modeler_chains import DependencyGraphChain, run_chain, stage_fingerprints
+
+
+class RecordingLLM(FakeListLLM):
+    """
+    Fake LLM that answers with the response for the first word of the prompt
+    and records the prompts it was called with.
+    """
+
+    responses: dict
+    prompts: list = []
+
+    @property
+    def _identifying_params(self):
+        return {"model_name": "fake"}
+
+    def _call(self, prompt, stop=None, run_manager=None, **kwargs):
+        self.prompts.append(prompt)
+        return self.responses[prompt.split()[0]]
+
+
+def build(templates, responses):
+    llm = RecordingLLM(responses=responses, prompts=[])
+    chains = [
+        LLMChain(llm=llm, prompt=PromptTemplate.from_template(template), output_key=key)
+        for key, template in templates.items()
+    ]
+    chain = DependencyGraphChain(
+        chains=chains, input_variables=["seed"], output_variables=list(templates)
+    )
+    return chain, llm
+
+
+TEMPLATES = {
+    "canvas": "Canvas for {seed}",
+    "assumptions": "Assumptions in {canvas}",
+    "risks": "Risks in {assumptions}",
+    "alternatives": "Alternatives to {seed} and {canvas}",
+}
+
+
+RESPONSES = {"Canvas": "c", "Assumptions": "a", "Risks": "r", "Alternatives": "alt"}
+
+
+class TestStageFingerprints(unittest.TestCase):
+    def test_changing_a_template_changes_it_and_its_dependents(self):
+        chain, _ = build(TEMPLATES, {})
+        before = stage_fingerprints(chain, {"seed": "idea"})
+        chain, _ = build({**TEMPLATES, "assumptions": "Top 30 in {canvas}"}, {})
+        after = stage_fingerprints(chain, {"seed": "idea"})
+
+        self.assertEqual(before["canvas"], after["canvas"])
+        self.assertEqual(before["alternatives"], after["alternatives"])
+        self.assertNotEqual(before["assumptions"], after["assumptions"])
+        self.assertNotEqual(before["risks"], after["risks"])
+
+    def test_changing_the_seed_changes_every_stage(self):
+        chain, _ = build(TEMPLATES, {})
+        before = stage_fingerprints(chain, {"seed": "idea"})
+        after = stage_fingerprints(chain, {"seed": "other idea"})
+        for key in TEMPLATES:
+            self.assertNotEqual(before[key], after[key])
+
+
+class TestRunChainIncremental(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.manifest_file = os.path.join(self.tmp_dir.name, "report.manifest.json")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_without_manifest_every_stage_runs(self):
+        chain, llm = build(TEMPLATES, RESPONSES)
+        output = run_chain(chain, "idea")
+        self.assertEqual(len(llm.prompts), 4)
+        self.assertEqual(output["risks"], "r")
+        self.assertFalse(os.path.exists(self.manifest_file))
+
+    def test_only_invalidated_stages_rerun(self):
+        chain, _ = build(TEMPLATES, RESPONSES)
+        run_chain(chain, "idea", self.manifest_file)
+        self.assertEqual(
+            load_manifest(self.manifest_file)["stages"]["canvas"]["output"], "c"
+        )
+
+        chain, llm = build(
+            {**TEMPLATES, "risks": "Ranked risks in {assumptions}"}, {"Ranked": "r2"}
+        )
+        output = run_chain(chain, "idea", self.manifest_file)
+
+        self.assertEqual(llm.prompts, ["Ranked risks in a"])
+        self.assertEqual(output["canvas"], "c")
+        self.assertEqual(output["risks"], "r2")
+        self.assertEqual(
+            load_manifest(self.manifest_file)["stages"]["risks"]["output"], "r2"
+        )
+
+    def test_missing_manifest_runs_everything(self):
+        self.assertEqual(load_manifest(self.manifest_file), {"stages": {}})
+        chain, llm = build(TEMPLATES, RESPONSES)
+        run_chain(chain, "idea", self.manifest_file)
+        self.assertEqual(len(llm.prompts), 4)
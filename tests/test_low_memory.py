@@ -0,0 +1,194 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import yaml
+from click.testing import CliRunner
+
+import business_modeler
+from business_modeler import (
+    OutputSpill,
+    SpilledOutput,
+    discard_spilled,
+    generate_report,
+    load_chain_config,
+)
+from business_modeler_chains import build_chain, mock_response
+
+
+class TestOutputSpill(unittest.TestCase):
+    def test_write_and_discard(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            spill = OutputSpill(temp_dir)
+            handle = spill.write("canvas", "# Canvas ünïcode")
+
+            self.assertEqual(handle.read(), "# Canvas ünïcode")
+            self.assertEqual(f"{handle}", "# Canvas ünïcode")
+
+            discard_spilled({"seed": "An idea", "canvas": handle})
+            self.assertEqual(os.listdir(temp_dir), [])
+
+    def test_markdown_report_streams_spilled_outputs(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            spill = OutputSpill(temp_dir)
+            outputs = {
+                key: f"# {key.capitalize()}\n\n1. Item."
+                for key in ["canvas", "assumptions", "risks", "experiments"]
+            }
+            spilled = {key: spill.write(key, value) for key, value in outputs.items()}
+            plain_file = os.path.join(temp_dir, "plain")
+            spilled_file = os.path.join(temp_dir, "spilled")
+
+            generate_report(
+                plain_file, ["md"], seed="An idea", alternatives="Other", **outputs
+            )
+            generate_report(
+                spilled_file, ["md"], seed="An idea", alternatives="Other", **spilled
+            )
+
+            with open(f"{plain_file}.md") as plain, open(f"{spilled_file}.md") as f:
+                self.assertEqual(f.read(), plain.read())
+
+
+class TestSpillingChain(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.spill_dir = os.path.join(self.temp_dir.name, "spill")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def build_chain(self, spill_dir):
+        return build_chain(
+            None,
+            load_chain_config("config.yaml")["chains"],
+            "templates",
+            "_common.txt",
+            backend="mock",
+            spill_dir=spill_dir,
+        )
+
+    def test_returns_spilled_outputs(self):
+        expected = self.build_chain(None)({"seed": "An idea"}, callbacks=[])
+
+        output = self.build_chain(self.spill_dir)({"seed": "An idea"}, callbacks=[])
+
+        self.assertEqual(output["seed"], "An idea")
+        for key in ["canvas", "assumptions", "risks", "experiments", "alternatives"]:
+            self.assertIsInstance(output[key], SpilledOutput)
+            self.assertEqual(output[key].read(), expected[key])
+        discard_spilled(output)
+        self.assertEqual(os.listdir(self.spill_dir), [])
+
+    def test_failed_run_removes_spilled_outputs(self):
+        def failing_response(prompt):
+            if "alternative business models" in prompt:
+                raise ConnectionError("network down")
+            return mock_response(prompt)
+
+        with patch("business_modeler_chains.mock_response", failing_response):
+            with self.assertRaises(ConnectionError):
+                self.build_chain(self.spill_dir)({"seed": "An idea"}, callbacks=[])
+
+        self.assertEqual(os.listdir(self.spill_dir), [])
+
+
+class TestMainLowMemory(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.spill_dir = os.path.join(self.temp_dir.name, "spill")
+        self.history_file = os.path.join(self.temp_dir.name, "history.db")
+        config = load_chain_config("config.yaml")
+        config.update(
+            backend="mock",
+            cache={"enabled": False},
+            runs_dir=os.path.join(self.temp_dir.name, "runs"),
+            history_file=self.history_file,
+            spill_dir=self.spill_dir,
+        )
+        self.config_file = os.path.join(self.temp_dir.name, "config.yaml")
+        with open(self.config_file, "w") as f:
+            yaml.safe_dump(config, f)
+        self.seed_dir = os.path.join(self.temp_dir.name, "seeds")
+        os.makedirs(self.seed_dir)
+        for name in ["coffee", "bakery", "dentists"]:
+            with open(os.path.join(self.seed_dir, f"{name}.md"), "w") as f:
+                f.write(f"An idea about {name}")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_batch(self):
+        output_dir = os.path.join(self.temp_dir.name, "reports")
+
+        result = CliRunner().invoke(
+            business_modeler.main,
+            [
+                "--config-file",
+                self.config_file,
+                "--format",
+                "md,html",
+                "--seed-dir",
+                self.seed_dir,
+                "--output-dir",
+                output_dir,
+                "--low-memory",
+            ],
+        )
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        with open(os.path.join(output_dir, "bakery.md")) as f:
+            report = f.read()
+        self.assertIn("An idea about bakery", report)
+        self.assertIn("# Risks", report)
+        with open(os.path.join(output_dir, "bakery.html")) as f:
+            self.assertIn("<h1>Risks</h1>", f.read())
+        self.assertEqual(os.listdir(self.spill_dir), [])
+        with sqlite3.connect(self.history_file) as connection:
+            (output,) = connection.execute(
+                "SELECT output FROM stages WHERE stage = 'risks' LIMIT 1"
+            ).fetchone()
+        self.assertIn("# Risks", output)
+
+    @patch("business_modeler.generate_report", side_effect=OSError("PDF error"))
+    def test_failed_rendering_removes_spilled_outputs(self, _):
+        seed_file = os.path.join(self.seed_dir, "coffee.md")
+
+        result = CliRunner().invoke(
+            business_modeler.main,
+            [
+                "--config-file",
+                self.config_file,
+                "--seed-file",
+                seed_file,
+                "--output-file",
+                os.path.join(self.temp_dir.name, "report"),
+                "--low-memory",
+            ],
+        )
+
+        self.assertIsInstance(result.exception, OSError)
+        self.assertEqual(os.listdir(self.spill_dir), [])
+        self.assertEqual(os.listdir(os.path.join(self.temp_dir.name, "runs")), [])
+
+    def test_cannot_combine_with_bulk(self):
+        result = CliRunner().invoke(
+            business_modeler.main,
+            [
+                "--config-file",
+                self.config_file,
+                "--seed-dir",
+                self.seed_dir,
+                "--bulk",
+                "--low-memory",
+            ],
+        )
+
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("--low-memory cannot be combined", result.output)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,5 @@
 import unittest
-from unittest.mock import ANY, MagicMock, patch
+from unittest.mock import ANY, patch
 
 from click.testing import CliRunner
 
@@ -7,10 +7,12 @@ import business_modeler  # replace 'business_modeler' with the actual module nam
 
 
 class TestMainCommand(unittest.TestCase):
+    @patch("business_modeler.RunHistory")
+    @patch("business_modeler.RunCheckpoint")
+    @patch("business_modeler.check_templates")
     @patch("business_modeler.report_results")
     @patch("business_modeler.generate_report")
-    @patch("business_modeler.build_chain")
-    @patch("business_modeler.get_openai_callback")
+    @patch("business_modeler_chains.build_chain")
     @patch("business_modeler.measure_time")
     @patch("business_modeler.load_chain_config")
     @patch("business_modeler.read_seed")
@@ -21,19 +23,20 @@ class TestMainCommand(unittest.TestCase):
         mock_read_seed,
         mock_load_chain_config,
         mock_measure_time,
-        mock_get_openai_callback,
         mock_build_chain,
         mock_generate_report,
         mock_report_results,
+        mock_check_templates,
+        mock_run_checkpoint,
+        mock_run_history,
     ):
         # Mocking the necessary functions
         mock_check_api_key.return_value = "dummy_api_key"
         mock_read_seed.return_value = "seed"
         mock_load_chain_config.return_value = {"chains": "config"}
         mock_measure_time.return_value.__enter__.return_value = lambda: 0.1
-        mock_get_openai_callback.return_value.__enter__.return_value = MagicMock()
-        mock_build_chain.return_value = lambda x: {"output": "chain output"}
-        mock_generate_report.return_value = ("markdown_file_name", "pdf_file_name")
+        mock_build_chain.return_value = lambda x, **kwargs: {"output": "chain output"}
+        mock_generate_report.return_value = {"pdf": "pdf_file_name"}
 
         # Executing the command
         runner = CliRunner()
@@ -42,7 +45,32 @@ class TestMainCommand(unittest.TestCase):
         # Making sure the command executes without errors
         self.assertEqual(result.exit_code, 0)
 
+        # The templates are validated before the chain is built
+        mock_check_templates.assert_called_once_with(
+            "config", "templates", "_common.txt", structured=False
+        )
+
         # Making sure report_results is called with the correct arguments
         mock_report_results.assert_called_once_with(
-            False, "markdown_file_name", "pdf_file_name", ANY, 0.1
+            {"pdf": "pdf_file_name"}, ANY, 0.1, None
+        )
+
+        # The finished run's checkpoint is removed
+        mock_run_checkpoint.create.return_value.remove.assert_called_once()
+
+        # The run is recorded in the history
+        mock_run_history.return_value.record.assert_called_once_with(
+            "seed",
+            {"output": "chain output"},
+            [],
+            seed_file="seed.txt",
+            output_file=ANY,
+            total_tokens=ANY,
+            total_cost=ANY,
+            duration=0.1,
+        )
+
+        # Only the PDF is created by default
+        mock_generate_report.assert_called_once_with(
+            None, ["pdf"], output="chain output"
         )
@@ -0,0 +1,220 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+from business_modeler import (
+    count_tokens,
+    load_chain_config,
+    report_stage_metrics,
+    write_metrics,
+)
+from business_modeler_chains import (
+    CallbackHandler,
+    build_chain,
+    get_token_cost,
+    run_chain,
+)
+
+
+def llm_result(model, prompt_tokens, completion_tokens):
+    response = MagicMock()
+    response.llm_output = {
+        "model_name": model,
+        "token_usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+        },
+    }
+    return response
+
+
+def make_record(stage, duration, **kwargs):
+    return {
+        "stage": stage,
+        "model": "gpt-4",
+        "start": 0.0,
+        "end": duration,
+        "duration": duration,
+        "time_to_first_token": None,
+        "prompt_tokens": 10,
+        "completion_tokens": 20,
+        "total_tokens": 30,
+        "cost": 0.01,
+        "reused": False,
+        "error": None,
+        **kwargs,
+    }
+
+
+@patch("business_modeler.click.secho")
+class TestCallbackHandlerMetrics(unittest.TestCase):
+    def test_records_stage_tokens_and_cost(self, mock_secho):
+        handler = CallbackHandler()
+        handler.on_chain_start({}, {}, run_id="chain", tags=["canvas"])
+        handler.on_llm_new_token("a", run_id="llm", parent_run_id="chain")
+        handler.on_llm_end(
+            llm_result("gpt-4", 1000, 1000), run_id="llm", parent_run_id="chain"
+        )
+        handler.on_chain_end({"canvas": "text"}, run_id="chain")
+
+        [record] = handler.records
+        self.assertEqual(record["stage"], "canvas")
+        self.assertEqual(record["model"], "gpt-4")
+        self.assertEqual(record["prompt_tokens"], 1000)
+        self.assertEqual(record["completion_tokens"], 1000)
+        self.assertEqual(record["total_tokens"], 2000)
+        self.assertAlmostEqual(record["cost"], 0.09)
+        self.assertIsNotNone(record["time_to_first_token"])
+        self.assertGreaterEqual(record["duration"], 0)
+        self.assertFalse(record["reused"])
+
+    def test_counts_tokens_of_streamed_responses(self, mock_secho):
+        handler = CallbackHandler()
+        handler.on_chain_start({}, {}, run_id="chain", tags=["canvas"])
+        handler.on_llm_start(
+            {},
+            ["Write a canvas"],
+            run_id="llm",
+            parent_run_id="chain",
+            invocation_params={"model_name": "gpt-4", "stream": True},
+        )
+        response = MagicMock(llm_output=None)
+        response.generations = [[MagicMock(text="The canvas of the idea")]]
+        handler.on_llm_end(response, run_id="llm", parent_run_id="chain")
+        handler.on_chain_end({"canvas": "text"}, run_id="chain")
+
+        [record] = handler.records
+        prompt_tokens = count_tokens("Write a canvas")
+        completion_tokens = count_tokens("The canvas of the idea")
+        self.assertEqual(record["model"], "gpt-4")
+        self.assertEqual(record["prompt_tokens"], prompt_tokens)
+        self.assertEqual(record["completion_tokens"], completion_tokens)
+        self.assertAlmostEqual(
+            record["cost"], get_token_cost("gpt-4", prompt_tokens, completion_tokens)
+        )
+        self.assertEqual(handler.total_tokens, prompt_tokens + completion_tokens)
+
+    def test_records_tokens_of_streamed_runs(self, mock_secho):
+        chain = build_chain(
+            None,
+            load_chain_config("config.yaml")["chains"],
+            "templates",
+            "_common.txt",
+            streaming=True,
+            backend="mock",
+        )
+        handler = CallbackHandler()
+
+        run_chain(chain, "A coffee shop for dogs", callbacks=[handler])
+
+        self.assertEqual(len(handler.records), 5)
+        for record in handler.records:
+            self.assertEqual(record["model"], "mock")
+            self.assertGreater(record["prompt_tokens"], 0)
+            self.assertGreater(record["completion_tokens"], 0)
+
+    def test_ignores_the_chain_running_the_stages(self, mock_secho):
+        handler = CallbackHandler()
+        handler.on_chain_start({}, {}, run_id="graph", tags=[])
+        handler.on_chain_end({}, run_id="graph")
+        self.assertEqual(handler.records, [])
+        mock_secho.assert_not_called()
+
+    def test_records_reused_stages(self, mock_secho):
+        handler = CallbackHandler()
+        handler.on_chain_start({"reused": True}, {}, run_id="chain", tags=["risks"])
+        handler.on_chain_end({"risks": "text"}, run_id="chain")
+        self.assertTrue(handler.records[0]["reused"])
+        mock_secho.assert_called_once_with(
+            "Reusing output for chain 'risks'", fg="cyan"
+        )
+
+    def test_records_errors(self, mock_secho):
+        handler = CallbackHandler()
+        handler.on_chain_start({}, {}, run_id="chain", tags=["risks"])
+        handler.on_chain_error(RuntimeError("timeout"), run_id="chain")
+        self.assertEqual(handler.records[0]["error"], "timeout")
+
+
+class TestGetTokenCost(unittest.TestCase):
+    def test_known_model(self):
+        self.assertAlmostEqual(get_token_cost("gpt-4", 1000, 1000), 0.09)
+
+    def test_unknown_model(self):
+        self.assertEqual(get_token_cost("local-model", 1000, 1000), 0.0)
+        self.assertEqual(get_token_cost(None, 1000, 1000), 0.0)
+
+
+class TestWriteMetrics(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.metrics_file = os.path.join(self.tmp_dir.name, "metrics")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_jsonl_appends_one_line_per_stage(self):
+        write_metrics(self.metrics_file, "jsonl", [make_record("canvas", 1.0)])
+        write_metrics(self.metrics_file, "jsonl", [make_record("risks", 2.0)])
+        with open(self.metrics_file) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual([line["stage"] for line in lines], ["canvas", "risks"])
+
+    def test_prometheus_summaries_per_stage_and_model(self):
+        records = [
+            make_record("canvas", 1.0),
+            make_record("canvas", 3.0),
+            make_record("risks", 2.0),
+            make_record("risks", 0.0, reused=True),
+        ]
+        write_metrics(self.metrics_file, "prometheus", records)
+        with open(self.metrics_file) as f:
+            text = f.read()
+
+        self.assertIn("# TYPE business_modeler_stage_duration_seconds summary", text)
+        self.assertIn(
+            'business_modeler_stage_duration_seconds{stage="canvas",model="gpt-4",'
+            'quantile="0.5"} 3.0',
+            text,
+        )
+        self.assertIn(
+            'business_modeler_stage_duration_seconds_count{stage="canvas",'
+            'model="gpt-4"} 2',
+            text,
+        )
+        # Reused stages did not call the model, so are left out
+        self.assertIn(
+            'business_modeler_stage_duration_seconds_count{stage="risks",'
+            'model="gpt-4"} 1',
+            text,
+        )
+        self.assertNotIn("time_to_first_token_seconds{", text)
+
+    def test_prometheus_summaries_per_variant(self):
+        records = [
+            make_record("risks", 1.0, variant="focused"),
+            make_record("risks", 2.0, variant="creative"),
+        ]
+        write_metrics(self.metrics_file, "prometheus", records)
+        with open(self.metrics_file) as f:
+            text = f.read()
+
+        for variant in ["focused", "creative"]:
+            self.assertIn(
+                'business_modeler_stage_duration_seconds_count{stage="risks",'
+                f'model="gpt-4",variant="{variant}"}} 1',
+                text,
+            )
+
+
+@patch("business_modeler.click.secho")
+def test_report_stage_metrics(mock_secho):
+    report_stage_metrics(
+        [make_record("canvas", 1.5), make_record("risks", 0.0, reused=True)]
+    )
+    mock_secho.assert_any_call(
+        "  canvas: 1.50s, 10 prompt + 20 completion tokens, $0.01", fg="yellow"
+    )
+    mock_secho.assert_any_call("  risks: reused", fg="yellow")
@@ -0,0 +1,78 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+from langchain.schema import HumanMessage
+
+from benchmarks.bench_pipeline import find_regressions
+from business_modeler_chains import MockChatModel, build_chain, mock_response
+
+
+class TestMockResponse(unittest.TestCase):
+    def test_uses_title_and_item_count_from_template(self):
+        prompt = (
+            "List top 10 risks per group.\n"
+            'The title of this section should be "Risks".\n'
+            "Use these assumptions: ..."
+        )
+        response = mock_response(prompt)
+        self.assertTrue(response.startswith("# Risks\n"))
+        self.assertIn("10. Risks item 10.", response)
+        self.assertNotIn("11.", response)
+
+    def test_defaults_without_instructions(self):
+        response = mock_response("Hello")
+        self.assertTrue(response.startswith("# Response\n"))
+        self.assertIn("10. Response item 10.", response)
+
+
+class TestMockChatModel(unittest.TestCase):
+    def test_reports_token_usage(self):
+        llm = MockChatModel()
+        result = llm.generate([[HumanMessage(content="three word prompt")]])
+        usage = result.llm_output["token_usage"]
+        self.assertEqual(usage["prompt_tokens"], 3)
+        self.assertGreater(usage["completion_tokens"], 0)
+        self.assertEqual(result.llm_output["model_name"], "mock")
+
+    def test_canned_responses_by_title(self):
+        llm = MockChatModel(responses={"Risks": "canned"})
+        message = llm([HumanMessage(content='The title is "Risks".')])
+        self.assertEqual(message.content, "canned")
+
+    def test_streams_tokens(self):
+        handler = MagicMock()
+        handler.ignore_llm = False
+        llm = MockChatModel(streaming=True, responses={"Risks": "a b c"})
+        llm([HumanMessage(content='The title is "Risks"')], callbacks=[handler])
+        tokens = [
+            call.kwargs["token"] for call in handler.on_llm_new_token.call_args_list
+        ]
+        self.assertEqual(tokens, ["a ", "b ", "c"])
+
+
+class TestBuildChainMockBackend(unittest.TestCase):
+    @patch("business_modeler_chains.RateLimitedChatOpenAI")
+    def test_mock_backend_does_not_use_openai(self, mock_chat_openai):
+        chain = build_chain(
+            None,
+            [{"template_file": "canvas.txt"}, {"template_file": "assumptions.txt"}],
+            "templates",
+            "_common.txt",
+            backend="mock",
+            mock_options={"latency": 0.0},
+        )
+        mock_chat_openai.assert_not_called()
+        output = chain({"seed": "An idea"})
+        self.assertTrue(output["canvas"].startswith("# Lean Business Model Canvas"))
+        self.assertTrue(output["assumptions"].startswith("# Assumptions"))
+
+
+class TestFindRegressions(unittest.TestCase):
+    def test_find_regressions(self):
+        baseline = {"scheduling": {"median": 1.0}, "removed": {"median": 1.0}}
+        self.assertEqual(
+            find_regressions({"scheduling": {"median": 1.2}}, baseline, 0.25), []
+        )
+        self.assertEqual(
+            len(find_regressions({"scheduling": {"median": 1.3}}, baseline, 0.25)), 1
+        )
@@ -0,0 +1,259 @@
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+import openai
+
+from business_modeler_chains import RateLimitedChatOpenAI, RateLimiter, get_rate_limiter
+
+
+def rate_limit_error(**headers):
+    return openai.error.RateLimitError("Rate limit reached", headers=headers)
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_limits_concurrency(self):
+        limiter = RateLimiter(max_concurrency=2)
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def request():
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.pop()
+            return "ok"
+
+        threads = [
+            threading.Thread(target=limiter.call, args=(request, 1)) for _ in range(6)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(max(peak), 2)
+
+    def test_waits_for_requests_per_minute(self):
+        limiter = RateLimiter(requests_per_minute=2)
+        limiter.window = 0.2
+
+        start = time.monotonic()
+        for _ in range(3):
+            limiter.call(lambda: "ok", 1)
+
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+    def test_waits_for_tokens_per_minute(self):
+        limiter = RateLimiter(tokens_per_minute=100)
+        limiter.window = 0.2
+
+        start = time.monotonic()
+        limiter.call(lambda: "ok", 80)
+        self.assertLess(time.monotonic() - start, 0.1)
+        limiter.call(lambda: "ok", 80)
+
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+    def test_corrects_tokens_with_usage(self):
+        limiter = RateLimiter(tokens_per_minute=100)
+        limiter.window = 10
+
+        limiter.call(lambda: {"used": 10}, 90, used_tokens=lambda r: r["used"])
+
+        start = time.monotonic()
+        limiter.call(lambda: "ok", 80)
+        self.assertLess(time.monotonic() - start, 0.1)
+
+    @patch("business_modeler_chains.time.sleep")
+    def test_retries_rate_limit_errors_and_adapts(self, mock_sleep):
+        limiter = RateLimiter(max_concurrency=8)
+        request = MagicMock(
+            side_effect=[
+                rate_limit_error(
+                    **{
+                        "retry-after": "3",
+                        "x-ratelimit-limit-requests": "200",
+                        "x-ratelimit-limit-tokens": "40000",
+                    }
+                ),
+                "ok",
+            ]
+        )
+
+        self.assertEqual(limiter.call(request, 1), "ok")
+
+        self.assertEqual(request.call_count, 2)
+        self.assertGreaterEqual(mock_sleep.call_args.args[0], 3)
+        self.assertEqual(limiter.requests_per_minute, 200)
+        self.assertEqual(limiter.tokens_per_minute, 40000)
+        # Halved by the error, then raised again by the success
+        self.assertEqual(limiter.concurrency, 5)
+
+    @patch("business_modeler_chains.time.sleep")
+    def test_gives_up_after_max_retries(self, mock_sleep):
+        limiter = RateLimiter(max_retries=2)
+        request = MagicMock(side_effect=rate_limit_error())
+
+        with self.assertRaises(openai.error.RateLimitError):
+            limiter.call(request, 1)
+
+        self.assertEqual(request.call_count, 3)
+        self.assertEqual(limiter.concurrency, 2)
+        self.assertEqual(limiter._running, 0)
+
+    def test_does_not_retry_other_errors(self):
+        limiter = RateLimiter()
+        request = MagicMock(side_effect=ValueError("bad request"))
+
+        with self.assertRaises(ValueError):
+            limiter.call(request, 1)
+
+        self.assertEqual(request.call_count, 1)
+        self.assertEqual(limiter._running, 0)
+
+    def test_streamed_request_runs_until_exhausted(self):
+        limiter = RateLimiter(max_concurrency=1)
+
+        chunks = limiter.call(lambda: iter(["a", "b"]), 1, stream=True)
+        self.assertEqual(next(chunks), "a")
+        self.assertEqual(limiter._running, 1)
+        self.assertEqual(list(chunks), ["b"])
+        self.assertEqual(limiter._running, 0)
+
+    def test_corrects_tokens_of_streamed_request(self):
+        limiter = RateLimiter()
+
+        chunks = limiter.call(
+            lambda: iter(["a", "b"]), 10, used_tokens=len, stream=True
+        )
+        list(chunks)
+
+        self.assertEqual(limiter._requests[-1][1], 2)
+
+
+class TestGetRateLimiter(unittest.TestCase):
+    def test_shared_per_model(self):
+        config = {
+            "max_concurrency": 3,
+            "models": {"test-model-a": {"requests_per_minute": 10}},
+        }
+        limiter = get_rate_limiter("test-model-a", config)
+
+        self.assertIs(get_rate_limiter("test-model-a"), limiter)
+        self.assertIsNot(get_rate_limiter("test-model-b", config), limiter)
+        self.assertEqual(limiter.max_concurrency, 3)
+        self.assertEqual(limiter.requests_per_minute, 10)
+        self.assertIsNone(limiter.tokens_per_minute)
+
+
+def openai_response(data, **headers):
+    return openai.openai_response.OpenAIResponse(data, headers)
+
+
+class TestRateLimitedChatOpenAI(unittest.TestCase):
+    def setUp(self):
+        patcher = patch("openai.api_requestor.APIRequestor.request")
+        self.mock_request = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_sends_requests_through_rate_limiter(self):
+        limiter = RateLimiter()
+        llm = RateLimitedChatOpenAI(openai_api_key="key", rate_limiter=limiter)
+        self.mock_request.return_value = (
+            openai_response(
+                {
+                    "choices": [{"message": {"role": "assistant", "content": "Hello"}}],
+                    "usage": {
+                        "prompt_tokens": 5,
+                        "completion_tokens": 1,
+                        "total_tokens": 6,
+                    },
+                }
+            ),
+            False,
+            "key",
+        )
+
+        with patch.object(limiter, "call", wraps=limiter.call) as mock_call, patch(
+            "business_modeler_chains.count_tokens", return_value=5
+        ):
+            self.assertEqual(llm.predict("Hi"), "Hello")
+
+        self.assertEqual(mock_call.call_args.args[1], 5)
+        self.assertEqual(limiter._requests[-1][1], 6)
+
+    def test_counts_tokens_with_configured_tokenizer(self):
+        llm = RateLimitedChatOpenAI(
+            openai_api_key="key", rate_limiter=RateLimiter(), tokenizer="cl100k_base"
+        )
+        self.mock_request.return_value = (
+            openai_response(
+                {
+                    "choices": [{"message": {"role": "assistant", "content": "Hello"}}],
+                    "usage": {"total_tokens": 6},
+                }
+            ),
+            False,
+            "key",
+        )
+
+        with patch(
+            "business_modeler_chains.count_tokens", return_value=5
+        ) as mock_count_tokens:
+            llm.predict("Hi")
+
+        mock_count_tokens.assert_called_with("Hi", "cl100k_base")
+
+    def test_corrects_tokens_of_streamed_responses(self):
+        limiter = RateLimiter()
+        llm = RateLimitedChatOpenAI(
+            openai_api_key="key", rate_limiter=limiter, streaming=True, max_tokens=100
+        )
+        self.mock_request.return_value = (
+            iter(
+                openai_response({"choices": [{"delta": {"content": content}}]})
+                for content in ["Hel", "lo"]
+            ),
+            True,
+            "key",
+        )
+
+        with patch(
+            "business_modeler_chains.count_tokens",
+            side_effect=lambda text, _: len(text),
+        ):
+            self.assertEqual(llm.predict("Hi"), "Hello")
+
+        self.assertEqual(limiter._requests[-1][1], len("Hi") + len("Hello"))
+
+    def test_adapts_limits_to_headers_of_responses(self):
+        limiter = RateLimiter(requests_per_minute=100)
+        llm = RateLimitedChatOpenAI(openai_api_key="key", rate_limiter=limiter)
+        self.mock_request.return_value = (
+            openai_response(
+                {
+                    "choices": [{"message": {"role": "assistant", "content": "Hello"}}],
+                    "usage": {"total_tokens": 6},
+                },
+                **{
+                    "x-ratelimit-limit-requests": "60",
+                    "x-ratelimit-limit-tokens": "40000",
+                },
+            ),
+            False,
+            "key",
+        )
+
+        llm.predict("Hi")
+
+        self.assertEqual(limiter.requests_per_minute, 60)
+        self.assertEqual(limiter.tokens_per_minute, 40000)
+
+
+if __name__ == "__main__":
+    unittest.main()
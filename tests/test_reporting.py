@@ -1,9 +1,16 @@
 import os
-
-# import tempfile
+import tempfile
 from unittest.mock import Mock, patch
 
-from business_modeler import generate_report, report_results
+import click
+import pytest
+
+from business_modeler import (
+    ReportRenderer,
+    generate_report,
+    parse_report_formats,
+    report_results,
+)
 
 
 @patch("business_modeler.md2pdf")
@@ -13,32 +20,72 @@ def test_generate_report(mock_read_template, mock_md2pdf):
     chain_output_dict = {"key": "value"}
     output_file = "test_file"
 
-    # Test with markdown=True
-    markdown_file_name, pdf_file_name = generate_report(
-        output_file, True, **chain_output_dict
-    )
+    # Test with the markdown and PDF formats
+    report_files = generate_report(output_file, ["md", "pdf"], **chain_output_dict)
 
-    assert markdown_file_name == "test_file.md"
-    assert pdf_file_name == "test_file.pdf"
-    assert os.path.exists(markdown_file_name)
+    assert report_files == {"md": "test_file.md", "pdf": "test_file.pdf"}
+    assert os.path.exists(report_files["md"])
     mock_md2pdf.assert_called_once()
 
     # Cleanup
-    if os.path.exists(markdown_file_name):
-        os.remove(markdown_file_name)
+    if os.path.exists(report_files["md"]):
+        os.remove(report_files["md"])
+
+
+@patch("business_modeler.md2pdf")
+@patch("business_modeler.read_template")
+def test_generate_report_html(mock_read_template, mock_md2pdf):
+    mock_read_template.return_value = "# Title\n{key}"
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output_file = os.path.join(tmp_dir, "report")
+
+        report_files = generate_report(output_file, ["html"], key="value")
+
+        assert report_files == {"html": f"{output_file}.html"}
+        with open(report_files["html"]) as f:
+            html = f.read()
+        assert "<h1>Title</h1>" in html
+        assert "<p>value</p>" in html
+        mock_md2pdf.assert_not_called()
+
+
+def test_parse_report_formats():
+    assert parse_report_formats("pdf", False) == ["pdf"]
+    assert parse_report_formats("html, pdf", True) == ["md", "pdf", "html"]
+    with pytest.raises(click.BadParameter):
+        parse_report_formats("pdf,docx", False)
+
+
+def test_report_renderer():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output_file = os.path.join(tmp_dir, "report")
+        chain_output_dict = {
+            key: key
+            for key in [
+                "seed",
+                "canvas",
+                "assumptions",
+                "risks",
+                "experiments",
+                "alternatives",
+            ]
+        }
+        with ReportRenderer(1) as renderer:
+            rendering = renderer.submit(output_file, ["md"], chain_output_dict)
+
+        assert rendering.result() == {"md": f"{output_file}.md"}
+        assert os.path.exists(f"{output_file}.md")
 
 
 @patch("business_modeler.click.secho")
 def test_report_results(mock_secho):
-    markdown = True
-    markdown_file_name = "markdown_file.md"
-    pdf_file_name = "pdf_file.pdf"
+    report_files = {"md": "markdown_file.md", "pdf": "pdf_file.pdf"}
     cb = Mock()
     cb.total_tokens = 100
     cb.total_cost = 10.0
     duration = 2.5
 
-    report_results(markdown, markdown_file_name, pdf_file_name, cb, duration)
+    report_results(report_files, cb, duration)
 
     # Assert that click.secho was called 5 times (Markdown file, PDF file, Total tokens, Total cost, Runtime)
     assert mock_secho.call_count == 5
@@ -0,0 +1,124 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import MagicMock
+
+from langchain.chains import LLMChain
+from langchain.llms.fake import FakeListLLM
+from langchain.prompts import PromptTemplate
+
+from business_modeler import ResponseCache
+from business_modeler_chains import DependencyGraphChain
+
+
+class FakeLLM(FakeListLLM):
+    """FakeListLLM whose parameters do not depend on its canned responses."""
+
+    @property
+    def _identifying_params(self):
+        return {"model_name": "fake"}
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache = ResponseCache(self.tmp_dir.name, max_size=10_000, max_age=60)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_make_key_depends_on_prompt_and_params(self):
+        key = ResponseCache.make_key("prompt", {"model_name": "gpt-4"})
+        self.assertEqual(key, ResponseCache.make_key("prompt", {"model_name": "gpt-4"}))
+        self.assertNotEqual(
+            key, ResponseCache.make_key("other", {"model_name": "gpt-4"})
+        )
+        self.assertNotEqual(
+            key, ResponseCache.make_key("prompt", {"model_name": "gpt-3.5-turbo"})
+        )
+
+    def test_make_key_ignores_non_semantic_params(self):
+        self.assertEqual(
+            ResponseCache.make_key("prompt", {"temperature": 0.7, "stream": True}),
+            ResponseCache.make_key("prompt", {"temperature": 0.7, "stream": False}),
+        )
+
+    def test_get_missing_key(self):
+        self.assertIsNone(self.cache.get("missing"))
+
+    def test_put_and_get(self):
+        self.cache.put("key", "output")
+        self.assertEqual(self.cache.get("key"), "output")
+
+    def test_expired_entries_are_ignored(self):
+        self.cache.put("key", "output")
+        old = time.time() - 120
+        os.utime(os.path.join(self.tmp_dir.name, "key.json"), (old, old))
+        self.assertIsNone(self.cache.get("key"))
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = ResponseCache(self.tmp_dir.name, max_size=60, max_age=60)
+        cache.put("old", "x" * 20)
+        old = time.time() - 10
+        os.utime(os.path.join(self.tmp_dir.name, "old.json"), (old, old))
+        cache.put("new", "y" * 20)
+        self.assertIsNone(cache.get("old"))
+        self.assertEqual(cache.get("new"), "y" * 20)
+
+
+class TestDependencyGraphChainCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache = ResponseCache(self.tmp_dir.name, max_size=10_000, max_age=60)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def build(self, responses, **kwargs):
+        llm = FakeLLM(responses=responses)
+        chains = [
+            LLMChain(
+                llm=llm,
+                prompt=PromptTemplate.from_template("Canvas for {seed}"),
+                output_key="canvas",
+            ),
+            LLMChain(
+                llm=llm,
+                prompt=PromptTemplate.from_template("Risks in {canvas}"),
+                output_key="risks",
+            ),
+        ]
+        return DependencyGraphChain(
+            chains=chains,
+            input_variables=["seed"],
+            output_variables=["canvas", "risks"],
+            cache=self.cache,
+            **kwargs,
+        )
+
+    def test_cached_outputs_are_reused(self):
+        first = self.build(["canvas 1", "risks 1"])({"seed": "idea"})
+        second = self.build(["canvas 2", "risks 2"])({"seed": "idea"})
+        self.assertEqual(second["canvas"], first["canvas"])
+        self.assertEqual(second["risks"], first["risks"])
+
+    def test_changed_prompt_misses_cache(self):
+        self.build(["canvas 1", "risks 1"])({"seed": "idea"})
+        output = self.build(["canvas 2", "risks 2"])({"seed": "other idea"})
+        self.assertEqual(output["canvas"], "canvas 2")
+
+    def test_refresh_stage_bypasses_cache(self):
+        self.build(["canvas 1", "risks 1"])({"seed": "idea"})
+        output = self.build(["risks 2"], refresh_stages=["risks"])({"seed": "idea"})
+        self.assertEqual(output["canvas"], "canvas 1")
+        self.assertEqual(output["risks"], "risks 2")
+
+    def test_cached_stage_is_reported_to_callbacks(self):
+        self.build(["canvas 1", "risks 1"])({"seed": "idea"})
+        handler = MagicMock()
+        handler.ignore_chain = False
+        self.build([])({"seed": "idea"}, callbacks=[handler])
+        ended = [call.args[0] for call in handler.on_chain_end.call_args_list]
+        self.assertIn({"canvas": "canvas 1"}, ended)
+        self.assertIn({"risks": "risks 1"}, ended)
@@ -0,0 +1,149 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import yaml
+from click.testing import CliRunner
+
+import business_modeler
+from business_modeler import SeedCache, embed_seed, load_chain_config
+from business_modeler_chains import build_chain, chain_fingerprint, mock_response
+
+SEED = "A coffee shop that delivers with drones"
+OUTPUTS = {"seed": SEED, "canvas": "The canvas", "risks": "The risks"}
+
+
+# Compare seeds by their words, without downloading an embedding model
+@patch("business_modeler.load_embedding_model", return_value=None)
+class TestSeedCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache = SeedCache(self.temp_dir.name)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_embedding_ignores_whitespace_and_casing(self, _):
+        embedder, vector = embed_seed(SEED)
+        _, other = embed_seed("a  COFFEE shop that delivers\nwith drones ")
+
+        self.assertEqual(embedder, "hashed")
+        self.assertAlmostEqual(float(vector @ other), 1.0, places=5)
+
+    def test_reuses_report_of_near_duplicate_seed(self, _):
+        self.assertIsNone(self.cache.lookup(SEED))
+        self.cache.add(SEED, OUTPUTS)
+
+        match = self.cache.lookup("a coffee shop that  delivers with DRONES")
+
+        self.assertAlmostEqual(match["similarity"], 1.0, places=5)
+        self.assertEqual(
+            match["outputs"], {"canvas": "The canvas", "risks": "The risks"}
+        )
+        self.assertIsNone(self.cache.lookup("Accounting software for dentists"))
+
+    def test_reuses_canvas_of_similar_seed(self, _):
+        self.cache.add(SEED, OUTPUTS)
+
+        match = self.cache.lookup(f"{SEED} in Paris")
+
+        self.assertLess(match["similarity"], self.cache.report_similarity)
+        self.assertEqual(match["outputs"], {"canvas": "The canvas"})
+
+    def test_only_reuses_outputs_of_the_same_chain(self, _):
+        chains_config = load_chain_config("config.yaml")["chains"]
+
+        def fingerprint(**options):
+            return chain_fingerprint(
+                build_chain(
+                    "sk-test", chains_config, "templates", "_common.txt", **options
+                )
+            )
+
+        mock = fingerprint(backend="mock")
+        self.assertEqual(fingerprint(backend="mock"), mock)
+        self.assertNotEqual(fingerprint(), mock)
+        self.assertNotEqual(fingerprint(model_name="gpt-4"), fingerprint())
+        self.assertNotEqual(fingerprint(temperature=0.2), fingerprint())
+
+        self.cache.add(SEED, OUTPUTS, mock)
+
+        self.assertIsNotNone(self.cache.lookup(SEED, mock))
+        self.assertIsNone(self.cache.lookup(SEED, "other"))
+        self.assertIsNone(self.cache.lookup(SEED))
+
+    def test_drops_oldest_entries(self, _):
+        cache = SeedCache(self.temp_dir.name, max_entries=2)
+        for seed in [SEED, "Accounting software for dentists", "A bakery for dogs"]:
+            cache.add(seed, {"canvas": seed})
+
+        self.assertIsNone(cache.lookup(SEED))
+        self.assertIsNotNone(cache.lookup("A bakery for dogs"))
+        # The index and the outputs of the two remaining seeds
+        files = [name for name in os.listdir(self.temp_dir.name) if ".json" in name]
+        self.assertEqual(len(files), 3)
+
+
+@patch("business_modeler.load_embedding_model", return_value=None)
+class TestMainSeedCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        config = load_chain_config("config.yaml")
+        config.update(
+            backend="mock",
+            runs_dir=os.path.join(self.temp_dir.name, "runs"),
+            cache={"enabled": False},
+            history_file=os.path.join(self.temp_dir.name, "history.db"),
+            seed_cache={
+                "enabled": True,
+                "dir": os.path.join(self.temp_dir.name, "seeds"),
+            },
+        )
+        self.config_file = os.path.join(self.temp_dir.name, "config.yaml")
+        with open(self.config_file, "w") as f:
+            yaml.safe_dump(config, f)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def run_main(self, name, seed):
+        seed_file = os.path.join(self.temp_dir.name, f"{name}.md")
+        with open(seed_file, "w") as f:
+            f.write(seed)
+        with patch(
+            "business_modeler_chains.mock_response", wraps=mock_response
+        ) as mock_mock_response:
+            result = CliRunner().invoke(
+                business_modeler.main,
+                [
+                    "--config-file",
+                    self.config_file,
+                    "--format",
+                    "md",
+                    "--seed-file",
+                    seed_file,
+                    "--output-file",
+                    os.path.join(self.temp_dir.name, name),
+                ],
+            )
+        self.assertEqual(result.exit_code, 0, result.output)
+        return result, mock_mock_response.call_count
+
+    def test_reuses_outputs_of_similar_seeds(self, _):
+        _, calls = self.run_main("first", SEED)
+        self.assertEqual(calls, 5)
+
+        result, calls = self.run_main("second", f"  {SEED.upper()}\n")
+        self.assertEqual(calls, 0)
+        self.assertIn("from a similar earlier seed (similarity 1.00)", result.output)
+        with open(os.path.join(self.temp_dir.name, "second.md")) as f:
+            self.assertIn(SEED.upper(), f.read())
+
+        result, calls = self.run_main("third", f"{SEED} in Paris")
+        self.assertEqual(calls, 4)
+        self.assertIn("Reused canvas from a similar earlier seed", result.output)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,145 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from click.testing import CliRunner
+
+import business_modeler
+from business_modeler import (
+    SeedPreprocessor,
+    find_duplicate_seeds,
+    load_chain_config,
+    remove_empty_sections,
+)
+from business_modeler_chains import ReportJobs, build_chain, mock_response, run_batch
+
+
+def count_words(text, tokenizer_name=None):
+    return len(text.split())
+
+
+class TestSeedPreprocessor(unittest.TestCase):
+    def test_normalizes_whitespace_and_removes_boilerplate(self):
+        preprocessor = SeedPreprocessor(strip_patterns=["^Sent from my "])
+        seed = (
+            "﻿# Idea\r\n\r\n\r\n\r\nA  coffee shop\t for dogs.   \r\n"
+            "<!-- Fill in the questions below -->\n"
+            "## Who has this problem?\n\n"
+            "## Why?\n  - Dogs  like coffee\n\n"
+            "Sent from my phone\n"
+        )
+
+        self.assertEqual(
+            preprocessor.process(seed),
+            "# Idea\n\nA coffee shop for dogs.\n\n## Why?\n  - Dogs like coffee",
+        )
+
+    def test_remove_empty_sections(self):
+        self.assertEqual(
+            remove_empty_sections(["# A", "## B", "### C", "", "## D", "Text"]),
+            ["# A", "", "## D", "Text"],
+        )
+        self.assertEqual(
+            remove_empty_sections(["## A", "### B", "Text"]), ["## A", "### B", "Text"]
+        )
+
+    def test_rejects_empty_seed(self):
+        with open("examples/template.md") as f:
+            template = f.read()
+
+        with self.assertRaisesRegex(ValueError, "The seed is empty"):
+            SeedPreprocessor().process(template)
+
+    @patch("business_modeler.count_tokens", count_words)
+    def test_oversized_seeds(self):
+        seed = (
+            "# Idea\n\n"
+            + " ".join(["A long sentence about the idea."] * 10)
+            + "\nMore."
+        )
+
+        compressed = SeedPreprocessor(max_tokens=12).process(seed)
+        self.assertEqual(compressed, "# Idea\n\nA long sentence about the idea.\nMore.")
+        self.assertEqual(SeedPreprocessor(max_tokens=100).process(seed), seed)
+        with self.assertRaisesRegex(
+            ValueError, "63 tokens, more than the maximum of 12"
+        ):
+            SeedPreprocessor(max_tokens=12, oversize="reject").process(seed)
+
+    def test_find_duplicate_seeds(self):
+        self.assertEqual(find_duplicate_seeds(["a", None, "b", "a", "a"]), {3: 0, 4: 0})
+
+
+class TestDuplicateSeeds(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write_seed(self, name, seed):
+        seed_file = os.path.join(self.temp_dir.name, f"{name}.md")
+        with open(seed_file, "w") as f:
+            f.write(seed)
+        return seed_file
+
+    def test_batch_runs_duplicates_once(self):
+        seed_files = [
+            self.write_seed("first", "A coffee shop for dogs."),
+            self.write_seed("second", "A  coffee shop for dogs.\n\n## Who?\n"),
+            self.write_seed("third", "A bakery for cats."),
+        ]
+        chain = build_chain(
+            None,
+            load_chain_config("config.yaml")["chains"],
+            "templates",
+            "_common.txt",
+            backend="mock",
+        )
+        output_dir = os.path.join(self.temp_dir.name, "reports")
+
+        with patch(
+            "business_modeler_chains.mock_response", wraps=mock_response
+        ) as mock_mock_response:
+            results = run_batch(
+                chain,
+                seed_files,
+                output_dir,
+                ["md"],
+                2,
+                preprocessor=SeedPreprocessor(),
+            )
+
+        self.assertEqual(mock_mock_response.call_count, 10)
+        self.assertEqual([result["error"] for result in results], [None] * 3)
+        self.assertEqual(results[1]["duplicate_of"], seed_files[0])
+        self.assertEqual(
+            results[1]["report_files"], {"md": os.path.join(output_dir, "second.md")}
+        )
+        with open(results[1]["report_files"]["md"]) as f:
+            self.assertIn("A coffee shop for dogs.", f.read())
+
+    def test_server_rejects_empty_seeds(self):
+        jobs = ReportJobs(
+            None, self.temp_dir.name, ["md"], 1, preprocessor=SeedPreprocessor()
+        )
+        try:
+            with self.assertRaisesRegex(ValueError, "The seed is empty"):
+                jobs.submit("## What problem are you trying to solve?\n\n")
+        finally:
+            jobs.shutdown()
+        self.assertEqual(os.listdir(self.temp_dir.name), [])
+
+    @patch("business_modeler.check_api_key")
+    def test_main_rejects_empty_seed(self, _):
+        result = CliRunner().invoke(
+            business_modeler.main, ["--seed-file", "examples/template.md"]
+        )
+
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("examples/template.md: The seed is empty", result.output)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,174 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+import urllib.error
+import urllib.request
+from unittest.mock import patch
+
+from click.testing import CliRunner
+
+import business_modeler
+from business_modeler import create_server, load_chain_config
+from business_modeler_chains import ReportJobs, build_chain
+
+
+def build_mock_chain():
+    return build_chain(
+        None,
+        load_chain_config("config.yaml")["chains"],
+        "templates",
+        "_common.txt",
+        backend="mock",
+    )
+
+
+class TestReportJobs(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.TemporaryDirectory()
+        self.jobs = ReportJobs(build_mock_chain(), self.output_dir.name, ["md"], 2)
+
+    def tearDown(self):
+        self.jobs.shutdown()
+        self.output_dir.cleanup()
+
+    def wait_for(self, job_id):
+        for _ in range(100):
+            job = self.jobs.get(job_id)
+            if job["status"] in ("done", "failed"):
+                return job
+            time.sleep(0.05)
+        self.fail(f"Job {job_id} did not finish")
+
+    def test_runs_job_and_reports_progress(self):
+        job = self.jobs.submit("An idea")
+        self.assertIn(job["status"], ("queued", "running", "done"))
+
+        job = self.wait_for(job["id"])
+
+        self.assertEqual(job["status"], "done")
+        self.assertIsNone(job["error"])
+        self.assertEqual(
+            job["report_files"],
+            {"md": os.path.join(self.output_dir.name, f"{job['id']}.md")},
+        )
+        self.assertEqual(job["progress"]["completed"], 5)
+        self.assertEqual(job["progress"]["total"], 5)
+        self.assertEqual(
+            set(job["progress"]["stages"]),
+            {"canvas", "assumptions", "risks", "experiments", "alternatives"},
+        )
+        with open(job["seed_file"]) as f:
+            self.assertEqual(f.read(), "An idea")
+
+    def test_forgets_oldest_finished_jobs(self):
+        self.jobs.max_jobs = 1
+        first = self.wait_for(self.jobs.submit("First")["id"])
+        second = self.wait_for(self.jobs.submit("Second")["id"])
+        self.jobs.submit("Third")
+
+        self.assertIsNone(self.jobs.get(first["id"]))
+        self.assertIsNotNone(self.jobs.get(second["id"]))
+        self.assertEqual(len(self.jobs.list()), 2)
+
+    def test_unknown_job(self):
+        self.assertIsNone(self.jobs.get("unknown"))
+
+
+class TestJobServer(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.TemporaryDirectory()
+        self.jobs = ReportJobs(build_mock_chain(), self.output_dir.name, ["md"], 2)
+        self.server = create_server(self.jobs, port=0)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.jobs.shutdown()
+        self.output_dir.cleanup()
+
+    def request(self, path, data=None):
+        body = None if data is None else json.dumps(data).encode("utf-8")
+        try:
+            with urllib.request.urlopen(self.url + path, body) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+    def test_submit_and_fetch_report(self):
+        status, body = self.request("/jobs", {"seed": "An idea", "formats": ["md"]})
+        self.assertEqual(status, 202)
+        job_id = json.loads(body)["id"]
+
+        for _ in range(100):
+            status, body = self.request(f"/jobs/{job_id}")
+            if json.loads(body)["status"] == "done":
+                break
+            time.sleep(0.05)
+        self.assertEqual(status, 200)
+
+        status, body = self.request(f"/jobs/{job_id}/report/md")
+        self.assertEqual(status, 200)
+        self.assertIn(b"# Lean Business Model Canvas", body)
+
+        status, body = self.request("/jobs")
+        self.assertEqual([job["id"] for job in json.loads(body)["jobs"]], [job_id])
+
+    def test_invalid_requests(self):
+        self.assertEqual(self.request("/jobs", {"text": "An idea"})[0], 400)
+        self.assertEqual(self.request("/jobs", {"seed": 1})[0], 400)
+        self.assertEqual(
+            self.request("/jobs", {"seed": "An idea", "formats": ["doc"]})[0], 400
+        )
+        self.assertEqual(self.request("/jobs/unknown")[0], 404)
+        self.assertEqual(self.request("/unknown")[0], 404)
+        self.assertEqual(json.loads(self.request("/health")[1]), {"status": "ok"})
+
+
+class TestServeCommand(unittest.TestCase):
+    @patch("business_modeler.check_api_key")
+    def test_help_needs_no_api_key(self, mock_check_api_key):
+        result = CliRunner().invoke(business_modeler.main, ["serve", "--help"])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("--socket", result.output)
+        mock_check_api_key.assert_not_called()
+
+    @patch("openai.requestssession", None)
+    @patch("business_modeler.ReportRenderer")
+    @patch("business_modeler.create_server")
+    @patch("business_modeler_chains.build_chain")
+    @patch("business_modeler.check_api_key")
+    def test_serve_builds_chain_once(
+        self,
+        mock_check_api_key,
+        mock_build_chain,
+        mock_create_server,
+        mock_report_renderer,
+    ):
+        mock_check_api_key.return_value = "dummy_api_key"
+        mock_build_chain.return_value.chains = []
+        mock_build_chain.return_value.token_budgets = {}
+
+        result = CliRunner().invoke(
+            business_modeler.main,
+            ["--format", "md", "--output-dir", "reports", "serve", "--port", "9000"],
+        )
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        mock_build_chain.assert_called_once()
+        self.assertEqual(mock_build_chain.call_args.args, ("dummy_api_key",))
+        jobs, host, port, socket_path = mock_create_server.call_args.args
+        self.assertEqual((host, port, socket_path), ("127.0.0.1", 9000, None))
+        self.assertEqual(jobs.formats, ["md"])
+        self.assertEqual(jobs.output_dir, "reports")
+        mock_create_server.return_value.serve_forever.assert_called_once()
+        jobs.shutdown()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import unittest
+
+from business_modeler import load_chain_config
+from business_modeler_chains import (
+    CallbackHandler,
+    ListPrefixHandler,
+    build_chain,
+    is_list_prefix,
+)
+
+
+def assumptions_response(count, closing=""):
+    items = "\n".join(f"{i}. Assumption {i}." for i in range(1, count + 1))
+    return f"# Assumptions\n\n{items}\n{closing}"
+
+
+class TestListPrefix(unittest.TestCase):
+    def test_is_list_prefix(self):
+        prefix = "# Items\n\n1. One.\n2. Two.\n"
+        self.assertTrue(is_list_prefix(prefix, prefix))
+        self.assertTrue(is_list_prefix(prefix, prefix + "\nThat is all.\n"))
+        self.assertFalse(is_list_prefix(prefix, prefix + "3. Three.\n"))
+        self.assertFalse(is_list_prefix(prefix, "# Other\n"))
+
+    def test_reports_prefix_once_items_are_complete(self):
+        prefixes = []
+        handler = ListPrefixHandler(
+            "assumptions", [2], lambda *prefix: prefixes.append(prefix)
+        )
+
+        for token in ["# Title\n\n1. ", "One.\n2. Tw", "o.", "\n3. Three.\n"]:
+            handler.on_llm_new_token(token)
+
+        self.assertEqual(
+            prefixes, [("assumptions", 2, "# Title\n\n1. One.\n2. Two.\n")]
+        )
+
+
+class TestSpeculation(unittest.TestCase):
+    def run_chain(self, assumptions, speculate=True):
+        chain = build_chain(
+            None,
+            load_chain_config("config.yaml")["chains"],
+            "templates",
+            "_common.txt",
+            backend="mock",
+            mock_options={
+                "tokens_per_second": 2000,
+                "responses": {"Assumptions": assumptions},
+            },
+            speculate=speculate,
+        )
+        monitor = CallbackHandler()
+        output = chain({"seed": "An idea"}, callbacks=[monitor])
+        records = {}
+        for record in monitor.records:
+            records.setdefault(record["stage"], []).append(record)
+        return output, records
+
+    def test_starts_dependent_chain_early(self):
+        closing = "Validate the riskiest assumptions first. " * 20
+        output, records = self.run_chain(assumptions_response(30, closing))
+
+        (assumptions,) = records["assumptions"]
+        (risks,) = records["risks"]
+        self.assertLess(risks["start"], assumptions["end"])
+        self.assertIsNone(risks["error"])
+        self.assertTrue(output["assumptions"].endswith(closing))
+        self.assertIn("# Risks", output["risks"])
+
+    def test_runs_again_when_list_continues(self):
+        output, records = self.run_chain(assumptions_response(40))
+
+        (assumptions,) = records["assumptions"]
+        self.assertEqual(len(records["risks"]), 2)
+        rerun = max(records["risks"], key=lambda record: record["start"])
+        self.assertGreaterEqual(rerun["start"], assumptions["end"])
+        self.assertIsNone(rerun["error"])
+        self.assertIn("# Risks", output["risks"])
+
+    def test_counts_tokens_of_streamed_upstream_chain(self):
+        closing = "Validate the riskiest assumptions first. " * 20
+        _, records = self.run_chain(assumptions_response(30, closing))
+
+        # The assumptions are streamed for the risks to start early
+        (assumptions,) = records["assumptions"]
+        self.assertIsNotNone(assumptions["time_to_first_token"])
+        self.assertGreater(assumptions["prompt_tokens"], 0)
+        self.assertGreater(assumptions["completion_tokens"], 0)
+
+    def test_disabled_by_default(self):
+        closing = "Validate the riskiest assumptions first. " * 20
+        _, records = self.run_chain(assumptions_response(30, closing), False)
+
+        self.assertGreaterEqual(
+            records["risks"][0]["start"], records["assumptions"][0]["end"]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
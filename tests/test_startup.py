@@ -0,0 +1,59 @@
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ["langchain", "openai", "md2pdf", "markdown", "transformers"]
+
+# Runs the command line in-process and prints the heavy modules it imported
+RUN_CLI = """
+import json, runpy, sys
+sys.argv = ["business_modeler.py"] + sys.argv[1:]
+try:
+    runpy.run_path("business_modeler.py", run_name="__main__")
+except SystemExit:
+    pass
+print(json.dumps([m for m in %r if m in sys.modules]))
+"""
+
+
+def imported_heavy_modules(*args):
+    result = subprocess.run(
+        [sys.executable, "-c", RUN_CLI % HEAVY_MODULES, *args],
+        cwd=ROOT_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+        env={**os.environ, "OPENAI_API_KEY": ""},
+    )
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+class TestStartup(unittest.TestCase):
+    def test_import_does_not_load_pipeline(self):
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import json, sys, business_modeler; "
+                f"print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))",
+            ],
+            cwd=ROOT_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        self.assertEqual(json.loads(result.stdout), [])
+
+    def test_help_does_not_load_pipeline(self):
+        self.assertEqual(imported_heavy_modules("--help"), [])
+        self.assertEqual(imported_heavy_modules("serve", "--help"), [])
+
+    def test_example_input_does_not_load_pipeline(self):
+        self.assertEqual(imported_heavy_modules(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from business_modeler import load_chain_config, read_template
+from business_modeler_chains import (
+    StreamingReportHandler,
+    build_chain,
+    mock_response,
+    run_chain,
+)
+
+OUTPUT_TEMPLATE = "# Original Idea\n{seed}\n\n{canvas}\n\n{risks}\n\n{alternatives}"
+
+
+class TestStreamingReportHandler(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.markdown_file_name = os.path.join(self.tmp_dir.name, "report.md")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def read(self):
+        with open(self.markdown_file_name) as f:
+            return f.read()
+
+    def test_file_starts_empty(self):
+        with open(self.markdown_file_name, "w") as f:
+            f.write("previous run")
+        StreamingReportHandler(self.markdown_file_name, OUTPUT_TEMPLATE)
+        self.assertEqual(self.read(), "")
+
+    def test_sections_are_written_in_template_order(self):
+        handler = StreamingReportHandler(
+            self.markdown_file_name, OUTPUT_TEMPLATE, echo_tokens=False
+        )
+        handler.on_chain_end({"seed": "idea"})
+        handler.on_chain_end({"canvas": "canvas"})
+        self.assertEqual(self.read(), "# Original Idea\nidea\n\ncanvas")
+
+        # "alternatives" finished first, but is held back until "risks" exists
+        handler.on_chain_end({"alternatives": "alternatives"})
+        self.assertEqual(self.read(), "# Original Idea\nidea\n\ncanvas")
+
+        handler.on_chain_end({"risks": "risks"})
+        self.assertEqual(
+            self.read(),
+            OUTPUT_TEMPLATE.format(
+                seed="idea", canvas="canvas", risks="risks", alternatives="alternatives"
+            ),
+        )
+
+    @patch("business_modeler.click.echo")
+    def test_concurrent_tokens_are_not_interleaved(self, mock_echo):
+        handler = StreamingReportHandler(self.markdown_file_name, OUTPUT_TEMPLATE)
+        handler.on_llm_start({}, ["a"], run_id="a")
+        handler.on_llm_start({}, ["b"], run_id="b")
+        handler.on_llm_new_token("a1", run_id="a")
+        handler.on_llm_new_token("b1", run_id="b")
+        handler.on_llm_new_token("a2", run_id="a")
+        handler.on_llm_end(None, run_id="a")
+        handler.on_llm_new_token("b2", run_id="b")
+        handler.on_llm_end(None, run_id="b")
+
+        echoed = "".join(
+            call.args[0] if call.args else "\n" for call in mock_echo.call_args_list
+        )
+        self.assertEqual(echoed, "a1a2\nb1b2\n")
+
+    def test_failed_run_keeps_finished_sections(self):
+        chain = build_chain(
+            None,
+            load_chain_config("config.yaml")["chains"],
+            "templates",
+            "_common.txt",
+            backend="mock",
+        )
+        handler = StreamingReportHandler(
+            self.markdown_file_name, read_template("output.txt"), echo_tokens=False
+        )
+
+        def failing_response(prompt):
+            if "risks per group" in prompt:
+                raise ConnectionError("network down")
+            return mock_response(prompt)
+
+        with patch("business_modeler_chains.mock_response", failing_response):
+            with self.assertRaises(ConnectionError):
+                run_chain(chain, "A coffee shop for dogs", callbacks=[handler])
+
+        report = self.read()
+        self.assertTrue(report.startswith("# Original Idea\nA coffee shop for dogs"))
+        self.assertIn("# Lean Business Model Canvas", report)
+        self.assertIn("# Assumptions", report)
+        self.assertNotIn("# Risks", report)
+
+    def test_writes_only_outputs_passing_validation(self):
+        chain = build_chain(
+            None,
+            load_chain_config("config.yaml")["chains"],
+            "templates",
+            "_common.txt",
+            backend="mock",
+        )
+        handler = StreamingReportHandler(
+            self.markdown_file_name, read_template("output.txt"), echo_tokens=False
+        )
+        calls = []
+
+        def flaky_response(prompt):
+            if "overall assumptions" in prompt:
+                calls.append(prompt)
+                if len(calls) == 1:
+                    return "# Assumptions\n\n1. A rejected assumption."
+            return mock_response(prompt)
+
+        with patch("business_modeler_chains.mock_response", flaky_response):
+            run_chain(chain, "A coffee shop for dogs", callbacks=[handler])
+
+        report = self.read()
+        self.assertEqual(len(calls), 2)
+        self.assertNotIn("A rejected assumption", report)
+        self.assertEqual(report.count("# Assumptions"), 1)
@@ -0,0 +1,209 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import yaml
+from click.testing import CliRunner
+
+import business_modeler
+from business_modeler import (
+    ReportStore,
+    load_chain_config,
+    parse_structured_output,
+    render_structured,
+    validate_document,
+    validate_schemas,
+)
+from business_modeler_chains import (
+    CallbackHandler,
+    build_chain,
+    mock_response,
+    select_fields,
+)
+
+SCHEMA = {
+    "title": "Experiments",
+    "type": "array",
+    "minItems": 1,
+    "items": {
+        "type": "object",
+        "properties": {
+            "experiment": {"type": "string"},
+            "rationale": {"type": "string", "title": "Why"},
+        },
+        "required": ["experiment", "rationale"],
+    },
+}
+
+
+class TestStructuredDocuments(unittest.TestCase):
+    def test_validate_document(self):
+        self.assertEqual(
+            validate_document([{"experiment": "E", "rationale": "R"}], SCHEMA), []
+        )
+        self.assertEqual(
+            validate_document([{"experiment": 1}], SCHEMA),
+            ["$[0] is missing rationale", "$[0].experiment should be of type string"],
+        )
+        self.assertEqual(
+            validate_document([], SCHEMA), ["$ should have at least 1 items"]
+        )
+        self.assertEqual(
+            validate_document(True, {"type": "integer"}),
+            ["$ should be of type integer"],
+        )
+
+    def test_parse_structured_output(self):
+        self.assertEqual(parse_structured_output('{"a": 1}'), {"a": 1})
+        self.assertEqual(parse_structured_output('```json\n{"a": 1}\n```'), {"a": 1})
+        with self.assertRaises(ValueError):
+            parse_structured_output("# Not JSON")
+
+    def test_render_structured(self):
+        self.assertEqual(
+            render_structured([{"rationale": "R", "experiment": "E"}], SCHEMA),
+            "# Experiments\n\n1. E\n   - **Why**: R\n",
+        )
+        self.assertEqual(
+            render_structured(
+                {"key_metrics": ["Users"], "summary": "S"},
+                {"type": "object", "properties": {"summary": {"title": "Summary"}}},
+            ),
+            "## Summary\n\nS\n\n## Key metrics\n\n1. Users\n",
+        )
+
+    def test_select_fields(self):
+        self.assertEqual(
+            json.loads(select_fields('{"a": 1, "b": 2, "c": 3}', ["a", "c"])),
+            {"a": 1, "c": 3},
+        )
+        self.assertEqual(select_fields("Shortened [...]", ["a"]), "Shortened [...]")
+
+    def test_repository_schemas_are_valid(self):
+        config = load_chain_config("config.yaml")
+        self.assertEqual(validate_schemas(config["chains"], "templates"), [])
+
+
+class TestReportStore(unittest.TestCase):
+    def test_appends_and_reads_reports(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            store = ReportStore(os.path.join(temp_dir, "store", "reports.jsonl"))
+            self.assertEqual(list(store.read()), [])
+
+            first = store.append("Idea", {"canvas": {"problems": ["P"]}})
+            store.append("Other idea", {"canvas": {"problems": []}})
+            with open(store.path, "a") as f:
+                f.write('{"id": "partly written')
+
+            records = list(store.read())
+
+        self.assertEqual([record["seed"] for record in records], ["Idea", "Other idea"])
+        self.assertEqual(records[0], first)
+        self.assertEqual(records[0]["stages"], {"canvas": {"problems": ["P"]}})
+
+
+class TestStructuredChain(unittest.TestCase):
+    def build_chain(self, **mock_options):
+        return build_chain(
+            None,
+            load_chain_config("config.yaml")["chains"],
+            "templates",
+            "_common.txt",
+            backend="mock",
+            mock_options=mock_options,
+            structured=True,
+        )
+
+    def test_outputs_match_schemas(self):
+        with patch(
+            "business_modeler_chains.mock_response", wraps=mock_response
+        ) as mock_mock_response:
+            output = self.build_chain()({"seed": "An idea"}, callbacks=[])
+
+        canvas = json.loads(output["canvas"])
+        self.assertEqual(len(canvas["problems"]), 3)
+        self.assertEqual(len(json.loads(output["assumptions"])), 30)
+        # The alternatives only get the canvas fields they need
+        (prompt,) = [
+            call.args[0]
+            for call in mock_mock_response.call_args_list
+            if "alternative business models" in call.args[0]
+        ]
+        self.assertIn('"unique_value_proposition"', prompt.split("JSON schema")[0])
+        self.assertNotIn('"key_metrics"', prompt.split("JSON schema")[0])
+
+    def test_invalid_output_fails_stage(self):
+        chain = self.build_chain(responses={"Risks": '{"user_desirability": []}'})
+        monitor = CallbackHandler()
+
+        with self.assertRaisesRegex(ValueError, "'risks' does not match its schema"):
+            chain({"seed": "An idea"}, callbacks=[monitor])
+
+
+class TestMainStructured(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        config = load_chain_config("config.yaml")
+        self.store_file = os.path.join(self.temp_dir.name, "reports.jsonl")
+        config.update(
+            backend="mock",
+            runs_dir=os.path.join(self.temp_dir.name, "runs"),
+            cache={"enabled": False},
+            history_file=os.path.join(self.temp_dir.name, "history.db"),
+            report_store=self.store_file,
+        )
+        self.config_file = os.path.join(self.temp_dir.name, "config.yaml")
+        with open(self.config_file, "w") as f:
+            yaml.safe_dump(config, f)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_renders_report_from_store(self):
+        seed_file = os.path.join(self.temp_dir.name, "seed.md")
+        with open(seed_file, "w") as f:
+            f.write("A coffee shop that delivers with drones")
+        output_file = os.path.join(self.temp_dir.name, "report")
+
+        result = CliRunner().invoke(
+            business_modeler.main,
+            [
+                "--config-file",
+                self.config_file,
+                "--structured",
+                "--format",
+                "md",
+                "--seed-file",
+                seed_file,
+                "--output-file",
+                output_file,
+            ],
+        )
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        (record,) = ReportStore(self.store_file).read()
+        self.assertEqual(record["seed"], "A coffee shop that delivers with drones")
+        self.assertEqual(
+            set(record["stages"]),
+            {"canvas", "assumptions", "risks", "experiments", "alternatives"},
+        )
+        with open(f"{output_file}.md") as f:
+            report = f.read()
+        self.assertIn("# Lean Business Model Canvas\n\n## Target Audience", report)
+        self.assertIn("# Risks\n\n## User Desirability\n\n1. ", report)
+
+    @patch("business_modeler.read_seed", return_value="seed")
+    def test_cannot_combine_with_stream(self, _):
+        result = CliRunner().invoke(
+            business_modeler.main,
+            ["--config-file", self.config_file, "--structured", "--stream"],
+        )
+
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("--structured cannot be combined", result.output)
+
+
+if __name__ == "__main__":
+    unittest.main()
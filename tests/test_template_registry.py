@@ -0,0 +1,160 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from click.testing import CliRunner
+
+import business_modeler
+from business_modeler import TemplateRegistry, find_cycles, validate_templates
+
+
+class TemplateDirTestCase(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.dir = self.temp_dir.name
+        self.write("_common.txt", "Common {seed}\n")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write(self, name, content, mtime=None):
+        path = os.path.join(self.dir, name)
+        with open(path, "w") as f:
+            f.write(content)
+        if mtime is not None:
+            os.utime(path, ns=(mtime, mtime))
+
+
+class TestTemplateRegistry(TemplateDirTestCase):
+    def test_prompt_adds_common_prefix_and_variables(self):
+        self.write("canvas.txt", "Canvas")
+        self.write("risks.txt", "Risks of {canvas}")
+        registry = TemplateRegistry(self.dir, "_common.txt")
+
+        self.assertEqual(registry.prompt("canvas.txt").text, "Common {seed}\nCanvas")
+        self.assertEqual(registry.prompt("risks.txt").variables, ("seed", "canvas"))
+        self.assertEqual(registry.get("risks.txt").variables, ("canvas",))
+
+    def test_reads_each_file_once(self):
+        self.write("canvas.txt", "Canvas")
+        registry = TemplateRegistry(self.dir, "_common.txt")
+
+        with patch("builtins.open", wraps=open) as mock_open:
+            first = registry.prompt("canvas.txt")
+            second = registry.prompt("canvas.txt")
+
+        self.assertIs(first, second)
+        self.assertEqual(mock_open.call_count, 2)
+
+    def test_reloads_changed_files(self):
+        self.write("canvas.txt", "Old", mtime=1_000_000_000)
+        registry = TemplateRegistry(self.dir, "_common.txt")
+        self.assertEqual(registry.get("canvas.txt").text, "Old")
+
+        self.write("canvas.txt", "New {seed}", mtime=2_000_000_000)
+
+        self.assertEqual(registry.get("canvas.txt").text, "New {seed}")
+        self.assertEqual(registry.get("canvas.txt").variables, ("seed",))
+
+    def test_missing_template(self):
+        registry = TemplateRegistry(self.dir, "_common.txt")
+        with self.assertRaises(FileNotFoundError):
+            registry.prompt("missing.txt")
+
+
+class TestFindCycles(unittest.TestCase):
+    def test_finds_cycles(self):
+        self.assertEqual(find_cycles({"a": [], "b": ["a"]}), [])
+        self.assertEqual(
+            find_cycles({"a": ["c"], "b": ["a"], "c": ["b"]}), [["a", "c", "b", "a"]]
+        )
+        self.assertEqual(find_cycles({"a": ["a"]}), [["a", "a"]])
+
+
+class TestValidateTemplates(TemplateDirTestCase):
+    def validate(self, **templates):
+        for name, content in templates.items():
+            self.write(f"{name}.txt", content)
+        chains_config = [
+            {"template_file": f"{name}.txt"} for name in templates if name != "output"
+        ]
+        return validate_templates(chains_config, self.dir, "_common.txt")
+
+    def test_valid_templates(self):
+        self.assertEqual(
+            self.validate(
+                canvas="Canvas",
+                risks="Risks of {canvas}",
+                output="{seed} {canvas} {risks}",
+            ),
+            [],
+        )
+
+    def test_missing_variables(self):
+        self.assertEqual(
+            self.validate(canvas="Canvas {canavs}", output="{canvas} {risks}"),
+            [
+                "canvas.txt uses {canavs}, which no template produces",
+                "output.txt uses {risks}, which no template produces",
+            ],
+        )
+
+    def test_unused_output(self):
+        self.assertEqual(
+            self.validate(canvas="Canvas", risks="Risks", output="{risks}"),
+            [
+                "The output of canvas.txt is not used by output.txt or any other template"
+            ],
+        )
+
+    def test_cycle(self):
+        self.assertEqual(
+            self.validate(
+                canvas="Canvas {risks}", risks="Risks {canvas}", output="{risks}"
+            ),
+            ["Templates depend on each other: canvas -> risks -> canvas"],
+        )
+
+    def test_later_template(self):
+        self.assertEqual(
+            self.validate(canvas="Canvas {risks}", risks="Risks", output="{canvas}"),
+            ["canvas.txt uses {risks}, which is produced by the later risks.txt"],
+        )
+
+    def test_missing_template_file(self):
+        self.write("output.txt", "{seed}")
+        problems = validate_templates(
+            [{"template_file": "missing.txt"}], self.dir, "_common.txt"
+        )
+        self.assertEqual(len(problems), 1)
+        self.assertTrue(problems[0].startswith("Cannot read missing.txt"))
+
+    def test_repository_templates_are_valid(self):
+        config = business_modeler.load_chain_config("config.yaml")
+        self.assertEqual(
+            validate_templates(config["chains"], "templates", "_common.txt"), []
+        )
+
+
+class TestCheckTemplates(unittest.TestCase):
+    @patch("business_modeler.validate_templates")
+    @patch("business_modeler.read_seed")
+    @patch("business_modeler.check_api_key")
+    def test_invalid_templates_fail_before_building_chain(
+        self, mock_check_api_key, mock_read_seed, mock_validate_templates
+    ):
+        mock_validate_templates.return_value = [
+            "risks.txt uses {x}, which no template produces"
+        ]
+
+        with patch("business_modeler_chains.build_chain") as mock_build_chain:
+            result = CliRunner().invoke(business_modeler.main, ["--seed-file", "s.md"])
+
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("Template error: risks.txt uses {x}", result.output)
+        mock_build_chain.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,164 @@
+import unittest
+from typing import Any, Dict, List, Optional
+from unittest.mock import patch
+
+from langchain.chains import LLMChain
+from langchain.llms.fake import FakeListLLM
+from langchain.prompts import PromptTemplate
+
+from business_modeler import (
+    TRUNCATION_MARKER,
+    compact_inputs,
+    compact_text,
+    count_tokens,
+    first_sentence,
+)
+from business_modeler_chains import DependencyGraphChain, stage_fingerprints
+
+
+def count_words(text):
+    return len(text.split())
+
+
+class PromptRecordingLLM(FakeListLLM):
+    """LLM that records its prompts and echoes the number of prompts seen."""
+
+    prompts: Any = None
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"model_name": "fake"}
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, **kwargs) -> str:
+        self.prompts.append(prompt)
+        return f"response {len(self.prompts)}"
+
+
+class TestCountTokens(unittest.TestCase):
+    @patch("business_modeler.load_tokenizer", return_value=None)
+    def test_estimates_tokens_without_tokenizer(self, _):
+        self.assertEqual(count_tokens("12345678"), 2)
+        self.assertEqual(count_tokens("123456789"), 3)
+
+    @patch("business_modeler.load_tokenizer")
+    def test_counts_with_tokenizer(self, mock_load_tokenizer):
+        mock_load_tokenizer.return_value.encode.return_value = [1, 2, 3]
+        self.assertEqual(count_tokens("some text", "gpt2"), 3)
+        mock_load_tokenizer.assert_called_once_with("gpt2")
+
+
+class TestCompactText(unittest.TestCase):
+    def test_short_text_is_unchanged(self):
+        self.assertEqual(compact_text("one two three", 3, count_words), "one two three")
+
+    def test_first_sentence_keeps_list_markers_and_headings(self):
+        self.assertEqual(
+            first_sentence("1. First idea. More detail."), "1. First idea."
+        )
+        self.assertEqual(first_sentence("- Point! Why."), "- Point!")
+        self.assertEqual(first_sentence("## A title. Really."), "## A title. Really.")
+        self.assertEqual(first_sentence("| a. b | c. d |"), "| a. b | c. d |")
+        self.assertEqual(first_sentence("no sentence end"), "no sentence end")
+
+    def test_summarizes_to_first_sentences(self):
+        text = "# Risks\n1. Cost. It is high.\n2. Time. It is short."
+        self.assertEqual(
+            compact_text(text, 8, count_words), "# Risks\n1. Cost.\n2. Time."
+        )
+
+    def test_truncates_whole_lines(self):
+        text = "\n".join(f"{i}. Item number {i}." for i in range(10))
+        compacted = compact_text(text, 10, count_words)
+        self.assertLessEqual(count_words(compacted), 10)
+        self.assertEqual(
+            compacted, f"0. Item number 0.\n1. Item number 1.{TRUNCATION_MARKER}"
+        )
+
+    def test_no_room_returns_empty_text(self):
+        self.assertEqual(compact_text("a b c", 0, count_words), "")
+
+
+class TestCompactInputs(unittest.TestCase):
+    def test_shares_budget_between_inputs(self):
+        prompt = PromptTemplate(
+            input_variables=["short", "long"], template="Short: {short} Long: {long}"
+        )
+        long_text = "\n".join(f"- Item {i}." for i in range(20))
+        inputs = {"short": "tiny input", "long": long_text, "other": "kept"}
+
+        compacted = compact_inputs(prompt, inputs, 20, count_words)
+
+        self.assertEqual(compacted["short"], "tiny input")
+        self.assertEqual(compacted["other"], "kept")
+        self.assertTrue(compacted["long"].endswith(TRUNCATION_MARKER))
+        self.assertLessEqual(
+            count_words(
+                prompt.format(short=compacted["short"], long=compacted["long"])
+            ),
+            20,
+        )
+
+    def test_inputs_within_budget_are_unchanged(self):
+        prompt = PromptTemplate(input_variables=["a"], template="A: {a}")
+        self.assertEqual(
+            compact_inputs(prompt, {"a": "x y"}, 10, count_words), {"a": "x y"}
+        )
+
+
+class TestDependencyGraphChainTokenBudget(unittest.TestCase):
+    def make_chain(self, **kwargs):
+        llm = PromptRecordingLLM(responses=[""], prompts=[])
+        chains = [
+            LLMChain(
+                llm=llm,
+                prompt=PromptTemplate(
+                    input_variables=["seed"], template="Canvas {seed}"
+                ),
+                output_key="canvas",
+            ),
+            LLMChain(
+                llm=llm,
+                prompt=PromptTemplate(
+                    input_variables=["seed", "canvas"],
+                    template="Alternatives {seed} {canvas}",
+                ),
+                output_key="alternatives",
+            ),
+        ]
+        chain = DependencyGraphChain(
+            chains=chains,
+            input_variables=["seed"],
+            output_variables=["canvas", "alternatives"],
+            **kwargs,
+        )
+        return chain, llm
+
+    @patch(
+        "business_modeler_chains.count_tokens",
+        side_effect=lambda t, **_: count_words(t),
+    )
+    def test_compacts_only_stages_with_budget(self, _):
+        chain, llm = self.make_chain(token_budgets={"alternatives": 5})
+        seed = "Seed. " + "word " * 20
+
+        chain({"seed": seed})
+
+        canvas_prompt, alternatives_prompt = llm.prompts
+        self.assertEqual(canvas_prompt, f"Canvas {seed}")
+        self.assertEqual(alternatives_prompt, "Alternatives Seed. response 1")
+
+    def test_token_budget_changes_fingerprint(self):
+        chain, _ = self.make_chain()
+        budget_chain, _ = self.make_chain(token_budgets={"alternatives": 5})
+
+        fingerprints = stage_fingerprints(chain, {"seed": "idea"})
+        budget_fingerprints = stage_fingerprints(budget_chain, {"seed": "idea"})
+
+        self.assertEqual(fingerprints["canvas"], budget_fingerprints["canvas"])
+        self.assertNotEqual(
+            fingerprints["alternatives"], budget_fingerprints["alternatives"]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,161 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from business_modeler import load_chain_config, validate_output, validate_output_rules
+from business_modeler_chains import (
+    CallbackHandler,
+    LocalBatchClient,
+    MockChatModel,
+    build_chain,
+    mock_response,
+    run_bulk,
+)
+
+REFUSAL = "I'm sorry, but I cannot create a canvas without more details."
+
+
+def assumptions_response(count):
+    items = "\n".join(f"{i}. Assumption {i}." for i in range(1, count + 1))
+    return f"# Assumptions\n\n{items}\n"
+
+
+class TestValidateOutput(unittest.TestCase):
+    def test_validate_output(self):
+        rules = {
+            "required_headings": ["Assumptions", "Next steps"],
+            "min_items": 3,
+            "max_length": 60,
+            "forbidden_patterns": ["^I'm sorry"],
+        }
+
+        self.assertEqual(
+            validate_output(
+                "# Assumptions.\n\n1. A\n2. B\n- C\n## Next steps\n", rules
+            ),
+            [],
+        )
+        self.assertEqual(
+            validate_output(assumptions_response(2), rules),
+            [
+                "is missing the heading 'Next steps'",
+                "has 2 list items, fewer than 3",
+            ],
+        )
+        self.assertEqual(
+            validate_output(REFUSAL, {"min_length": 100, **rules})[-2:],
+            [
+                "is 61 characters long, longer than 60",
+                "matches '^I'm sorry'",
+            ],
+        )
+
+    def test_validate_output_rules(self):
+        self.assertEqual(
+            validate_output_rules(load_chain_config("config.yaml")["chains"]), []
+        )
+        self.assertEqual(
+            validate_output_rules(
+                [
+                    {
+                        "template_file": "risks.txt",
+                        "validate": {
+                            "min_itemz": 3,
+                            "on_failure": "ignore",
+                            "max_length": -1,
+                            "forbidden_patterns": ["("],
+                        },
+                    }
+                ]
+            ),
+            [
+                "risks has an unknown validation rule 'min_itemz'",
+                "The on_failure of risks must be one of abort, retry",
+                "The max_length of risks must be a positive integer",
+                "risks has an invalid pattern '(': missing ), unterminated "
+                "subpattern at position 0",
+            ],
+        )
+
+
+class TestValidatedChain(unittest.TestCase):
+    def run_chain(self, responses=None):
+        chain = build_chain(
+            None,
+            load_chain_config("config.yaml")["chains"],
+            "templates",
+            "_common.txt",
+            backend="mock",
+            mock_options={"responses": responses or {}},
+        )
+        monitor = CallbackHandler()
+        try:
+            return chain({"seed": "An idea"}, callbacks=[monitor]), monitor.records
+        except ValueError as e:
+            return e, monitor.records
+
+    def test_aborts_before_downstream_stages(self):
+        error, records = self.run_chain({"Lean Business Model Canvas": REFUSAL})
+
+        self.assertIn("The output of chain 'canvas' failed validation", str(error))
+        self.assertIn("shorter than 200", str(error))
+        self.assertEqual([record["stage"] for record in records], ["canvas"])
+
+    def test_retries_failed_stage(self):
+        calls = []
+
+        def flaky_response(prompt):
+            if "overall assumptions" in prompt:
+                calls.append(prompt)
+                return assumptions_response(10 if len(calls) == 1 else 30)
+            return mock_response(prompt)
+
+        with patch("business_modeler_chains.mock_response", flaky_response):
+            output, records = self.run_chain()
+
+        self.assertEqual(output["assumptions"], assumptions_response(30))
+        self.assertEqual(len(calls), 2)
+        stages = [record["stage"] for record in records]
+        self.assertEqual(stages.count("assumptions"), 2)
+        self.assertEqual(stages.count("risks"), 1)
+
+    def test_aborts_once_retries_are_used_up(self):
+        error, records = self.run_chain({"Assumptions": assumptions_response(10)})
+
+        self.assertIn("has 10 list items, fewer than 30", str(error))
+        stages = [record["stage"] for record in records]
+        self.assertEqual(stages.count("assumptions"), 2)
+        self.assertNotIn("risks", stages)
+
+
+class TestBulkValidation(unittest.TestCase):
+    def test_failed_validation_fails_seed(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            seed_file = os.path.join(temp_dir, "seed.md")
+            with open(seed_file, "w") as f:
+                f.write("An idea")
+            chain = build_chain(
+                None,
+                load_chain_config("config.yaml")["chains"],
+                "templates",
+                "_common.txt",
+                backend="mock",
+            )
+            client = LocalBatchClient(
+                os.path.join(temp_dir, "batches"),
+                MockChatModel(responses={"Assumptions": assumptions_response(10)}),
+            )
+
+            (result,) = run_bulk(
+                chain, [seed_file], temp_dir, ["md"], client, poll_interval=0
+            )
+
+        self.assertTrue(result["error"].startswith("assumptions: The output failed"))
+        stages = [record["stage"] for record in result["stages"]]
+        self.assertEqual(stages.count("assumptions"), 2)
+        self.assertNotIn("risks", stages)
+
+
+if __name__ == "__main__":
+    unittest.main()
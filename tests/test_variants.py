@@ -0,0 +1,178 @@
+import unittest
+from unittest.mock import patch
+
+from click.testing import CliRunner
+
+import business_modeler
+from business_modeler import (
+    combine_variant_outputs,
+    load_chain_config,
+    validate_variants,
+    variant_label,
+)
+from business_modeler_chains import CallbackHandler, build_variant_chains, run_variants
+
+VARIANTS = [
+    {"name": "focused", "temperature": 0.3},
+    {"name": "gpt-4", "model_name": "gpt-4"},
+]
+
+
+def config_chains():
+    return load_chain_config("config.yaml")["chains"]
+
+
+class TestValidateVariants(unittest.TestCase):
+    def validate(self, shared_stages, variants=VARIANTS):
+        return validate_variants(
+            config_chains(), shared_stages, variants, "templates", "_common.txt"
+        )
+
+    def test_valid_variants(self):
+        self.assertEqual(self.validate(["canvas"]), [])
+        self.assertEqual(self.validate([]), [])
+
+    def test_shared_stage_depends_on_variant_stage(self):
+        self.assertEqual(
+            self.validate(["assumptions"]),
+            [
+                "The shared stage assumptions uses {canvas}, which is generated per variant"
+            ],
+        )
+
+    def test_invalid_settings(self):
+        self.assertEqual(
+            self.validate(["unknown"], []),
+            [
+                "No variants are configured",
+                "The shared stage unknown is not one of the chains",
+            ],
+        )
+        self.assertEqual(
+            self.validate([], [{"name": "a"}, {"name": "a"}]),
+            ["Every variant needs a unique name"],
+        )
+        self.assertIn(
+            "Every stage is shared, so the variants would not differ",
+            self.validate(
+                ["canvas", "assumptions", "risks", "experiments", "alternatives"]
+            ),
+        )
+
+
+class TestCombineVariantOutputs(unittest.TestCase):
+    def test_lists_differing_sections_per_variant(self):
+        self.assertEqual(
+            variant_label(VARIANTS[0], "gpt-3.5-turbo-16k", 0.7),
+            "focused (gpt-3.5-turbo-16k, temperature 0.3)",
+        )
+        chains_config = [
+            {"template_file": "canvas.txt", "model_name": "gpt-4"},
+            {"template_file": "risks.txt", "model_name": "gpt-4"},
+        ]
+        self.assertEqual(
+            variant_label(
+                VARIANTS[0], "gpt-3.5-turbo-16k", 0.7, chains_config, ["canvas"]
+            ),
+            "focused (gpt-3.5-turbo-16k, risks: gpt-4, temperature 0.3)",
+        )
+        self.assertEqual(
+            variant_label(VARIANTS[1], "gpt-3.5-turbo-16k", 0.7, chains_config),
+            "gpt-4 (gpt-4, temperature 0.7)",
+        )
+        sections = combine_variant_outputs(
+            {
+                "a": {"seed": "idea", "canvas": "C", "risks": "R1"},
+                "b": {"seed": "idea", "canvas": "C", "risks": "R2"},
+            }
+        )
+
+        self.assertEqual(sections["seed"], "idea")
+        self.assertEqual(sections["canvas"], "C")
+        self.assertEqual(
+            sections["risks"],
+            "---\n\n**Variant: a**\n\nR1\n\n---\n\n**Variant: b**\n\nR2",
+        )
+
+
+class TestRunVariants(unittest.TestCase):
+    def test_runs_shared_stages_once(self):
+        shared_chain, variant_chains = build_variant_chains(
+            None,
+            config_chains(),
+            ["canvas"],
+            VARIANTS,
+            prompt_templates_dir="templates",
+            common_prefix_file="_common.txt",
+            backend="mock",
+        )
+        self.assertEqual(shared_chain.output_variables, ["canvas"])
+        self.assertCountEqual(
+            variant_chains["focused"].input_variables, ["seed", "canvas"]
+        )
+
+        monitor = CallbackHandler()
+        outputs = run_variants(shared_chain, variant_chains, "An idea", [monitor])
+
+        self.assertEqual(list(outputs), ["focused", "gpt-4"])
+        self.assertEqual(outputs["focused"]["canvas"], outputs["gpt-4"]["canvas"])
+        self.assertIn("risks", outputs["gpt-4"])
+        stages = [record["stage"] for record in monitor.records]
+        self.assertEqual(stages.count("canvas"), 1)
+        self.assertEqual(stages.count("risks"), 2)
+        labels = [
+            (record["stage"], record.get("variant")) for record in monitor.records
+        ]
+        self.assertIn(("canvas", None), labels)
+        self.assertIn(("risks", "focused"), labels)
+        self.assertIn(("risks", "gpt-4"), labels)
+
+    @patch("business_modeler_chains.build_chain")
+    def test_variant_settings_override_model(self, mock_build_chain):
+        build_variant_chains(
+            None,
+            [{"template_file": "canvas.txt"}, {"template_file": "risks.txt"}],
+            ["canvas"],
+            VARIANTS,
+            model_name="gpt-3.5-turbo-16k",
+            temperature=0.7,
+        )
+
+        settings = [
+            (call.args[1], call.kwargs["model_name"], call.kwargs["temperature"])
+            for call in mock_build_chain.call_args_list
+        ]
+        self.assertEqual(
+            settings,
+            [
+                ([{"template_file": "canvas.txt"}], "gpt-3.5-turbo-16k", 0.7),
+                ([{"template_file": "risks.txt"}], "gpt-3.5-turbo-16k", 0.3),
+                ([{"template_file": "risks.txt"}], "gpt-4", 0.7),
+            ],
+        )
+
+    @patch("business_modeler_chains.build_chain")
+    def test_variant_settings_override_chain_settings(self, mock_build_chain):
+        chain_config = {"template_file": "risks.txt", "model_name": "gpt-4"}
+        build_variant_chains(None, [chain_config], [], VARIANTS)
+
+        self.assertEqual(
+            [call.args[1] for call in mock_build_chain.call_args_list],
+            [[chain_config], [{"template_file": "risks.txt"}]],
+        )
+
+
+class TestMainVariants(unittest.TestCase):
+    @patch("business_modeler.read_seed", return_value="seed")
+    def test_cannot_combine_with_batch(self, _):
+        result = CliRunner().invoke(
+            business_modeler.main,
+            ["--backend", "mock", "--seed-dir", ".", "--variants"],
+        )
+
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("--variants cannot be combined", result.output)
+
+
+if __name__ == "__main__":
+    unittest.main()